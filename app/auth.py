@@ -7,12 +7,15 @@ from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 import os
 
-from app.database import get_db
+from app.database import get_db, get_async_db
 from app.models import Doctor
 from app.schemas import TokenData
+from app.principal_cache import principal_cache
+from app.metrics import latency_tracker
 
 # Security configuration
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
@@ -25,6 +28,13 @@ if SECRET_KEY == "your-secret-key-change-in-production":
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 hours
 
+# Doctors allowed to use the admin endpoints (comma-separated emails)
+ADMIN_EMAILS = {
+    email.strip().lower()
+    for email in os.getenv("ADMIN_EMAILS", "").split(",")
+    if email.strip()
+}
+
 # Password hashing context
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -67,7 +77,23 @@ def get_current_doctor(
 ) -> Doctor:
     """
     Get the current authenticated doctor from JWT token
+    
+    Verified tokens are cached for AUTH_CACHE_TTL_SECONDS; a cached token
+    resolves without decoding it again or querying the database.
+    """
+    with latency_tracker.time("auth"):
+        return _resolve_doctor(token, db)
+
+
+def _resolve_doctor(token: str, db: Session) -> Doctor:
+    """
+    Resolve a bearer token to a doctor, using the principal cache
     """
+    cached_doctor = principal_cache.get(token)
+    if cached_doctor is not None:
+        # Attach a copy to this request's session without a SELECT
+        return db.merge(cached_doctor, load=False)
+    
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -87,9 +113,70 @@ def get_current_doctor(
     if doctor is None:
         raise credentials_exception
     
+    principal_cache.put(token, doctor, payload.get("exp"))
+    return doctor
+
+
+async def get_current_doctor_async(
+    token: str = Depends(oauth2_scheme),
+    db=Depends(get_async_db)
+) -> Doctor:
+    """
+    Get the current authenticated doctor using the async database session
+    
+    For async endpoints: resolving the doctor takes neither a threadpool
+    slot nor a synchronous pooled connection. Requires DB_ASYNC.
+    """
+    with latency_tracker.time("auth"):
+        return await _resolve_doctor_async(token, db)
+
+
+async def _resolve_doctor_async(token: str, db) -> Doctor:
+    """
+    Resolve a bearer token to a doctor with an async session
+    """
+    cached_doctor = principal_cache.get(token)
+    if cached_doctor is not None:
+        # Attach a copy to this request's session without a SELECT, as the
+        # sync path does; the cached instance is shared by every request
+        return await db.merge(cached_doctor, load=False)
+    
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        email: str = payload.get("sub")
+        if email is None:
+            raise credentials_exception
+    except JWTError:
+        raise credentials_exception
+    
+    result = await db.execute(select(Doctor).where(Doctor.email == email))
+    doctor = result.scalars().first()
+    if doctor is None:
+        raise credentials_exception
+    
+    principal_cache.put(token, doctor, payload.get("exp"))
     return doctor
 
 
+def get_current_admin(current_doctor: Doctor = Depends(get_current_doctor)) -> Doctor:
+    """
+    Get the current doctor, requiring administrator privileges
+    """
+    if current_doctor.email.lower() not in ADMIN_EMAILS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Administrator privileges required"
+        )
+    
+    return current_doctor
+
+
 def authenticate_doctor(db: Session, email: str, password: str) -> Optional[Doctor]:
     """
     Authenticate a doctor with email and password
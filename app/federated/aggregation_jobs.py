@@ -0,0 +1,184 @@
+"""
+Background aggregation jobs
+
+Aggregation used to run inside the request, holding a DB session and a
+threadpool slot until the new version was stored. Jobs now run on a
+single background thread per worker, one at a time, so concurrent
+requests on the same worker cannot race for the next version number. The
+request returns at once with a job to poll.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Optional
+
+from fastapi import HTTPException
+
+from app.database import SessionLocal
+from app.models import GlobalModel
+from app.schemas import AggregationPolicy, AggregationStrategy, TreeSelection, GlobalModelResponse
+from app.federated.aggregator import federated_averaging, resolve_strategy
+from app.metrics import latency_tracker
+
+# Finished jobs kept for status queries before the oldest are forgotten
+MAX_TRACKED_JOBS = 1000
+
+
+class AggregationJob:
+    """
+    Options, status and timings of one aggregation job
+    """
+
+    def __init__(
+        self,
+        policy: Optional[AggregationPolicy],
+        strategy: Optional[AggregationStrategy],
+        tree_budget: Optional[int],
+        tree_selection: Optional[TreeSelection],
+        distill: Optional[bool]
+    ):
+        self.id = uuid.uuid4().hex
+        self.policy = policy
+        self.strategy = strategy
+        self.tree_budget = tree_budget
+        self.tree_selection = tree_selection
+        self.distill = distill
+        self.status = "queued"
+        self.submitted_at = datetime.utcnow()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.aggregate_seconds: Optional[float] = None
+        self.error: Optional[str] = None
+        self.global_model: Optional[GlobalModelResponse] = None
+        self.future: Optional[Future] = None
+
+    @property
+    def queue_seconds(self) -> Optional[float]:
+        if self.started_at is None:
+            return None
+        return (self.started_at - self.submitted_at).total_seconds()
+
+
+class AggregationJobManager:
+    """
+    Runs aggregation jobs one at a time on a background thread
+    """
+
+    def __init__(self):
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._jobs: "OrderedDict[str, AggregationJob]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="aggregation")
+            return self._executor
+
+    def submit(
+        self,
+        policy: Optional[AggregationPolicy] = None,
+        strategy: Optional[AggregationStrategy] = None,
+        tree_budget: Optional[int] = None,
+        tree_selection: Optional[TreeSelection] = None,
+        distill: Optional[bool] = None,
+        on_success: Optional[Callable[[GlobalModel], None]] = None
+    ) -> AggregationJob:
+        """
+        Queue an aggregation
+
+        Args:
+            policy, strategy, tree_budget, tree_selection, distill: Options
+                of federated_averaging; None uses its defaults
+            on_success: Called with the new GlobalModel after it is stored
+
+        Returns:
+            The queued AggregationJob
+
+        Raises:
+            HTTPException: If the options do not fit together
+        """
+        # Rejected before queueing, so the request gets the 400
+        resolve_strategy(strategy, distill, tree_budget)
+
+        job = AggregationJob(policy, strategy, tree_budget, tree_selection, distill)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > MAX_TRACKED_JOBS:
+                self._jobs.popitem(last=False)
+
+        job.future = self._get_executor().submit(self._run, job, on_success)
+        return job
+
+    def get(self, job_id: str) -> Optional[AggregationJob]:
+        """
+        Look up a job
+
+        Args:
+            job_id: Job identifier returned by submit
+
+        Returns:
+            The AggregationJob, or None if unknown
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job: AggregationJob, on_success: Optional[Callable[[GlobalModel], None]]) -> None:
+        job.started_at = datetime.utcnow()
+        job.status = "running"
+        latency_tracker.record("aggregate.queue", job.queue_seconds)
+        start = time.perf_counter()
+
+        db = SessionLocal()
+        try:
+            global_model = federated_averaging(
+                db, job.policy, job.distill, job.strategy, job.tree_budget, job.tree_selection
+            )
+            job.global_model = GlobalModelResponse.model_validate(global_model)
+        except HTTPException as e:
+            db.rollback()
+            job.error = str(e.detail)
+        except Exception as e:
+            db.rollback()
+            job.error = f"Error aggregating models: {str(e)}"
+        finally:
+            db.close()
+
+        job.aggregate_seconds = time.perf_counter() - start
+        latency_tracker.record("aggregate.job", job.aggregate_seconds)
+        job.finished_at = datetime.utcnow()
+        if job.error is not None:
+            job.status = "failed"
+            return
+
+        job.status = "succeeded"
+        if on_success is not None:
+            on_success(global_model)
+
+    def stats(self) -> dict:
+        """
+        Count tracked jobs per status
+
+        Returns:
+            Dictionary of status -> number of jobs
+        """
+        with self._lock:
+            jobs = list(self._jobs.values())
+        counts = {"queued": 0, "running": 0, "succeeded": 0, "failed": 0}
+        for job in jobs:
+            counts[job.status] += 1
+        return counts
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop the background thread, by default after the running job"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+# Shared by the aggregation endpoints of this worker
+aggregation_jobs = AggregationJobManager()
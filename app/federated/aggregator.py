@@ -1,71 +1,528 @@
 """
 Federated averaging (FedAvg) aggregation logic
+
+How the members of a version are combined is up to an aggregation
+strategy. The ensemble strategy merges every member's trees with the
+sample weights folded in; the parameter averaging strategy averages the
+logistic regression each hospital fits alongside its forest, which keeps
+the served model at one coefficient per feature.
+
+New contributions are read from the database in batches, and legacy rows
+stored as pickled estimators are converted in a process pool. An ensemble
+version is stored as a manifest of member hashes and weights, so only the
+new contributions are read; the ensemble itself is assembled from its
+members when a host first serves it. Only a tree budget that removes
+trees, or distilling a student, assembles it during aggregation, at a cost
+proportional to the total size of the members.
 """
+import multiprocessing
+import os
 import pickle
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from fastapi import HTTPException
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Type
 
 from app.models import ModelContribution, GlobalModel
+from app.schemas import AggregationPolicy, AggregationStrategy, TreeSelection
+from app.federated.compiled_forest import CompiledForest
+from app.federated.linear_model import LinearModel
+from app.federated.artifact_store import (
+    artifact_store, save_forest, save_ensemble, assemble_ensemble, forest_size,
+    load_serving_forest, save_linear_model
+)
+from app.federated.distillation import DISTILL_ON_AGGREGATE, distill, load_server_inputs
+from app.federated.tree_budget import TREE_BUDGET, TREE_SELECTION, select_trees
+from app.metrics import latency_tracker
+
+# Policy used when an aggregation request does not choose one
+DEFAULT_AGGREGATION_POLICY = AggregationPolicy(os.getenv("AGGREGATION_POLICY", "all"))
+
+# Strategy used when an aggregation request does not choose one
+DEFAULT_AGGREGATION_STRATEGY = AggregationStrategy(os.getenv("AGGREGATION_STRATEGY", "ensemble"))
+
+# Processes converting legacy contributions
+AGGREGATION_WORKERS = int(os.getenv("AGGREGATION_WORKERS", "4"))
+
+# Contribution rows read from the database at a time
+AGGREGATION_BATCH_SIZE = int(os.getenv("AGGREGATION_BATCH_SIZE", "200"))
+
+
+def _compile_legacy_contribution(model_weights: bytes, num_samples: int) -> str:
+    """
+    Unpickle a legacy contribution, compile it and store its forest
+
+    Runs in a pool process.
+
+    Returns:
+        Content hash of the stored forest
+    """
+    model_data = pickle.loads(model_weights)
+    return save_forest(
+        CompiledForest.from_sklearn(model_data['model']),
+        {'feature_names': model_data['feature_names'], 'n_samples': num_samples}
+    )
+
+
+def _member(contribution_id: int, hospital_name: str, num_samples: int, artifact_hash: str) -> dict:
+    """
+    Describe a stored contribution as an ensemble member
+
+    Returns:
+        Member dictionary referencing the contribution's compiled forest
+    """
+    member = {
+        'contribution_id': contribution_id,
+        'hospital_name': hospital_name,
+        'num_samples': num_samples,
+        'artifact_hash': artifact_hash,
+    }
+    # Kept in the manifest so parameter averaging never opens the artifact
+    linear_params = artifact_store.metadata(artifact_hash).get('linear_model')
+    if linear_params is not None:
+        member['linear_model'] = linear_params
+    return member
+
+
+class _LegacyConverter:
+    """
+    Converts contributions stored before the artifact store existed
+
+    Their pickled estimators are fetched one batch at a time and compiled
+    in a process pool, started only if such rows are found. Each row is
+    updated to reference its new artifact, so it is converted only once.
+    """
+
+    def __init__(self, db: Session, workers: int = AGGREGATION_WORKERS):
+        self.db = db
+        self.workers = max(1, workers)
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def convert(self, rows: List) -> Dict[int, str]:
+        """
+        Args:
+            rows: Contribution rows without an artifact hash
+
+        Returns:
+            Dictionary of contribution id -> artifact hash
+        """
+        if self._pool is None:
+            # Spawned rather than forked: the parent holds threads and DB connections
+            self._pool = ProcessPoolExecutor(
+                max_workers=min(self.workers, len(rows)), mp_context=multiprocessing.get_context("spawn")
+            )
+
+        num_samples = {row.id: row.num_samples for row in rows}
+        blobs = (
+            self.db.query(ModelContribution.id, ModelContribution.model_weights)
+            .filter(ModelContribution.id.in_(list(num_samples)))
+            .all()
+        )
+        futures = {
+            contribution_id: self._pool.submit(
+                _compile_legacy_contribution, model_weights, num_samples[contribution_id]
+            )
+            for contribution_id, model_weights in blobs
+        }
+        del blobs
+
+        artifact_hashes = {}
+        for contribution_id, future in futures.items():
+            artifact_hashes[contribution_id] = future.result()
+            self.db.query(ModelContribution).filter(ModelContribution.id == contribution_id).update(
+                {ModelContribution.artifact_hash: artifact_hashes[contribution_id]},
+                synchronize_session=False
+            )
+        self.db.commit()
+        return artifact_hashes
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+class Strategy(ABC):
+    """
+    Combines the members of a global version into the model it serves
+
+    Members are shared by all strategies, so versions aggregated with
+    different strategies still reuse each other's members. A strategy is
+    instantiated per aggregation.
+    """
+
+    name: AggregationStrategy
+    # Whether a student can be distilled from the combined model
+    distillable = False
+    # Whether the strategy takes a tree budget
+    budgeted = False
+
+    @abstractmethod
+    def combine(self, members: List[dict], weights: List[float]) -> Tuple[Any, Optional[dict]]:
+        """
+        Build the served model
+
+        Args:
+            members: Member dictionaries, see _member
+            weights: Sample weight per member, summing to one
+
+        Returns:
+            Tuple of (combined model, tree budget report or None when no
+            budget removed trees)
+        """
+
+    @abstractmethod
+    def store(self, model: Any, manifest: dict) -> str:
+        """
+        Store the combined model with the version manifest
+
+        Returns:
+            Content hash of the artifact
+        """
 
 
-def federated_averaging(db: Session) -> GlobalModel:
+class EnsembleStrategy(Strategy):
+    """
+    Weighted ensemble of the trees of every member
+
+    The version is stored as its manifest, which references the members by
+    hash; the ensemble is assembled from them on first load. With a tree
+    budget, at most that many trees are kept, reweighted so the ensemble's
+    expected output is unchanged in expectation (see tree_budget), and the
+    budgeted forest is stored instead.
+    """
+
+    name = AggregationStrategy.ensemble
+    distillable = True
+    budgeted = True
+
+    def __init__(
+        self,
+        tree_budget: int = 0,
+        tree_selection: TreeSelection = TREE_SELECTION,
+        seed: int = 0
+    ):
+        self.tree_budget = tree_budget
+        self.tree_selection = tree_selection
+        self.seed = seed
+
+    def combine(
+        self,
+        members: List[dict],
+        weights: List[float]
+    ) -> Tuple[Optional[CompiledForest], Optional[dict]]:
+        """
+        Select trees under the tree budget
+
+        Returns:
+            Tuple of (budgeted forest and its report), or (None, None) when
+            every tree is kept and the members are served as they are
+        """
+        if not self.tree_budget:
+            return None, None
+        artifact_hashes = [member['artifact_hash'] for member in members]
+        tree_counts = [forest_size(artifact_hash)[1] for artifact_hash in artifact_hashes]
+        if sum(tree_counts) <= self.tree_budget:
+            return None, None
+
+        # FedAvg: weighted average of Random Forest models
+        # For Random Forest, we'll create an ensemble that weights predictions.
+        # The trees of every member are merged into one flat forest with the
+        # weights folded in, and the budget picks from it.
+        forest = assemble_ensemble(artifact_hashes, weights)
+        return select_trees(
+            forest, tree_counts, weights, self.tree_budget, self.tree_selection,
+            server_inputs=load_server_inputs(), seed=self.seed
+        )
+
+    def store(self, model: Optional[CompiledForest], manifest: dict) -> str:
+        if model is None:
+            return save_ensemble(manifest)
+        return save_forest(model, manifest)
+
+
+class ParameterAveragingStrategy(Strategy):
+    """Sample-weighted mean of the members' logistic regression parameters"""
+
+    name = AggregationStrategy.parameter_averaging
+
+    def combine(self, members: List[dict], weights: List[float]) -> Tuple[LinearModel, Optional[dict]]:
+        params = [
+            member.get('linear_model')
+            or artifact_store.metadata(member['artifact_hash']).get('linear_model')
+            for member in members
+        ]
+        missing = sum(p is None for p in params)
+        if missing:
+            raise HTTPException(
+                status_code=400,
+                detail=(
+                    f"{missing} of {len(members)} contributions have no parametric model "
+                    "(trained before parameter averaging was available); retrain them "
+                    "or aggregate with the ensemble strategy"
+                )
+            )
+        return LinearModel.average([LinearModel.from_dict(p) for p in params], weights), None
+
+    def store(self, model: LinearModel, manifest: dict) -> str:
+        return save_linear_model(model, manifest)
+
+
+STRATEGIES: Dict[AggregationStrategy, Type[Strategy]] = {
+    strategy.name: strategy for strategy in (EnsembleStrategy, ParameterAveragingStrategy)
+}
+
+
+def _contribution_batches(
+    db: Session,
+    policy: AggregationPolicy,
+    after_id: Optional[int] = None,
+    batch_size: int = AGGREGATION_BATCH_SIZE
+) -> Iterator[List]:
+    """
+    Get the contributions an aggregation has to add, oldest first
+
+    Rows are read in keyset-paginated batches without their legacy blob
+    column, so no more than one batch is held at a time.
+
+    Args:
+        db: Database session
+        policy: Which contributions take part in the ensemble
+        after_id: Only return contributions newer than this id
+        batch_size: Rows per batch
+
+    Yields:
+        Lists of (id, hospital_name, num_samples, artifact_hash,
+        supersedes_id) rows
+    """
+    query = db.query(
+        ModelContribution.id, ModelContribution.hospital_name,
+        ModelContribution.num_samples, ModelContribution.artifact_hash,
+        ModelContribution.supersedes_id
+    )
+
+    if policy == AggregationPolicy.latest_per_hospital:
+        latest_ids = (
+            db.query(func.max(ModelContribution.id))
+            .group_by(ModelContribution.hospital_name)
+        )
+        query = query.filter(ModelContribution.id.in_(latest_ids))
+
+    last_id = after_id or 0
+    while True:
+        rows = (
+            query.filter(ModelContribution.id > last_id)
+            .order_by(ModelContribution.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1].id
+
+
+def resolve_strategy(
+    strategy: Optional[AggregationStrategy],
+    distill_student: Optional[bool],
+    tree_budget: Optional[int]
+) -> Tuple[Type[Strategy], bool, int]:
+    """
+    Apply the defaults of an aggregation's options and check they fit
+
+    Args:
+        strategy: Requested strategy, None for AGGREGATION_STRATEGY
+        distill_student: Requested distillation, None for the default
+        tree_budget: Requested tree budget, None for the default
+
+    Returns:
+        Tuple of (strategy class, distill a student, tree budget)
+
+    Raises:
+        HTTPException: If a student or tree budget is requested for a
+            strategy without trees
+    """
+    strategy_class = STRATEGIES[strategy or DEFAULT_AGGREGATION_STRATEGY]
+    if distill_student is None:
+        distill_student = DISTILL_ON_AGGREGATE and strategy_class.distillable
+    elif distill_student and not strategy_class.distillable:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A student can only be distilled from the ensemble strategy, not {strategy_class.name.value}"
+        )
+    if tree_budget is None:
+        tree_budget = TREE_BUDGET if strategy_class.budgeted else 0
+    elif tree_budget and not strategy_class.budgeted:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A tree budget only applies to the ensemble strategy, not {strategy_class.name.value}"
+        )
+    return strategy_class, distill_student, tree_budget
+
+
+def federated_averaging(
+    db: Session,
+    policy: Optional[AggregationPolicy] = None,
+    distill_student: Optional[bool] = None,
+    strategy: Optional[AggregationStrategy] = None,
+    tree_budget: Optional[int] = None,
+    tree_selection: Optional[TreeSelection] = None
+) -> GlobalModel:
     """
     Implement FedAvg aggregation algorithm
-    
+
     Aggregates model weights from all hospital contributions
-    weighted by number of samples
-    
+    weighted by number of samples.
+
+    Aggregation is incremental: the members of the previous global version
+    are reused and only contributions recorded since then are added, so no
+    contribution is deserialized twice. Member forests live in the
+    artifact store and are referenced by hash; the global version stores
+    a manifest of its members plus whatever model its strategy combined
+    (none for an ensemble without a tree budget). Selecting trees under a
+    budget and distilling a student still read every member.
+
     Args:
         db: Database session
-        
+        policy: "all" keeps every contribution not superseded by an
+            incremental update, "latest_per_hospital" keeps only each
+            hospital's newest one
+        distill_student: Also distill a bounded-size student forest from
+            the ensemble; defaults to the DISTILL_ON_AGGREGATE setting
+        strategy: "ensemble" or "parameter_averaging"; defaults to the
+            AGGREGATION_STRATEGY setting
+        tree_budget: Maximum trees in the ensemble, 0 for no limit;
+            defaults to the TREE_BUDGET setting
+        tree_selection: "stratified" or "greedy" picks under the budget;
+            defaults to the TREE_SELECTION setting
+
     Returns:
         GlobalModel instance
-        
+
     Raises:
-        HTTPException: If no contributions available
+        HTTPException: If no contributions available, a student or tree
+            budget is requested for a strategy without trees, or a member
+            lacks what the strategy needs
     """
-    # Get all model contributions
-    contributions = db.query(ModelContribution).all()
-    
-    if not contributions:
+    policy = policy or DEFAULT_AGGREGATION_POLICY
+    strategy_class, distill_student, tree_budget = resolve_strategy(strategy, distill_student, tree_budget)
+
+    # Get the latest version and, if it exists, its already compiled
+    # members. Only its manifest is read; the served model is left to the
+    # model manager
+    latest = (
+        db.query(GlobalModel.version, GlobalModel.artifact_hash)
+        .order_by(GlobalModel.version.desc())
+        .first()
+    )
+    latest_version = latest.version if latest is not None else None
+    previous = (
+        artifact_store.metadata(latest.artifact_hash)
+        if latest is not None and latest.artifact_hash is not None else None
+    )
+    new_version = (latest_version + 1) if latest_version is not None else 1
+
+    if strategy_class.budgeted:
+        # Seeded by version, so re-running an aggregation picks the same trees
+        aggregation = strategy_class(tree_budget, tree_selection or TREE_SELECTION, seed=new_version)
+    else:
+        aggregation = strategy_class()
+
+    with latency_tracker.time("aggregate.members"):
+        if (
+            previous is not None
+            and previous.get('policy') == policy.value
+            and previous.get('members')
+            and all('artifact_hash' in member for member in previous['members'])
+        ):
+            previous_members = previous['members']
+            last_contribution_id = previous['last_contribution_id']
+        else:
+            # First aggregation, a policy change, or a version stored before
+            # members were kept: rebuild from the contributions table
+            previous_members = []
+            last_contribution_id = 0
+
+        # Keyed by hospital under latest_per_hospital, where a newer
+        # contribution replaces the hospital's member and moves to the end
+        by_hospital = policy == AggregationPolicy.latest_per_hospital
+        members_by_key = {
+            (member['hospital_name'] if by_hospital else member['contribution_id']): member
+            for member in previous_members
+        }
+        converter = _LegacyConverter(db)
+        try:
+            for rows in _contribution_batches(db, policy, after_id=last_contribution_id):
+                legacy = [row for row in rows if row.artifact_hash is None]
+                converted = converter.convert(legacy) if legacy else {}
+                for row in rows:
+                    member = _member(
+                        row.id, row.hospital_name, row.num_samples,
+                        row.artifact_hash or converted[row.id]
+                    )
+                    key = row.hospital_name if by_hospital else row.id
+                    if row.supersedes_id is not None and not by_hospital:
+                        # An incremental update replaces the contribution it built on
+                        members_by_key.pop(row.supersedes_id, None)
+                    members_by_key.pop(key, None)
+                    members_by_key[key] = member
+                last_contribution_id = rows[-1].id
+        finally:
+            converter.close()
+        members = list(members_by_key.values())
+
+    if not members:
         raise HTTPException(
             status_code=400,
             detail="No model contributions available for aggregation"
         )
-    
-    # Load all models and their sample counts
-    models = []
-    sample_counts = []
-    
-    for contrib in contributions:
-        model_data = pickle.loads(contrib.model_weights)
-        models.append(model_data['model'])
-        sample_counts.append(contrib.num_samples)
-    
+
+    sample_counts = [member['num_samples'] for member in members]
     total_samples = sum(sample_counts)
-    
-    # FedAvg: weighted average of Random Forest models
-    # For Random Forest, we'll create an ensemble that weights predictions
-    aggregated_model = {
-        'models': models,
-        'weights': [n / total_samples for n in sample_counts],
-        'num_contributions': len(contributions),
+    weights = [n / total_samples for n in sample_counts]
+
+    with latency_tracker.time("aggregate.merge"):
+        model, tree_budget_report = aggregation.combine(members, weights)
+
+    manifest = {
+        'members': members,
+        'weights': weights,
+        'policy': policy.value,
+        'strategy': aggregation.name.value,
+        'last_contribution_id': last_contribution_id,
+        'num_contributions': len(members),
         'total_samples': total_samples
     }
-    
-    # Get the latest version number
-    latest_model = db.query(GlobalModel).order_by(GlobalModel.version.desc()).first()
-    new_version = (latest_model.version + 1) if latest_model else 1
-    
+
+    # Identical models share one artifact
+    with latency_tracker.time("aggregate.store"):
+        artifact_hash = aggregation.store(model, manifest)
+
+    # Optional bounded-size student, stored next to the ensemble. Its
+    # teacher is the served forest, so this publishes it for this host
+    student_hash, student_report = None, None
+    if distill_student:
+        with latency_tracker.time("aggregate.distill"):
+            teacher = load_serving_forest(artifact_hash)[0]
+            student, student_report = distill(teacher, server_inputs=load_server_inputs())
+            student_hash = save_forest(student, {'teacher_artifact_hash': artifact_hash})
+
     # Create new global model
-    global_model = GlobalModel(
-        model_data=pickle.dumps(aggregated_model),
-        version=new_version,
-        num_contributions=len(contributions)
-    )
-    
-    db.add(global_model)
-    db.commit()
-    db.refresh(global_model)
-    
+    with latency_tracker.time("aggregate.commit"):
+        global_model = GlobalModel(
+            artifact_hash=artifact_hash,
+            student_artifact_hash=student_hash,
+            student_fidelity=student_report,
+            version=new_version,
+            strategy=aggregation.name.value,
+            tree_budget_report=tree_budget_report,
+            num_contributions=len(members)
+        )
+
+        db.add(global_model)
+        db.commit()
+        db.refresh(global_model)
+
     return global_model
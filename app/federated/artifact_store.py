@@ -0,0 +1,451 @@
+"""
+Content-addressed on-disk store for model artifacts
+
+Each artifact is a directory of ``.npy`` arrays plus a ``meta.json`` file,
+named after the SHA-256 of its content. Arrays are loaded memory-mapped, so
+every worker process on a host shares the same pages of the same model
+instead of holding its own copy, and identical artifacts are stored once.
+
+Forests are stored in a compact encoding that has to be decoded before
+traversal. So that decoded arrays are not duplicated in every worker, the
+decoded layout of a served forest is written once per host next to its
+artifact (``<hash>.serving``) and every worker maps that instead.
+
+A global ensemble version is stored as its manifest only: the member
+forests are referenced by hash, so a contribution's trees are stored once
+however many versions include it. The ensemble is assembled from its
+members when its serving layout is first written on a host.
+"""
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; publishing is then unlocked
+    fcntl = None
+
+import numpy as np
+
+from app.federated.compiled_forest import CompiledForest
+from app.federated.linear_model import LinearModel
+
+# Root directory of the artifact store
+MODEL_STORE_DIR = os.getenv("MODEL_STORE_DIR", "model_store")
+
+# Leaf value encoding of stored forests: float32 or uint16 (quantized)
+MODEL_VALUE_ENCODING = os.getenv("MODEL_VALUE_ENCODING", "float32")
+
+# Threads decoding member forests while an ensemble is assembled
+FOREST_DECODE_WORKERS = int(os.getenv("FOREST_DECODE_WORKERS", "4"))
+
+METADATA_FILE = "meta.json"
+
+# Suffix of the decoded serving layout derived from a forest artifact
+SERVING_SUFFIX = ".serving"
+
+# Suffix of the lock file serializing derived writes across processes
+LOCK_SUFFIX = ".lock"
+
+
+class ArtifactStore:
+    """
+    Immutable, content-addressed artifacts under a root directory
+    """
+
+    def __init__(self, root: str = MODEL_STORE_DIR):
+        self.root = root
+
+    def path(self, artifact_hash: str) -> str:
+        """Directory holding an artifact"""
+        return os.path.join(self.root, artifact_hash[:2], artifact_hash)
+
+    def exists(self, artifact_hash: str) -> bool:
+        return os.path.isdir(self.path(artifact_hash))
+
+    def put(self, arrays: Dict[str, np.ndarray], metadata: dict) -> str:
+        """
+        Store arrays and metadata, unless identical content already exists
+
+        Args:
+            arrays: Named arrays
+            metadata: JSON-serializable metadata
+
+        Returns:
+            Content hash identifying the artifact
+        """
+        arrays = {name: np.ascontiguousarray(value) for name, value in arrays.items()}
+        metadata_json = json.dumps(metadata, sort_keys=True)
+
+        digest = hashlib.sha256()
+        for name in sorted(arrays):
+            array = arrays[name]
+            digest.update(f"{name}:{array.dtype.str}:{array.shape};".encode())
+            digest.update(array.tobytes())
+        digest.update(metadata_json.encode())
+        artifact_hash = digest.hexdigest()
+
+        self._write(self.path(artifact_hash), arrays, metadata_json)
+        return artifact_hash
+
+    def _write(self, final_path: str, arrays: Dict[str, np.ndarray], metadata_json: str) -> None:
+        if os.path.isdir(final_path):
+            return
+
+        # Write into a private directory and rename it into place, so readers
+        # never see a partially written artifact
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        temp_path = os.path.join(self.root, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(temp_path)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(temp_path, f"{name}.npy"), array, allow_pickle=False)
+            with open(os.path.join(temp_path, METADATA_FILE), "w") as f:
+                f.write(metadata_json)
+            os.rename(temp_path, final_path)
+        except OSError:
+            # Another process stored the same content first
+            shutil.rmtree(temp_path, ignore_errors=True)
+            if not os.path.isdir(final_path):
+                raise
+
+    def derived_path(self, artifact_hash: str, suffix: str) -> str:
+        """Directory holding data derived from an artifact"""
+        return self.path(artifact_hash) + suffix
+
+    def put_derived(
+        self,
+        artifact_hash: str,
+        suffix: str,
+        arrays: Dict[str, np.ndarray],
+        metadata: dict
+    ) -> None:
+        """
+        Store data derived from an artifact, unless it already exists
+
+        Derived data is a pure function of its artifact, so it is written
+        at most once and removed together with the artifact.
+        """
+        arrays = {name: np.ascontiguousarray(value) for name, value in arrays.items()}
+        self._write(
+            self.derived_path(artifact_hash, suffix), arrays, json.dumps(metadata, sort_keys=True)
+        )
+
+    @contextmanager
+    def lock(self, artifact_hash: str) -> Iterator[None]:
+        """
+        Hold an exclusive lock on an artifact, across the processes of this host
+
+        Lets one process build data derived from the artifact while the
+        others wait for it instead of building it too.
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(self.derived_path(artifact_hash, LOCK_SUFFIX), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, artifact_hash: str, mmap: bool = True) -> Tuple[Dict[str, np.ndarray], dict]:
+        """
+        Load an artifact
+
+        Args:
+            artifact_hash: Content hash returned by put
+            mmap: Map arrays read-only instead of reading them into memory
+
+        Returns:
+            Tuple of (named arrays, metadata)
+
+        Raises:
+            FileNotFoundError: If the artifact does not exist
+        """
+        return self._read(self.path(artifact_hash), mmap)
+
+    def get_derived(
+        self,
+        artifact_hash: str,
+        suffix: str,
+        mmap: bool = True
+    ) -> Optional[Tuple[Dict[str, np.ndarray], dict]]:
+        """Load data derived from an artifact, None if it was not stored yet"""
+        path = self.derived_path(artifact_hash, suffix)
+        if not os.path.isdir(path):
+            return None
+        return self._read(path, mmap)
+
+    def metadata(self, artifact_hash: str) -> dict:
+        """Load only the metadata of an artifact"""
+        with open(os.path.join(self.path(artifact_hash), METADATA_FILE)) as f:
+            return json.load(f)
+
+    def _read(self, path: str, mmap: bool) -> Tuple[Dict[str, np.ndarray], dict]:
+        with open(os.path.join(path, METADATA_FILE)) as f:
+            metadata = json.load(f)
+
+        arrays = {}
+        for filename in os.listdir(path):
+            if filename.endswith(".npy"):
+                arrays[filename[:-4]] = np.load(
+                    os.path.join(path, filename),
+                    mmap_mode="r" if mmap else None,
+                    allow_pickle=False
+                )
+        return arrays, metadata
+
+    def list(self) -> Iterator[str]:
+        """Hashes of all stored artifacts"""
+        if not os.path.isdir(self.root):
+            return
+        for prefix in os.listdir(self.root):
+            prefix_path = os.path.join(self.root, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_path):
+                continue
+            for artifact_hash in os.listdir(prefix_path):
+                # Derived directories carry a suffix
+                if "." not in artifact_hash:
+                    yield artifact_hash
+
+    def size(self, artifact_hash: str, suffix: str = "") -> int:
+        """Bytes used on disk by an artifact, or by data derived from it
+        with the given suffix; 0 if missing"""
+        path = self.path(artifact_hash) + suffix
+        if not os.path.isdir(path):
+            return 0
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    def delete(self, artifact_hash: str) -> None:
+        """Remove an artifact and its derived data; processes that mapped
+        them keep their mapping"""
+        path = self.path(artifact_hash)
+        prefix_path = os.path.dirname(path)
+        if os.path.isdir(prefix_path):
+            for name in os.listdir(prefix_path):
+                if not name.startswith(artifact_hash + "."):
+                    continue
+                derived = os.path.join(prefix_path, name)
+                if os.path.isdir(derived):
+                    shutil.rmtree(derived, ignore_errors=True)
+                else:
+                    os.remove(derived)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def save_forest(
+    forest: CompiledForest,
+    metadata: Optional[dict] = None,
+    value_encoding: str = MODEL_VALUE_ENCODING
+) -> str:
+    """
+    Store a compiled forest in the compact format
+
+    Args:
+        forest: Forest to store
+        metadata: Extra JSON-serializable metadata
+        value_encoding: Leaf value encoding, "float32" or "uint16"
+
+    Returns:
+        Content hash of the artifact
+    """
+    arrays, compact_format = forest.to_compact(value_encoding)
+    return artifact_store.put(
+        arrays,
+        {
+            **(metadata or {}),
+            'kind': 'compiled_forest',
+            # Scalars go in the metadata; only node arrays are memory-mapped
+            'forest_shape': {'max_depth': forest.max_depth, 'n_features': forest.n_features},
+            'forest_format': compact_format,
+        }
+    )
+
+
+def load_forest(artifact_hash: str) -> Tuple[CompiledForest, dict]:
+    """
+    Load a stored compiled forest with memory-mapped node arrays
+
+    Args:
+        artifact_hash: Content hash returned by save_forest
+
+    Returns:
+        Tuple of (forest, metadata)
+    """
+    arrays, metadata = artifact_store.get(artifact_hash)
+    if 'forest_format' not in metadata:
+        # Stored before the compact format: full-precision arrays
+        return CompiledForest.from_arrays({**arrays, **metadata['forest_shape']}), metadata
+
+    forest = CompiledForest.from_compact(
+        arrays, metadata['forest_format'], **metadata['forest_shape']
+    )
+    return forest, metadata
+
+
+def forest_size(artifact_hash: str) -> Tuple[int, int]:
+    """
+    Nodes and trees of a stored forest, without decoding it
+
+    Returns:
+        Tuple of (n_nodes, n_trees)
+    """
+    arrays, _ = artifact_store.get(artifact_hash)
+    return len(arrays['feature']), len(arrays['tree_roots'])
+
+
+def decode_forests(
+    artifact_hashes: Sequence[str],
+    workers: int = FOREST_DECODE_WORKERS
+) -> Iterator[CompiledForest]:
+    """
+    Decode stored forests in a thread pool, in order
+
+    At most 2 * workers forests are decoded ahead of the consumer, so the
+    decoded forests never all exist at once.
+    """
+    workers = max(1, workers)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="forest-decode") as pool:
+        pending = deque()
+        for artifact_hash in artifact_hashes:
+            pending.append(pool.submit(lambda h: load_forest(h)[0], artifact_hash))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def assemble_ensemble(artifact_hashes: List[str], weights: Sequence[float]) -> CompiledForest:
+    """
+    Merge stored member forests into one weighted ensemble
+
+    Members are decoded a few at a time and copied into the preallocated
+    ensemble, so memory use is the ensemble plus a few members. The cost
+    is proportional to the total size of the members.
+
+    Args:
+        artifact_hashes: Member forests, in order
+        weights: Weight folded into each member's values
+
+    Returns:
+        CompiledForest whose output is the weighted sum of the members
+    """
+    sizes = [forest_size(artifact_hash) for artifact_hash in artifact_hashes]
+    n_features = artifact_store.metadata(artifact_hashes[0])['forest_shape']['n_features']
+    return CompiledForest.assemble(
+        decode_forests(artifact_hashes),
+        weights,
+        n_nodes=sum(n_nodes for n_nodes, _ in sizes),
+        n_trees=sum(n_trees for _, n_trees in sizes),
+        n_features=n_features
+    )
+
+
+def save_ensemble(manifest: dict) -> str:
+    """
+    Store a global ensemble version as its manifest only
+
+    Args:
+        manifest: Version manifest; its 'members' reference the member
+            forests by 'artifact_hash' and 'weights' holds their weights
+
+    Returns:
+        Content hash of the artifact
+    """
+    return artifact_store.put({}, {**manifest, 'kind': 'ensemble'})
+
+
+def publish_serving_forest(artifact_hash: str) -> None:
+    """
+    Write the decoded serving layout of a stored forest for this host
+
+    The layout is decoded from the stored artifact, or assembled from the
+    members of an ensemble version, so it is identical no matter which
+    process publishes it. Processes publishing the same artifact wait for
+    the first one instead of building it too.
+
+    Args:
+        artifact_hash: Content hash returned by save_forest or save_ensemble
+    """
+    if artifact_store.get_derived(artifact_hash, SERVING_SUFFIX) is not None:
+        return
+    with artifact_store.lock(artifact_hash):
+        if artifact_store.get_derived(artifact_hash, SERVING_SUFFIX) is not None:
+            return
+        metadata = artifact_store.metadata(artifact_hash)
+        if metadata.get('kind') == 'ensemble':
+            forest = assemble_ensemble(
+                [member['artifact_hash'] for member in metadata['members']], metadata['weights']
+            )
+        else:
+            forest = load_forest(artifact_hash)[0]
+        artifact_store.put_derived(
+            artifact_hash,
+            SERVING_SUFFIX,
+            forest.to_serving_arrays(),
+            {'max_depth': forest.max_depth, 'n_features': forest.n_features}
+        )
+
+
+def load_serving_forest(artifact_hash: str) -> Tuple[CompiledForest, dict]:
+    """
+    Load a stored forest for serving, attached read-only to shared arrays
+
+    The forest's traversal arrays are memory-mapped from the host's
+    serving layout, which is derived from the artifact on first use. All
+    workers of the host map the same file, so the page cache holds one
+    copy of the arrays. A SHAP explainer built for the forest is not
+    shared: it is a private copy in each worker (see explainer_cache).
+
+    Args:
+        artifact_hash: Content hash returned by save_forest or save_ensemble
+
+    Returns:
+        Tuple of (forest, metadata of the artifact)
+    """
+    publish_serving_forest(artifact_hash)
+    arrays, shape = artifact_store.get_derived(artifact_hash, SERVING_SUFFIX)
+    metadata = artifact_store.metadata(artifact_hash)
+    return CompiledForest.from_serving_arrays(arrays, **shape), metadata
+
+
+def save_linear_model(model: LinearModel, metadata: Optional[dict] = None) -> str:
+    """
+    Store a linear model
+
+    Args:
+        model: Model to store
+        metadata: Extra JSON-serializable metadata
+
+    Returns:
+        Content hash of the artifact
+    """
+    return artifact_store.put(
+        {'coef': model.coef, 'feature_means': model.feature_means},
+        {**(metadata or {}), 'kind': 'linear_model', 'intercept': model.intercept}
+    )
+
+
+def load_linear_model(artifact_hash: str) -> Tuple[LinearModel, dict]:
+    """
+    Load a stored linear model; its arrays are small enough to read
+
+    Args:
+        artifact_hash: Content hash returned by save_linear_model
+
+    Returns:
+        Tuple of (model, metadata)
+    """
+    arrays, metadata = artifact_store.get(artifact_hash, mmap=False)
+    return LinearModel(arrays['coef'], metadata['intercept'], arrays['feature_means']), metadata
+
+
+# Shared store of this process
+artifact_store = ArtifactStore()
@@ -0,0 +1,565 @@
+"""
+Flat array representation of the federated tree ensemble
+
+All trees from every hospital contribution are stored in one set of
+contiguous node arrays so a batch of rows can be scored against every tree
+in a single vectorized pass instead of going model by model through
+sklearn's per-estimator overhead.
+"""
+import numpy as np
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# Upper bound on rows x trees scored per traversal step; small enough for
+# the temporary node index matrices to stay in cache
+MAX_TRAVERSAL_CELLS = 65_536
+
+# Leaf value encodings of the compact storage format
+VALUE_ENCODINGS = ('float32', 'uint16')
+
+
+def _smallest_uint(max_value: int) -> np.dtype:
+    """Smallest unsigned integer dtype that can hold max_value"""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def _round_down_float32(threshold: np.ndarray) -> np.ndarray:
+    """
+    Largest float32 not above each threshold
+
+    Rows are compared as float32, and for any float32 x, x <= t holds
+    exactly when x <= round_down(t), so splits are unchanged.
+    """
+    rounded = threshold.astype(np.float32)
+    too_large = rounded.astype(np.float64) > threshold
+    rounded[too_large] = np.nextafter(rounded[too_large], np.float32(-np.inf))
+    return rounded
+
+
+class CompiledForest:
+    """
+    Flat, weighted forest of binary decision trees
+
+    Node arrays are indexed globally across all trees. Leaves point to
+    themselves as both children so every row can take the same number of
+    traversal steps. ``value`` holds the positive class probability of each
+    node already multiplied by the weight of its tree, so the forest output
+    for a row is the sum of its leaf values over all trees.
+    """
+
+    ARRAY_FIELDS = (
+        'feature', 'threshold', 'children_left', 'children_right',
+        'value', 'node_samples', 'tree_roots'
+    )
+
+    # Arrays exactly as traversal reads them; a forest built from these
+    # makes no private copies, so memory-mapped arrays stay shared
+    SERVING_FIELDS = ('feature', 'threshold', 'children', 'value', 'node_samples', 'tree_roots')
+
+    def __init__(
+        self,
+        feature: np.ndarray,
+        threshold: np.ndarray,
+        children_left: np.ndarray,
+        children_right: np.ndarray,
+        value: np.ndarray,
+        node_samples: np.ndarray,
+        tree_roots: np.ndarray,
+        max_depth: int,
+        n_features: int
+    ):
+        # Traversal lookup table: child of node i is children[2 * i + go_right]
+        children = np.empty(2 * len(feature), dtype=np.int32)
+        children[0::2] = children_left
+        children[1::2] = children_right
+
+        self._set_arrays(
+            feature.astype(np.int32, copy=False), threshold, children,
+            value, node_samples, tree_roots.astype(np.int32, copy=False),
+            max_depth, n_features
+        )
+
+    def _set_arrays(
+        self,
+        feature: np.ndarray,
+        threshold: np.ndarray,
+        children: np.ndarray,
+        value: np.ndarray,
+        node_samples: np.ndarray,
+        tree_roots: np.ndarray,
+        max_depth: int,
+        n_features: int
+    ) -> None:
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.value = value
+        self.node_samples = node_samples
+        self.tree_roots = tree_roots
+        self.max_depth = int(max_depth)
+        self.n_features = int(n_features)
+
+    @property
+    def children_left(self) -> np.ndarray:
+        return self.children[0::2]
+
+    @property
+    def children_right(self) -> np.ndarray:
+        return self.children[1::2]
+
+    @property
+    def n_trees(self) -> int:
+        return len(self.tree_roots)
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.feature)
+
+    @classmethod
+    def from_sklearn(cls, model, weight: float = 1.0) -> 'CompiledForest':
+        """
+        Compile a fitted RandomForestClassifier or RandomForestRegressor
+
+        Args:
+            model: Fitted sklearn forest with binary 0/1 target, or a
+                regression forest predicting the positive class probability
+            weight: Weight of the whole forest; each tree gets
+                weight / n_estimators
+
+        Returns:
+            CompiledForest whose output equals weight * P(class 1)
+        """
+        is_regressor = not hasattr(model, 'classes_')
+        classes = [] if is_regressor else list(model.classes_)
+        positive_index = classes.index(1) if 1 in classes else None
+        tree_weight = weight / len(model.estimators_)
+
+        features, thresholds, lefts, rights, values, samples, roots = [], [], [], [], [], [], []
+        max_depth = 0
+        offset = 0
+
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            n_nodes = tree.node_count
+            node_ids = np.arange(offset, offset + n_nodes)
+            is_leaf = tree.children_left == -1
+
+            # Normalize per node so both count and fraction layouts of
+            # tree_.value give the class probability
+            class_weights = tree.value[:, 0, :]
+            if is_regressor:
+                positive_prob = class_weights[:, 0]
+            elif positive_index is None:
+                positive_prob = np.zeros(n_nodes)
+            else:
+                positive_prob = class_weights[:, positive_index] / class_weights.sum(axis=1)
+
+            features.append(np.where(is_leaf, 0, tree.feature))
+            thresholds.append(np.where(is_leaf, np.inf, tree.threshold))
+            lefts.append(np.where(is_leaf, node_ids, tree.children_left + offset))
+            rights.append(np.where(is_leaf, node_ids, tree.children_right + offset))
+            values.append(positive_prob * tree_weight)
+            samples.append(tree.weighted_n_node_samples)
+            roots.append(offset)
+
+            max_depth = max(max_depth, tree.max_depth)
+            offset += n_nodes
+
+        return cls(
+            feature=np.concatenate(features).astype(np.int32),
+            threshold=np.concatenate(thresholds).astype(np.float64),
+            children_left=np.concatenate(lefts).astype(np.int32),
+            children_right=np.concatenate(rights).astype(np.int32),
+            value=np.concatenate(values).astype(np.float64),
+            node_samples=np.concatenate(samples).astype(np.float64),
+            tree_roots=np.asarray(roots, dtype=np.int32),
+            max_depth=max_depth,
+            n_features=model.n_features_in_
+        )
+
+    @classmethod
+    def concatenate(
+        cls,
+        forests: Sequence['CompiledForest'],
+        weights: Optional[Sequence[float]] = None
+    ) -> 'CompiledForest':
+        """
+        Merge several forests into one, optionally rescaling each
+
+        Args:
+            forests: Forests to merge
+            weights: Multiplier applied to each forest's values
+
+        Returns:
+            CompiledForest whose output is the weighted sum of the inputs
+        """
+        if weights is None:
+            weights = [1.0] * len(forests)
+
+        return cls.assemble(
+            forests,
+            weights,
+            n_nodes=sum(forest.n_nodes for forest in forests),
+            n_trees=sum(forest.n_trees for forest in forests),
+            n_features=forests[0].n_features
+        )
+
+    @classmethod
+    def assemble(
+        cls,
+        forests: Iterable['CompiledForest'],
+        weights: Sequence[float],
+        n_nodes: int,
+        n_trees: int,
+        n_features: int
+    ) -> 'CompiledForest':
+        """
+        Merge forests into arrays allocated up front, one forest at a time
+
+        Only the output and the forest being copied need to be in memory,
+        so the forests can be produced lazily (e.g. decoded on demand).
+
+        Args:
+            forests: Forests to merge, in order
+            weights: Multiplier applied to each forest's values
+            n_nodes: Total nodes of the forests
+            n_trees: Total trees of the forests
+            n_features: Number of input features
+
+        Returns:
+            CompiledForest whose output is the weighted sum of the inputs
+
+        Raises:
+            ValueError: If the forests do not add up to n_nodes and n_trees
+        """
+        arrays = {
+            'feature': np.empty(n_nodes, dtype=np.int32),
+            'threshold': np.empty(n_nodes, dtype=np.float64),
+            'children': np.empty(2 * n_nodes, dtype=np.int32),
+            'value': np.empty(n_nodes, dtype=np.float64),
+            'node_samples': np.empty(n_nodes, dtype=np.float64),
+            'tree_roots': np.empty(n_trees, dtype=np.int32),
+        }
+        node_offset, tree_offset, max_depth = 0, 0, 0
+
+        for forest, weight in zip(forests, weights):
+            node_end, tree_end = node_offset + forest.n_nodes, tree_offset + forest.n_trees
+            if node_end > n_nodes or tree_end > n_trees:
+                raise ValueError("Forests are larger than the allocated ensemble")
+
+            arrays['feature'][node_offset:node_end] = forest.feature
+            arrays['threshold'][node_offset:node_end] = forest.threshold
+            np.add(forest.children, node_offset, out=arrays['children'][2 * node_offset:2 * node_end])
+            np.multiply(forest.value, weight, out=arrays['value'][node_offset:node_end])
+            arrays['node_samples'][node_offset:node_end] = forest.node_samples
+            np.add(forest.tree_roots, node_offset, out=arrays['tree_roots'][tree_offset:tree_end])
+
+            max_depth = max(max_depth, forest.max_depth)
+            node_offset, tree_offset = node_end, tree_end
+
+        if node_offset != n_nodes or tree_offset != n_trees:
+            raise ValueError("Forests are smaller than the allocated ensemble")
+
+        return cls.from_serving_arrays(arrays, max_depth, n_features)
+
+    def select_trees(self, tree_indices: np.ndarray, scales: np.ndarray) -> 'CompiledForest':
+        """
+        Build a forest from a subset of the trees, rescaling each
+
+        Args:
+            tree_indices: Trees to keep, in output order
+            scales: Multiplier applied to the values of each kept tree
+
+        Returns:
+            CompiledForest with only the kept trees
+        """
+        tree_indices = np.asarray(tree_indices, dtype=np.int64)
+        tree_sizes = np.diff(np.append(self.tree_roots, self.n_nodes))[tree_indices]
+        old_roots = self.tree_roots[tree_indices].astype(np.int64)
+        new_roots = np.concatenate([[0], np.cumsum(tree_sizes)[:-1]]).astype(np.int64)
+
+        # Trees are contiguous node ranges, so nodes move by their tree's shift
+        shift = np.repeat(new_roots - old_roots, tree_sizes)
+        node_ids = np.arange(int(tree_sizes.sum())) - shift
+
+        return CompiledForest(
+            feature=self.feature[node_ids],
+            threshold=self.threshold[node_ids],
+            children_left=(self.children_left[node_ids] + shift).astype(np.int32),
+            children_right=(self.children_right[node_ids] + shift).astype(np.int32),
+            value=self.value[node_ids] * np.repeat(np.asarray(scales, dtype=np.float64), tree_sizes),
+            node_samples=self.node_samples[node_ids],
+            tree_roots=new_roots.astype(np.int32),
+            max_depth=self.max_depth,
+            n_features=self.n_features
+        )
+
+    def to_arrays(self) -> dict:
+        """
+        Export the forest as a dictionary of plain arrays and scalars
+        """
+        arrays = {name: getattr(self, name) for name in self.ARRAY_FIELDS}
+        arrays['max_depth'] = self.max_depth
+        arrays['n_features'] = self.n_features
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: dict) -> 'CompiledForest':
+        """
+        Rebuild a forest exported with to_arrays
+        """
+        return cls(**{name: arrays[name] for name in cls.ARRAY_FIELDS},
+                   max_depth=arrays['max_depth'],
+                   n_features=arrays['n_features'])
+
+    def to_serving_arrays(self) -> dict:
+        """
+        Export the arrays traversal reads, in the layout it reads them
+        """
+        return {name: getattr(self, name) for name in self.SERVING_FIELDS}
+
+    @classmethod
+    def from_serving_arrays(cls, arrays: dict, max_depth: int, n_features: int) -> 'CompiledForest':
+        """
+        Wrap arrays exported with to_serving_arrays without copying them
+        """
+        forest = cls.__new__(cls)
+        forest._set_arrays(*(arrays[name] for name in cls.SERVING_FIELDS), max_depth, n_features)
+        return forest
+
+    def to_compact(self, value_encoding: str = 'float32') -> Tuple[dict, dict]:
+        """
+        Export the forest in the compact storage format
+
+        Only what traversal and TreeSHAP read is kept: thresholds as
+        float32 rounded down (splits are unchanged for float32 rows),
+        feature ids and child indices as the smallest unsigned integers
+        that fit, with child indices relative to their tree, and node
+        sample counts as float32. Values are float32, or uint16 scaled by
+        the largest value.
+
+        Args:
+            value_encoding: "float32" or "uint16"
+
+        Returns:
+            Tuple of (arrays, format description needed by from_compact)
+
+        Raises:
+            ValueError: If value_encoding is unknown
+        """
+        if value_encoding not in VALUE_ENCODINGS:
+            raise ValueError(f"Unknown value encoding: {value_encoding}")
+
+        tree_sizes = np.diff(np.append(self.tree_roots, self.n_nodes))
+        offsets = np.repeat(self.tree_roots, tree_sizes)
+        index_dtype = _smallest_uint(int(tree_sizes.max()) - 1)
+
+        arrays = {
+            'feature': self.feature.astype(_smallest_uint(self.n_features - 1)),
+            'threshold': _round_down_float32(np.asarray(self.threshold, dtype=np.float64)),
+            'children_left': (self.children_left - offsets).astype(index_dtype),
+            'children_right': (self.children_right - offsets).astype(index_dtype),
+            'node_samples': self.node_samples.astype(np.float32),
+            'tree_roots': self.tree_roots.astype(_smallest_uint(self.n_nodes - 1)),
+        }
+        compact_format = {'value_encoding': value_encoding}
+
+        if value_encoding == 'uint16':
+            scale = float(self.value.max()) or 1.0
+            arrays['value'] = np.rint(self.value / scale * 65535).astype(np.uint16)
+            compact_format['value_scale'] = scale
+        else:
+            arrays['value'] = self.value.astype(np.float32)
+
+        return arrays, compact_format
+
+    @classmethod
+    def from_compact(
+        cls,
+        arrays: dict,
+        compact_format: dict,
+        max_depth: int,
+        n_features: int
+    ) -> 'CompiledForest':
+        """
+        Rebuild a forest exported with to_compact
+
+        Thresholds and node sample counts are used as stored (memory-mapped
+        arrays stay mapped); indices and values are decoded.
+        """
+        tree_roots = arrays['tree_roots'].astype(np.int32)
+        n_nodes = len(arrays['feature'])
+        offsets = np.repeat(tree_roots, np.diff(np.append(tree_roots, n_nodes)))
+
+        value = arrays['value'].astype(np.float64)
+        if compact_format['value_encoding'] == 'uint16':
+            value *= compact_format['value_scale'] / 65535
+
+        return cls(
+            feature=arrays['feature'].astype(np.int32),
+            threshold=arrays['threshold'],
+            children_left=(arrays['children_left'] + offsets).astype(np.int32),
+            children_right=(arrays['children_right'] + offsets).astype(np.int32),
+            value=value,
+            node_samples=arrays['node_samples'],
+            tree_roots=tree_roots,
+            max_depth=max_depth,
+            n_features=n_features
+        )
+
+    def to_shap_model(self) -> dict:
+        """
+        Export the forest in shap's dictionary tree ensemble format
+
+        TreeSHAP values are additive over trees, so explaining this single
+        model gives the weighted sum of the member models' explanations.
+
+        Returns:
+            Dictionary accepted by shap.TreeExplainer
+        """
+        trees = []
+        bounds = list(self.tree_roots) + [self.n_nodes]
+
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            node_ids = np.arange(start, end)
+            left = self.children_left[start:end]
+            is_leaf = left == node_ids
+            children_left = np.where(is_leaf, -1, left - start).astype(np.int32)
+            children_right = np.where(is_leaf, -1, self.children_right[start:end] - start).astype(np.int32)
+
+            trees.append({
+                'children_left': children_left,
+                'children_right': children_right,
+                'children_default': children_left,
+                'features': np.where(is_leaf, -2, self.feature[start:end]).astype(np.int32),
+                'thresholds': np.where(is_leaf, -2.0, self.threshold[start:end]).astype(np.float64),
+                'values': self.value[start:end].astype(np.float64).reshape(-1, 1),
+                'node_sample_weight': self.node_samples[start:end].astype(np.float64),
+            })
+
+        return {'trees': trees}
+
+    def iter_leaves(self, X: np.ndarray) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Find the leaf reached in every tree, a chunk of rows at a time
+
+        Args:
+            X: 2-D feature matrix
+
+        Yields:
+            Tuples of (first row index, array of shape (chunk_rows, n_trees)
+            with global leaf indices)
+        """
+        # sklearn compares float32 features against float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        n_features = X.shape[1]
+        chunk = max(1, MAX_TRAVERSAL_CELLS // max(self.n_trees, 1))
+
+        for start in range(0, X.shape[0], chunk):
+            X_chunk = X[start:start + chunk]
+            flat = X_chunk.ravel()
+            row_offsets = (np.arange(len(X_chunk)) * n_features)[:, None]
+            nodes = np.broadcast_to(self.tree_roots, (len(X_chunk), self.n_trees))
+
+            for _ in range(self.max_depth):
+                values = flat[row_offsets + self.feature[nodes]]
+                go_right = values > self.threshold[nodes]
+                nodes = self.children[2 * nodes + go_right]
+
+            yield start, nodes
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        """
+        Score every row against all trees in one pass
+
+        Args:
+            X: 2-D feature matrix
+
+        Returns:
+            Weighted positive class probability per row
+        """
+        output = np.empty(len(X), dtype=np.float64)
+        for start, leaves in self.iter_leaves(X):
+            output[start:start + len(leaves)] = self.value[leaves].sum(axis=1)
+        return output
+
+    def predict_trees(self, X: np.ndarray) -> np.ndarray:
+        """
+        Weighted output of every tree for every row
+
+        Args:
+            X: 2-D feature matrix
+
+        Returns:
+            Array of shape (n_rows, n_trees); rows sum to predict(X)
+        """
+        output = np.empty((len(X), self.n_trees), dtype=np.float64)
+        for start, leaves in self.iter_leaves(X):
+            output[start:start + len(leaves)] = self.value[leaves]
+        return output
+
+    def saabas_contributions(self, X: np.ndarray) -> np.ndarray:
+        """
+        Path-based (Saabas) feature contributions for every row
+
+        Each split on the decision path credits its feature with the change
+        in node value from parent to child. Contributions plus the summed
+        root values equal the forest output exactly. This is a cheap
+        approximation of TreeSHAP computed during the same traversal.
+
+        Args:
+            X: 2-D feature matrix
+
+        Returns:
+            Array of shape (n_rows, n_features) with contributions
+        """
+        X = np.asarray(X, dtype=np.float32)
+        n_features = X.shape[1]
+        contributions = np.zeros((X.shape[0], n_features), dtype=np.float64)
+        chunk = max(1, MAX_TRAVERSAL_CELLS // max(self.n_trees, 1))
+
+        for start in range(0, X.shape[0], chunk):
+            X_chunk = X[start:start + chunk]
+            n_rows = len(X_chunk)
+            flat = X_chunk.ravel()
+            row_offsets = (np.arange(n_rows) * n_features)[:, None]
+            nodes = np.broadcast_to(self.tree_roots, (n_rows, self.n_trees))
+            totals = np.zeros(n_rows * n_features, dtype=np.float64)
+
+            for _ in range(self.max_depth):
+                cells = row_offsets + self.feature[nodes]
+                go_right = flat[cells] > self.threshold[nodes]
+                children = self.children[2 * nodes + go_right]
+                # Leaves point to themselves, so they contribute zero
+                totals += np.bincount(
+                    cells.ravel(),
+                    weights=(self.value[children] - self.value[nodes]).ravel(),
+                    minlength=n_rows * n_features
+                )
+                nodes = children
+
+            contributions[start:start + n_rows] = totals.reshape(n_rows, n_features)
+
+        return contributions
+
+    def expected_value(self) -> float:
+        """Sum of root node values, the baseline for Saabas contributions"""
+        return float(self.value[self.tree_roots].sum())
+
+
+def compile_ensemble(models: List, weights: Sequence[float]) -> CompiledForest:
+    """
+    Compile a weighted list of sklearn forests into one flat forest
+
+    Args:
+        models: Fitted RandomForestClassifier objects
+        weights: Aggregation weight of each model
+
+    Returns:
+        CompiledForest whose output is the weighted ensemble probability
+    """
+    return CompiledForest.concatenate(
+        [CompiledForest.from_sklearn(model, weight) for model, weight in zip(models, weights)]
+    )
@@ -1,10 +1,18 @@
 """
 Data processing and validation for federated learning
 """
-import pandas as pd
+import numpy as np
 from io import StringIO
-from fastapi import HTTPException
-from typing import Tuple, List
+from typing import TYPE_CHECKING, BinaryIO, Dict, IO, List, Tuple, Union
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Rows parsed per chunk when streaming an upload
+CSV_CHUNK_ROWS = 10_000
+
+# Uploads larger than this are rejected while streaming, before they are fully parsed
+MAX_TRAINING_ROWS = 1_000_000
 
 
 def get_required_columns() -> List[str]:
@@ -33,36 +41,176 @@ def get_feature_names() -> List[str]:
     ]
 
 
-def validate_and_parse_csv(csv_data: str) -> Tuple[pd.DataFrame, pd.Series]:
+def get_column_dtypes() -> Dict[str, str]:
     """
-    Validate and parse CSV data for training
+    Get the dtype every value of each required column must fit
+    
+    Returns:
+        Dictionary of column name -> NumPy dtype name
+    """
+    dtypes = {column: 'int32' for column in get_required_columns()}
+    dtypes['oldpeak'] = 'float32'
+    return dtypes
+
+
+def validate_column_values(chunk: "pd.DataFrame") -> None:
+    """
+    Check that every value of a parsed chunk fits its column's dtype
+    
+    Columns are parsed as float64, which holds every int32 exactly, so
+    integer columns accept integral values written as floats (e.g. 0.0)
+    while fractional and out-of-range values are rejected instead of
+    being truncated or wrapped around.
     
     Args:
-        csv_data: CSV content as string
+        chunk: DataFrame with all required columns parsed as float64
+        
+    Raises:
+        ValueError: If a value is missing, fractional in an integer
+            column, or outside its column's dtype
+    """
+    for column, dtype in get_column_dtypes().items():
+        values = chunk[column].to_numpy()
+        if np.isnan(values).any():
+            raise ValueError(f"Column '{column}' contains missing values")
+        
+        if np.dtype(dtype).kind == 'i':
+            low, high = np.iinfo(dtype).min, np.iinfo(dtype).max
+        else:
+            low, high = -np.finfo(dtype).max, np.finfo(dtype).max
+        if ((values < low) | (values > high)).any():
+            raise ValueError(f"Column '{column}' contains values outside the range [{low}, {high}]")
+        if np.dtype(dtype).kind == 'i' and (values != np.floor(values)).any():
+            raise ValueError(f"Column '{column}' must contain whole numbers")
+
+
+class ColumnarBuffer:
+    """
+    Growable typed per-column storage for parsed CSV chunks
+    
+    Features are kept as float32 columns (the dtype the trees are fitted
+    on) and the target as int8, so memory scales with the numeric data
+    rather than with the CSV text.
+    """
+    
+    def __init__(self, capacity: int = CSV_CHUNK_ROWS):
+        self.num_rows = 0
+        self._features = {name: np.empty(capacity, dtype=np.float32) for name in get_feature_names()}
+        self._target = np.empty(capacity, dtype=np.int8)
+    
+    def append(self, chunk: "pd.DataFrame") -> None:
+        """
+        Append one parsed chunk
+        
+        Args:
+            chunk: DataFrame with all required columns
+        """
+        start, end = self.num_rows, self.num_rows + len(chunk)
+        if end > len(self._target):
+            self._grow(max(end, 2 * len(self._target)))
+        
+        for name, column in self._features.items():
+            column[start:end] = chunk[name].to_numpy()
+        self._target[start:end] = chunk['target'].to_numpy()
+        self.num_rows = end
+    
+    def _grow(self, capacity: int) -> None:
+        for name, column in self._features.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.num_rows] = column[:self.num_rows]
+            self._features[name] = grown
+        grown = np.empty(capacity, dtype=self._target.dtype)
+        grown[:self.num_rows] = self._target[:self.num_rows]
+        self._target = grown
+    
+    def to_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Build the training arrays, releasing each column once copied
+        
+        Returns:
+            Tuple of (float32 feature matrix in column-major order, int8 target)
+        """
+        X = np.empty((self.num_rows, len(self._features)), dtype=np.float32, order='F')
+        for i, name in enumerate(get_feature_names()):
+            X[:, i] = self._features.pop(name)[:self.num_rows]
+        y = self._target[:self.num_rows].copy()
+        self._target = np.empty(0, dtype=np.int8)
+        return X, y
+
+
+def parse_csv_stream(
+    stream: Union[BinaryIO, IO[str]],
+    chunk_rows: int = CSV_CHUNK_ROWS
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Stream, validate and parse CSV data for training chunk by chunk
+    
+    Only the required columns are parsed, as float64, and checked against
+    their dtypes (see validate_column_values) before they are copied into
+    a columnar buffer. Columns, values and row counts are checked as
+    chunks arrive, so bad uploads fail without parsing the whole file.
+    
+    Args:
+        stream: Binary or text file object positioned at the CSV header
+        chunk_rows: Rows parsed per chunk
         
     Returns:
-        Tuple of (features DataFrame, target Series)
+        Tuple of (feature matrix, target vector)
         
     Raises:
         ValueError: If data validation fails
     """
-    # Parse CSV data
-    df = pd.read_csv(StringIO(csv_data))
+    # Imported on first upload so serving workers never load pandas
+    import pandas as pd
     
-    # Validate required columns
     required_columns = get_required_columns()
-    missing_columns = [col for col in required_columns if col not in df.columns]
-    if missing_columns:
-        raise ValueError(f"Missing required columns: {missing_columns}")
+    required = set(required_columns)
+    buffer = ColumnarBuffer(chunk_rows)
+    
+    try:
+        reader = pd.read_csv(
+            stream,
+            usecols=lambda column: column in required,
+            dtype={column: 'float64' for column in required_columns},
+            chunksize=chunk_rows
+        )
+        
+        for chunk in reader:
+            # Validate required columns
+            missing_columns = [col for col in required_columns if col not in chunk.columns]
+            if missing_columns:
+                raise ValueError(f"Missing required columns: {missing_columns}")
+            
+            validate_column_values(chunk)
+            if not chunk['target'].isin((0, 1)).all():
+                raise ValueError("Column 'target' must contain only 0 or 1")
+            if buffer.num_rows + len(chunk) > MAX_TRAINING_ROWS:
+                raise ValueError(f"Dataset must contain at most {MAX_TRAINING_ROWS} samples")
+            
+            buffer.append(chunk)
+    except pd.errors.EmptyDataError:
+        raise ValueError("CSV file is empty")
+    except (TypeError, OverflowError) as e:
+        raise ValueError(f"Invalid value in CSV: {str(e)}")
     
     # Validate minimum sample size
-    num_samples = len(df)
-    if num_samples < 10:
+    if buffer.num_rows < 10:
         raise ValueError("Dataset must contain at least 10 samples")
     
-    # Prepare features and target
-    feature_cols = get_feature_names()
-    X = df[feature_cols]
-    y = df['target']
+    return buffer.to_arrays()
+
+
+def validate_and_parse_csv(csv_data: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Validate and parse CSV data for training
     
-    return X, y
+    Args:
+        csv_data: CSV content as string
+        
+    Returns:
+        Tuple of (feature matrix, target vector)
+        
+    Raises:
+        ValueError: If data validation fails
+    """
+    return parse_csv_stream(StringIO(csv_data))
@@ -0,0 +1,239 @@
+"""
+Distillation of the federated ensemble into a bounded-size student forest
+
+The global ensemble holds every tree of every contribution, so inference
+cost grows with the federation. The student is a small regression forest
+fitted to the ensemble's risk scores. Its size depends only on the
+DISTILL_* settings, so serving from it keeps latency flat however many
+hospitals contribute.
+
+The server holds no patient data. Training inputs are synthesized from
+the ensemble itself. A row walks down a few random trees, taking each
+branch with the share of training samples that went that way. The splits
+on its paths bound the features they test, so rows roughly follow the
+joint distribution the trees were fitted on. Every feature is then
+drawn from the intervals between its split thresholds within those
+bounds. Rows from a server-held dataset (DISTILL_DATA_PATH), if
+configured, are added to the training inputs. Fidelity is measured on
+held-out inputs drawn the same way.
+"""
+import os
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+from app.federated.compiled_forest import CompiledForest
+from app.federated.data_processor import get_feature_names
+
+# Distill at every aggregation unless the request chooses
+DISTILL_ON_AGGREGATE = os.getenv("DISTILL_ON_AGGREGATE", "false").lower() == "true"
+
+# Size of the student forest
+DISTILL_TREES = int(os.getenv("DISTILL_TREES", "32"))
+DISTILL_MAX_DEPTH = int(os.getenv("DISTILL_MAX_DEPTH", "10"))
+
+# Synthetic rows labelled by the ensemble to fit the student
+DISTILL_SAMPLES = int(os.getenv("DISTILL_SAMPLES", "20000"))
+
+# Optional CSV of server-held inputs (training data columns; target ignored)
+DISTILL_DATA_PATH = os.getenv("DISTILL_DATA_PATH")
+
+# Tree walks per synthetic row; later walks respect the bounds of earlier
+# ones, so more walks constrain more features jointly
+SYNTHETIC_WALKS = 4
+
+# Share of inputs held out to measure fidelity
+HOLDOUT_FRACTION = 0.2
+
+# Risk level boundaries, as in app.prediction.determine_risk_level
+RISK_LEVEL_BOUNDS = (0.33, 0.67)
+
+
+def synthesize_inputs(
+    forest: CompiledForest,
+    n_rows: int,
+    rng: np.random.Generator,
+    walks: int = SYNTHETIC_WALKS
+) -> np.ndarray:
+    """
+    Sample inputs shaped like the data the ensemble was trained on
+
+    Each row walks randomly chosen trees from the root, going left with
+    probability node_samples[left] / node_samples[node] unless the bounds
+    from earlier splits rule a branch out, and keeps the bounds the splits
+    on its paths put on each feature. Each feature is then drawn uniformly
+    from the midpoints between its sorted split thresholds (plus one value
+    below the lowest and one above the highest) that fall within the row's
+    bounds.
+
+    Args:
+        forest: Ensemble to sample from
+        n_rows: Number of rows
+        rng: Random generator
+        walks: Trees walked per row
+
+    Returns:
+        Array of shape (n_rows, n_features)
+    """
+    lower = np.full((n_rows, forest.n_features), -np.inf)
+    upper = np.full((n_rows, forest.n_features), np.inf)
+    rows = np.arange(n_rows)
+
+    for _ in range(walks):
+        nodes = forest.tree_roots[rng.integers(0, forest.n_trees, n_rows)].astype(np.int64)
+        for _ in range(forest.max_depth):
+            left, right = forest.children_left[nodes], forest.children_right[nodes]
+            is_split = left != nodes
+            if not is_split.any():
+                break
+
+            feature = forest.feature[nodes]
+            threshold = forest.threshold[nodes].astype(np.float64)
+            samples = np.maximum(forest.node_samples[nodes].astype(np.float64), 1e-12)
+            go_left = rng.random(n_rows) < forest.node_samples[left] / samples
+            # Branches ruled out by earlier walks are not taken
+            go_left |= upper[rows, feature] <= threshold
+            go_left &= lower[rows, feature] < threshold
+
+            # Left means x <= threshold, right means x > threshold
+            bounded = is_split & go_left
+            upper[rows[bounded], feature[bounded]] = np.minimum(
+                upper[rows[bounded], feature[bounded]], threshold[bounded]
+            )
+            bounded = is_split & ~go_left
+            lower[rows[bounded], feature[bounded]] = np.maximum(
+                lower[rows[bounded], feature[bounded]], threshold[bounded]
+            )
+            nodes = np.where(is_split, np.where(go_left, left, right), nodes)
+
+    is_split = forest.children_left != np.arange(forest.n_nodes)
+    split_features = forest.feature[is_split]
+    split_thresholds = forest.threshold[is_split].astype(np.float64)
+
+    X = np.zeros((n_rows, forest.n_features))
+    for feature in range(forest.n_features):
+        cuts = np.unique(split_thresholds[split_features == feature])
+        if len(cuts) == 0:
+            continue
+        points = np.concatenate([
+            [cuts[0] - 1.0], (cuts[:-1] + cuts[1:]) / 2.0, [cuts[-1] + 1.0]
+        ])
+        # Points p with lower < p <= upper; there is always at least one,
+        # since both bounds are cuts
+        first = np.searchsorted(points, lower[:, feature], side='right')
+        count = np.searchsorted(points, upper[:, feature], side='right') - first
+        X[:, feature] = points[first + (rng.random(n_rows) * np.maximum(count, 1)).astype(np.int64)]
+    return X
+
+
+def load_server_inputs(path: Optional[str] = DISTILL_DATA_PATH) -> Optional[np.ndarray]:
+    """
+    Load the feature columns of a server-held CSV
+
+    Args:
+        path: CSV path, None if no server-held data is configured
+
+    Returns:
+        Feature matrix in get_feature_names() order, or None
+    """
+    if not path:
+        return None
+
+    import pandas as pd
+
+    return pd.read_csv(path, usecols=get_feature_names())[get_feature_names()].to_numpy(dtype=float)
+
+
+def _risk_levels(scores: np.ndarray) -> np.ndarray:
+    return np.searchsorted(RISK_LEVEL_BOUNDS, scores, side='right')
+
+
+def fidelity(teacher: CompiledForest, student: CompiledForest, X: np.ndarray) -> dict:
+    """
+    Compare student and ensemble risk scores on the same inputs
+
+    Args:
+        teacher: Ensemble
+        student: Distilled forest
+        X: Inputs not used to fit the student
+
+    Returns:
+        Dictionary with mean/max absolute score error, agreement of the
+        0.5 decision and of the Low/Medium/High risk level
+    """
+    expected = teacher.predict(X)
+    actual = student.predict(X)
+    errors = np.abs(actual - expected)
+    return {
+        'rows': len(X),
+        'mean_abs_error': float(errors.mean()),
+        'p99_abs_error': float(np.percentile(errors, 99)),
+        'max_abs_error': float(errors.max()),
+        'decision_agreement': float(np.mean((actual > 0.5) == (expected > 0.5))),
+        'risk_level_agreement': float(np.mean(_risk_levels(actual) == _risk_levels(expected))),
+    }
+
+
+def distill(
+    teacher: CompiledForest,
+    n_samples: int = DISTILL_SAMPLES,
+    n_trees: int = DISTILL_TREES,
+    max_depth: int = DISTILL_MAX_DEPTH,
+    server_inputs: Optional[np.ndarray] = None,
+    seed: int = 0
+) -> Tuple[CompiledForest, dict]:
+    """
+    Fit a bounded-size student forest to the ensemble's risk scores
+
+    Args:
+        teacher: Compiled global ensemble
+        n_samples: Synthetic rows to label with the ensemble
+        n_trees: Trees of the student
+        max_depth: Maximum depth of the student's trees
+        server_inputs: Optional server-held feature rows added to the
+            synthetic ones
+        seed: Random seed
+
+    Returns:
+        Tuple of (student forest, report with fidelity metrics and sizes)
+    """
+    # Imported here so only aggregation loads sklearn
+    from sklearn.ensemble import RandomForestRegressor
+
+    start = time.perf_counter()
+    rng = np.random.default_rng(seed)
+
+    X = synthesize_inputs(teacher, n_samples, rng)
+    n_holdout = max(1, int(len(X) * HOLDOUT_FRACTION))
+    X_train, X_holdout = X[n_holdout:], X[:n_holdout]
+
+    server_holdout = None
+    if server_inputs is not None and len(server_inputs):
+        server_inputs = server_inputs[rng.permutation(len(server_inputs))]
+        n_server_holdout = max(1, int(len(server_inputs) * HOLDOUT_FRACTION))
+        server_holdout = server_inputs[:n_server_holdout]
+        X_train = np.vstack([X_train, server_inputs[n_server_holdout:]])
+
+    model = RandomForestRegressor(
+        n_estimators=n_trees,
+        max_depth=max_depth,
+        min_samples_leaf=5,
+        random_state=seed,
+        n_jobs=1
+    )
+    model.fit(X_train, teacher.predict(X_train))
+    student = CompiledForest.from_sklearn(model)
+
+    report = {
+        'student_trees': student.n_trees,
+        'student_nodes': student.n_nodes,
+        'teacher_trees': teacher.n_trees,
+        'teacher_nodes': teacher.n_nodes,
+        'training_rows': len(X_train),
+        'synthetic': fidelity(teacher, student, X_holdout),
+    }
+    if server_holdout is not None:
+        report['server_data'] = fidelity(teacher, student, server_holdout)
+    report['seconds'] = time.perf_counter() - start
+    return student, report
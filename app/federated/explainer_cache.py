@@ -0,0 +1,109 @@
+"""
+Per-version cache of SHAP explainers for the global model
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Hashable
+
+import numpy as np
+
+from app.federated.compiled_forest import CompiledForest
+
+if TYPE_CHECKING:
+    import shap
+
+# Number of global model versions whose explainers are kept in memory
+EXPLAINER_CACHE_SIZE = int(os.getenv("EXPLAINER_CACHE_SIZE", "2"))
+
+
+class ExplainerCache:
+    """
+    Bounded LRU cache of TreeExplainers keyed by GlobalModel.version
+
+    The explainer covers every tree of the compiled forest, so its SHAP
+    values are the weighted combination over all ensemble members. A
+    version's distilled student is keyed by (version, "student").
+
+    shap copies the forest into its own arrays, so each cached explainer
+    is private to the worker and several times the size of the forest's
+    shared serving arrays.
+    """
+
+    def __init__(self, max_size: int = EXPLAINER_CACHE_SIZE):
+        self.max_size = max(1, max_size)
+        self._explainers: "OrderedDict[Hashable, shap.TreeExplainer]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, forest: CompiledForest) -> "shap.TreeExplainer":
+        """
+        Get the explainer for a model version, building it on first use
+
+        Args:
+            key: GlobalModel version the forest belongs to, or
+                (version, "student") for its student
+            forest: Compiled forest of that version
+
+        Returns:
+            TreeExplainer for the whole weighted ensemble
+        """
+        with self._lock:
+            explainer = self._explainers.get(key)
+            if explainer is not None:
+                self._explainers.move_to_end(key)
+                self.hits += 1
+                return explainer
+
+            # Built under the lock so concurrent requests for a new version
+            # construct the explainer only once. shap is imported on the
+            # first exact explanation rather than at worker startup.
+            import shap
+
+            self.misses += 1
+            explainer = shap.TreeExplainer(forest.to_shap_model())
+            self._explainers[key] = explainer
+            while len(self._explainers) > self.max_size:
+                self._explainers.popitem(last=False)
+            return explainer
+
+    def shap_values(self, key: Hashable, forest: CompiledForest, features: np.ndarray) -> np.ndarray:
+        """
+        Explain a batch of rows with the cached explainer
+
+        Args:
+            key: GlobalModel version the forest belongs to, or
+                (version, "student") for its student
+            forest: Compiled forest of that version
+            features: 2-D feature matrix
+
+        Returns:
+            Array of shape (n_rows, n_features) with positive class SHAP values
+        """
+        explainer = self.get(key, forest)
+        shap_values = np.asarray(explainer.shap_values(features))
+        return shap_values.reshape(len(features), forest.n_features)
+
+    def stats(self) -> dict:
+        """
+        Get cache counters
+
+        Returns:
+            Dictionary with cached versions, hits, misses and hit rate
+        """
+        with self._lock:
+            versions = list(self._explainers)
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            'versions': versions,
+            'max_size': self.max_size,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else 0.0,
+        }
+
+
+# Shared by all SHAP explanation requests
+explainer_cache = ExplainerCache()
@@ -0,0 +1,146 @@
+"""
+Logistic regression model whose parameters can be averaged across hospitals
+
+Every hospital fits the same model on features scaled with fixed
+reference constants rather than its own statistics, so coefficients mean
+the same thing everywhere and the global model is their sample-weighted
+average: one coefficient per feature, whatever the number of hospitals.
+"""
+import numpy as np
+from typing import Sequence
+
+from app.federated.data_processor import get_feature_names
+
+# Fixed (center, scale) per feature from typical clinical ranges; shared by
+# all hospitals so that their coefficients are comparable
+REFERENCE_SCALING = {
+    'age': (55.0, 10.0), 'sex': (0.5, 0.5), 'cp': (1.0, 1.0), 'trestbps': (130.0, 18.0),
+    'chol': (245.0, 50.0), 'fbs': (0.5, 0.5), 'restecg': (0.5, 0.5), 'thalach': (150.0, 23.0),
+    'exang': (0.5, 0.5), 'oldpeak': (1.0, 1.2), 'slope': (1.0, 0.6), 'ca': (0.7, 1.0),
+    'thal': (2.0, 0.6),
+}
+
+# Inverse regularization strength of the local fits
+LOGISTIC_C = 1.0
+
+
+def _reference_scaling() -> np.ndarray:
+    return np.array([REFERENCE_SCALING[name] for name in get_feature_names()]).T
+
+
+def _sigmoid(z: np.ndarray) -> np.ndarray:
+    return 1.0 / (1.0 + np.exp(-z))
+
+
+class LinearModel:
+    """
+    Logistic regression on reference-scaled features
+
+    ``feature_means`` are the (sample-weighted) means of the training
+    features; they are the baseline of the model's explanations.
+    """
+
+    def __init__(self, coef: np.ndarray, intercept: float, feature_means: np.ndarray):
+        self.coef = np.asarray(coef, dtype=np.float64)
+        self.intercept = float(intercept)
+        self.feature_means = np.asarray(feature_means, dtype=np.float64)
+
+    @property
+    def n_features(self) -> int:
+        return len(self.coef)
+
+    @classmethod
+    def fit(cls, X: np.ndarray, y: np.ndarray) -> 'LinearModel':
+        """
+        Fit on one hospital's training data
+
+        Args:
+            X: Feature matrix in get_feature_names() column order
+            y: Binary 0/1 target
+
+        Returns:
+            Fitted LinearModel
+        """
+        feature_means = X.mean(axis=0, dtype=np.float64)
+        positive_rate = float(np.mean(y))
+        if positive_rate in (0.0, 1.0):
+            # One class only: predict its (clipped) rate everywhere
+            rate = min(max(positive_rate, 1e-3), 1 - 1e-3)
+            return cls(np.zeros(X.shape[1]), np.log(rate / (1 - rate)), feature_means)
+
+        # Imported here so only training processes load sklearn
+        from sklearn.linear_model import LogisticRegression
+
+        center, scale = _reference_scaling()
+        model = LogisticRegression(C=LOGISTIC_C, max_iter=1000)
+        model.fit((X - center) / scale, y)
+        return cls(model.coef_[0], model.intercept_[0], feature_means)
+
+    @classmethod
+    def average(cls, models: Sequence['LinearModel'], weights: Sequence[float]) -> 'LinearModel':
+        """
+        Weighted average of the parameters of several models
+
+        Args:
+            models: Models fitted with the same reference scaling
+            weights: Weight per model, summing to one
+
+        Returns:
+            Averaged LinearModel
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        return cls(
+            np.average([model.coef for model in models], axis=0, weights=weights),
+            float(np.average([model.intercept for model in models], weights=weights)),
+            np.average([model.feature_means for model in models], axis=0, weights=weights)
+        )
+
+    def decision_function(self, X: np.ndarray) -> np.ndarray:
+        center, scale = _reference_scaling()
+        return ((np.asarray(X, dtype=np.float64) - center) / scale) @ self.coef + self.intercept
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        """Positive class probability per row"""
+        return _sigmoid(self.decision_function(X))
+
+    def contributions(self, X: np.ndarray) -> np.ndarray:
+        """
+        Per-feature contributions to each row's risk score
+
+        In log-odds, coef * (x - mean) are the exact SHAP values of a
+        linear model. They are rescaled so that each row's contributions
+        sum to its risk score minus the score at the feature means, the
+        same property as the forest's explanations.
+
+        Args:
+            X: 2-D feature matrix
+
+        Returns:
+            Array of shape (n_rows, n_features)
+        """
+        _, scale = _reference_scaling()
+        log_odds = (np.asarray(X, dtype=np.float64) - self.feature_means) / scale * self.coef
+        margin = self.decision_function(X)
+        base_margin = self.decision_function(self.feature_means[np.newaxis, :])[0]
+        delta = margin - base_margin
+        probability_delta = _sigmoid(margin) - _sigmoid(base_margin)
+        # Slope of the sigmoid between the baseline and the row
+        ratio = np.divide(
+            probability_delta, delta,
+            out=_sigmoid(margin) * (1 - _sigmoid(margin)),
+            where=np.abs(delta) > 1e-12
+        )
+        return log_odds * ratio[:, np.newaxis]
+
+    def to_dict(self) -> dict:
+        """JSON-serializable parameters"""
+        return {
+            'coef': self.coef.tolist(),
+            'intercept': self.intercept,
+            'feature_means': self.feature_means.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, params: dict) -> 'LinearModel':
+        return cls(params['coef'], params['intercept'], params['feature_means'])
+
@@ -1,20 +1,29 @@
 """
 Local model training for federated learning
 """
-import pandas as pd
-from sklearn.ensemble import RandomForestClassifier
+import numpy as np
 from fastapi import HTTPException
-from typing import Tuple
+from typing import Optional, Tuple
 
-from app.federated.data_processor import validate_and_parse_csv
+from app.federated.data_processor import validate_and_parse_csv, get_feature_names
+from app.federated.linear_model import LinearModel
+from app.federated.compiled_forest import CompiledForest
 
+# Trees of a local forest, also kept by incremental updates
+N_ESTIMATORS = 100
 
-def train_local_model(csv_data: str) -> Tuple[dict, int]:
+
+def fit_local_model(X: np.ndarray, y: np.ndarray, n_jobs: int = -1) -> Tuple[dict, int]:
     """
-    Train a local Random Forest model on hospital's CSV data
+    Train a local Random Forest model on already parsed training arrays
+    
+    A logistic regression is fitted alongside, so the contribution can
+    also take part in parameter-averaging aggregation.
     
     Args:
-        csv_data: CSV content as string
+        X: Feature matrix in get_feature_names() column order
+        y: Target vector
+        n_jobs: Number of cores used to fit the trees (-1 for all)
         
     Returns:
         Tuple of (model_weights_dict, num_samples)
@@ -22,17 +31,18 @@ def train_local_model(csv_data: str) -> Tuple[dict, int]:
     Raises:
         HTTPException: If training fails
     """
+    # Imported here so only training processes load sklearn
+    from sklearn.ensemble import RandomForestClassifier
+    
     try:
-        # Validate and parse CSV data
-        X, y = validate_and_parse_csv(csv_data)
         num_samples = len(X)
         
         # Train model
         model = RandomForestClassifier(
-            n_estimators=100,
+            n_estimators=N_ESTIMATORS,
             max_depth=10,
             random_state=42,
-            n_jobs=-1
+            n_jobs=n_jobs
         )
         model.fit(X, y)
         
@@ -40,19 +50,130 @@ def train_local_model(csv_data: str) -> Tuple[dict, int]:
         # For Random Forest, we store the entire model as weights
         model_weights = {
             'model': model,
-            'feature_names': list(X.columns),
+            # Parametric model for the parameter averaging strategy
+            'linear_model': LinearModel.fit(X, y),
+            'feature_names': get_feature_names(),
             'n_samples': num_samples
         }
         
         return model_weights, num_samples
         
-    except ValueError as e:
+    except Exception as e:
         raise HTTPException(
             status_code=400,
-            detail=f"Data validation error: {str(e)}"
+            detail=f"Error training model: {str(e)}"
+        )
+
+
+def fit_incremental_model(
+    X: np.ndarray,
+    y: np.ndarray,
+    base_forest: CompiledForest,
+    base_samples: int,
+    base_linear: Optional[LinearModel] = None,
+    n_jobs: int = -1
+) -> Tuple[dict, int]:
+    """
+    Update a hospital's previous forest with newly collected rows only
+    
+    New trees are grown on the new rows, as many as their share of all
+    the hospital's samples (at least one), and the oldest trees beyond
+    N_ESTIMATORS are retired. All trees are weighted equally, so the new
+    rows count about as much as their share. Training time depends on the
+    new rows, not on the hospital's history. The logistic regression is
+    fitted on the new rows and averaged with the previous one by sample
+    count.
+    
+    Args:
+        X: Feature matrix of the new rows in get_feature_names() column order
+        y: Target vector of the new rows
+        base_forest: Compiled forest of the hospital's previous contribution,
+            its trees oldest first and equally weighted
+        base_samples: Samples the previous contribution was trained on
+        base_linear: Logistic regression of the previous contribution, if any
+        n_jobs: Number of cores used to fit the trees (-1 for all)
+        
+    Returns:
+        Tuple of (model_weights_dict with the compiled 'forest', cumulative
+        num_samples)
+        
+    Raises:
+        HTTPException: If training fails
+    """
+    # Imported here so only training processes load sklearn
+    from sklearn.ensemble import RandomForestClassifier
+    
+    try:
+        num_new = len(X)
+        num_samples = base_samples + num_new
+        new_trees = min(N_ESTIMATORS, max(1, round(N_ESTIMATORS * num_new / num_samples)))
+        kept_trees = min(base_forest.n_trees, N_ESTIMATORS - new_trees)
+        
+        model = RandomForestClassifier(
+            n_estimators=new_trees,
+            max_depth=10,
+            random_state=42,
+            n_jobs=n_jobs
         )
+        model.fit(X, y)
+        
+        # Every tree ends up with the same weight; the newest trees are last
+        total_trees = kept_trees + new_trees
+        retained = base_forest.select_trees(
+            np.arange(base_forest.n_trees - kept_trees, base_forest.n_trees),
+            np.full(kept_trees, base_forest.n_trees / total_trees)
+        )
+        forest = CompiledForest.concatenate([
+            retained,
+            CompiledForest.from_sklearn(model, weight=new_trees / total_trees)
+        ])
+        
+        linear_model = LinearModel.fit(X, y)
+        if base_linear is not None:
+            linear_model = LinearModel.average(
+                [base_linear, linear_model],
+                [base_samples / num_samples, num_new / num_samples]
+            )
+        
+        model_weights = {
+            'forest': forest,
+            'linear_model': linear_model,
+            'feature_names': get_feature_names(),
+            'n_samples': num_samples,
+            'new_trees': new_trees,
+            'retired_trees': base_forest.n_trees - kept_trees
+        }
+        
+        return model_weights, num_samples
+        
     except Exception as e:
         raise HTTPException(
             status_code=400,
             detail=f"Error training model: {str(e)}"
         )
+
+
+def train_local_model(csv_data: str, n_jobs: int = -1) -> Tuple[dict, int]:
+    """
+    Train a local Random Forest model on hospital's CSV data
+    
+    Args:
+        csv_data: CSV content as string
+        n_jobs: Number of cores used to fit the trees (-1 for all)
+        
+    Returns:
+        Tuple of (model_weights_dict, num_samples)
+        
+    Raises:
+        HTTPException: If training fails
+    """
+    try:
+        # Validate and parse CSV data
+        X, y = validate_and_parse_csv(csv_data)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Data validation error: {str(e)}"
+        )
+    
+    return fit_local_model(X, y, n_jobs=n_jobs)
@@ -0,0 +1,248 @@
+"""
+Versioned in-process cache of the deserialized global model
+"""
+import pickle
+import threading
+from sqlalchemy.orm import Session
+from fastapi import HTTPException
+from typing import Optional, Tuple
+
+from app.models import GlobalModel
+from app.federated.compiled_forest import CompiledForest, compile_ensemble
+from app.federated.artifact_store import artifact_store, load_serving_forest, load_linear_model
+from app.metrics import latency_tracker
+
+
+class ModelCache:
+    """
+    Cache of the loaded aggregated model keyed by GlobalModel.version
+
+    Each lookup runs a single query on the version column. The model is
+    only loaded from the artifact store (or, for legacy rows, the
+    model_data blob) when a newer version appears.
+
+    While the background model manager runs, request handlers use
+    get_current instead: the manager loads new versions off the request
+    path and publishes them here, so lookups need no query at all.
+    """
+
+    def __init__(self):
+        # (version, aggregated_data) swapped as one tuple so readers never
+        # see a version paired with another version's data
+        self._entry: Optional[Tuple[int, dict]] = None
+        self._load_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        # Set while the model manager keeps the entry current
+        self.managed = False
+        self.hits = 0
+        self.misses = 0
+
+    def get_latest(self, db: Session) -> Tuple[int, dict]:
+        """
+        Get the latest global model, loading it only on a version change
+
+        Args:
+            db: Database session
+
+        Returns:
+            Tuple of (version, aggregated model data)
+
+        Raises:
+            HTTPException: If no global model is available
+        """
+        with latency_tracker.time("model_version_check"):
+            latest_version = (
+                db.query(GlobalModel.version)
+                .order_by(GlobalModel.version.desc())
+                .limit(1)
+                .scalar()
+            )
+
+        if latest_version is None:
+            raise HTTPException(
+                status_code=404,
+                detail="No global model available. Please train and aggregate models first."
+            )
+
+        entry = self._entry
+        if entry is not None and entry[0] == latest_version:
+            self._count(hit=True)
+            return entry
+
+        # Only one request deserializes a new version; the others wait and
+        # then find it already cached
+        with self._load_lock:
+            entry = self._entry
+            if entry is not None and entry[0] == latest_version:
+                self._count(hit=True)
+                return entry
+
+            self._count(hit=False)
+            entry = self.load(db, latest_version)
+            self._entry = entry
+            return entry
+
+    def get_current(self, db: Session) -> Tuple[int, dict]:
+        """
+        Get the model to serve a request with
+
+        Returns the entry published by the model manager without touching
+        the database; falls back to get_latest when no manager runs or it
+        has not published a model yet.
+
+        Args:
+            db: Database session
+
+        Returns:
+            Tuple of (version, aggregated model data)
+
+        Raises:
+            HTTPException: If no global model is available
+        """
+        entry = self._entry
+        if self.managed and entry is not None:
+            self._count(hit=True)
+            return entry
+        return self.get_latest(db)
+
+    @property
+    def version(self) -> Optional[int]:
+        """Version of the cached model, None if nothing is cached"""
+        entry = self._entry
+        return entry[0] if entry is not None else None
+
+    def load(self, db: Session, version: int) -> Tuple[int, dict]:
+        """
+        Load a global model version without caching it
+
+        Args:
+            db: Database session
+            version: GlobalModel version
+
+        Returns:
+            Tuple of (version, aggregated model data)
+        """
+        with latency_tracker.time("model_load"):
+            row = (
+                db.query(GlobalModel.artifact_hash, GlobalModel.student_artifact_hash,
+                         GlobalModel.model_data)
+                .filter(GlobalModel.version == version)
+                .first()
+            )
+            return version, load_global_model(
+                row.artifact_hash, row.model_data, row.student_artifact_hash
+            )
+
+    def publish(self, entry: Tuple[int, dict]) -> bool:
+        """
+        Swap in a loaded model unless a newer one is already cached
+
+        Requests that already took the previous entry finish with it.
+
+        Args:
+            entry: Tuple of (version, aggregated model data) from load
+
+        Returns:
+            True if the entry was swapped in
+        """
+        with self._load_lock:
+            current = self._entry
+            if current is not None and current[0] >= entry[0]:
+                return False
+            self._entry = entry
+            return True
+
+    def clear(self) -> None:
+        """Drop the cached model so the next lookup reloads it"""
+        with self._load_lock:
+            self._entry = None
+
+    def stats(self) -> dict:
+        """
+        Get cache counters
+
+        Returns:
+            Dictionary with cached version, hits, misses and hit rate
+        """
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        entry = self._entry
+        return {
+            'version': entry[0] if entry is not None else None,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else 0.0,
+        }
+
+    def _count(self, hit: bool) -> None:
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+def load_global_model(
+    artifact_hash: Optional[str],
+    model_data: Optional[bytes],
+    student_artifact_hash: Optional[str] = None
+) -> dict:
+    """
+    Load a global model version from the artifact store or a legacy blob
+
+    Args:
+        artifact_hash: GlobalModel.artifact_hash, None for legacy rows
+        model_data: GlobalModel.model_data, only used for legacy rows
+        student_artifact_hash: GlobalModel.student_artifact_hash, if the
+            version has a distilled student
+
+    Returns:
+        Aggregated model data (manifest) with a CompiledForest under
+        'forest' (or, for parameter-averaged versions, a LinearModel under
+        'linear'), and under 'student' either None or a dictionary with
+        the student's CompiledForest under 'forest'
+    """
+    if artifact_hash is None:
+        aggregated_data = load_aggregated_model(model_data)
+    elif artifact_store.metadata(artifact_hash).get('kind') == 'linear_model':
+        linear, manifest = load_linear_model(artifact_hash)
+        aggregated_data = dict(manifest)
+        aggregated_data['linear'] = linear
+    else:
+        forest, manifest = load_serving_forest(artifact_hash)
+        aggregated_data = dict(manifest)
+        aggregated_data['forest'] = forest
+
+    # Shaped like aggregated data, so it is scored and explained the same way
+    aggregated_data['student'] = None
+    if student_artifact_hash is not None:
+        aggregated_data['student'] = {'forest': load_serving_forest(student_artifact_hash)[0]}
+    return aggregated_data
+
+
+def load_aggregated_model(model_data: bytes) -> dict:
+    """
+    Deserialize a GlobalModel blob and attach its compiled forest
+
+    Versions aggregated before forests were compiled at aggregation time
+    are compiled here once, when they are loaded.
+
+    Args:
+        model_data: Pickled aggregated model
+
+    Returns:
+        Aggregated model data with a CompiledForest under 'forest'
+    """
+    aggregated_data = pickle.loads(model_data)
+    if 'forest' in aggregated_data:
+        aggregated_data['forest'] = CompiledForest.from_arrays(aggregated_data['forest'])
+    else:
+        aggregated_data['forest'] = compile_ensemble(
+            aggregated_data['models'], aggregated_data['weights']
+        )
+    return aggregated_data
+
+
+# Shared by the predictor and the SHAP explanation path
+model_cache = ModelCache()
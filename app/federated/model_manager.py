@@ -0,0 +1,170 @@
+"""
+Background loading and hot swap of new global model versions
+
+Without the manager, the first /predict after an aggregation loads the new
+version inline, so every worker pays a latency spike. The manager checks
+the latest GlobalModel.version on a short interval (one indexed query),
+loads a new version on its own thread, maps its compiled forest (and,
+with MODEL_PRELOAD_EXPLAINER, builds its SHAP explainer), and only then
+publishes it to the model cache. Requests already running keep the entry
+they took and finish on the old version.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+
+from app.database import SessionLocal
+from app.models import GlobalModel
+from app.federated.model_cache import model_cache
+from app.federated.explainer_cache import explainer_cache
+from app.federated.data_processor import get_feature_names
+from app.federated.predictor import predict_batch_with_aggregated_model
+from app.metrics import latency_tracker
+
+# Seconds between version checks; 0 disables the manager, and requests
+# then check the version and load new models themselves
+MODEL_REFRESH_INTERVAL_SECONDS = float(os.getenv("MODEL_REFRESH_INTERVAL_SECONDS", "2"))
+
+# Build the SHAP explainer of a new version before swapping it in. Off by
+# default: the explainer is a private copy of the whole forest in every
+# worker, several times the size of the shared serving arrays, so it is
+# only built once a worker serves an exact explanation
+MODEL_PRELOAD_EXPLAINER = os.getenv("MODEL_PRELOAD_EXPLAINER", "false").lower() == "true"
+
+
+class ModelManager:
+    """
+    Keeps the model cache on the latest global version from a daemon thread
+    """
+
+    def __init__(
+        self,
+        interval_seconds: float = MODEL_REFRESH_INTERVAL_SECONDS,
+        preload_explainer: bool = MODEL_PRELOAD_EXPLAINER
+    ):
+        self.interval_seconds = interval_seconds
+        self.preload_explainer = preload_explainer
+        self._thread: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.swaps = 0
+        self.last_checked_at: Optional[datetime] = None
+        self.last_swapped_at: Optional[datetime] = None
+        self.last_prepare_seconds: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        thread = self._thread
+        return thread is not None and thread.is_alive()
+
+    def start(self) -> bool:
+        """
+        Start the manager thread unless it runs already or is disabled
+
+        Returns:
+            True if the thread was started
+        """
+        with self._lock:
+            if self.interval_seconds <= 0 or self.running:
+                return False
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="model-manager", daemon=True)
+            self._thread.start()
+            model_cache.managed = True
+            return True
+
+    def stop(self) -> None:
+        """Stop the manager thread; requests go back to checking versions"""
+        with self._lock:
+            model_cache.managed = False
+            thread = self._thread
+            self._stop.set()
+            self._wake.set()
+        if thread is not None:
+            thread.join()
+
+    def refresh(self) -> None:
+        """Check for a new version now instead of at the next interval"""
+        self._wake.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.check()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+            self._wake.wait(self.interval_seconds)
+            self._wake.clear()
+
+    def check(self) -> bool:
+        """
+        Load, prepare and publish the latest version if it is new
+
+        Returns:
+            True if a new version was swapped in
+        """
+        db = SessionLocal()
+        try:
+            latest_version = (
+                db.query(GlobalModel.version)
+                .order_by(GlobalModel.version.desc())
+                .limit(1)
+                .scalar()
+            )
+            self.last_checked_at = datetime.utcnow()
+            current_version = model_cache.version
+            if latest_version is None or (current_version is not None and latest_version <= current_version):
+                return False
+
+            start = time.perf_counter()
+            entry = model_cache.load(db, latest_version)
+        finally:
+            db.close()
+
+        self._prepare(*entry)
+        if not model_cache.publish(entry):
+            return False
+
+        self.last_prepare_seconds = time.perf_counter() - start
+        latency_tracker.record("model_prepare", self.last_prepare_seconds)
+        self.last_swapped_at = datetime.utcnow()
+        self.swaps += 1
+        return True
+
+    def _prepare(self, version: int, aggregated_data: dict) -> None:
+        # Touch the forest arrays once and, if enabled, build the explainers,
+        # so the first request on the new version does no setup work
+        served = [(version, aggregated_data)]
+        if aggregated_data.get('student') is not None:
+            served.append(((version, "student"), aggregated_data['student']))
+
+        for explainer_key, model_data in served:
+            predict_batch_with_aggregated_model(model_data, np.zeros((1, len(get_feature_names()))))
+            # Linear models are explained without an explainer
+            if self.preload_explainer and 'forest' in model_data:
+                explainer_cache.get(explainer_key, model_data['forest'])
+
+    def status(self) -> dict:
+        return {
+            'running': self.running,
+            'interval_seconds': self.interval_seconds,
+            'version': model_cache.version,
+            'swaps': self.swaps,
+            'last_checked_at': self.last_checked_at,
+            'last_swapped_at': self.last_swapped_at,
+            'last_prepare_ms': (
+                self.last_prepare_seconds * 1000.0 if self.last_prepare_seconds is not None else None
+            ),
+            'last_error': self.last_error,
+        }
+
+
+# Started by the app at startup; one per worker process
+model_manager = ModelManager()
@@ -1,13 +1,62 @@
 """
 Global model prediction logic
 """
-import pickle
 import numpy as np
 from sqlalchemy.orm import Session
-from fastapi import HTTPException
 from typing import Tuple
 
-from app.models import GlobalModel
+from app.federated.model_cache import model_cache
+
+
+def predict_batch_with_aggregated_model(
+    aggregated_data: dict,
+    features: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Make predictions for many rows using an already loaded aggregated model
+    
+    All trees of all ensemble members are scored for the whole feature
+    matrix in one pass over the compiled forest, with the aggregation
+    weights already folded into the leaf values. Parameter-averaged
+    versions are scored by their averaged linear model instead.
+    
+    Args:
+        aggregated_data: Aggregated model data from the model cache
+        features: 2-D feature matrix, one row per patient
+        
+    Returns:
+        Tuple of (positive class probabilities, predictions), one per row
+    """
+    linear = aggregated_data.get('linear')
+    if linear is not None:
+        probabilities = linear.predict(features)
+    else:
+        # Weighted ensemble probability of the positive class
+        probabilities = aggregated_data['forest'].predict(features)
+    
+    # Weights sum to one (under a tree budget, in expectation), so the
+    # negative class gets the remainder; ties go to class 0 as with argmax
+    predictions = (probabilities > 1.0 - probabilities).astype(int)
+    
+    return probabilities, predictions
+
+
+def predict_with_aggregated_model(aggregated_data: dict, features: np.ndarray) -> Tuple[float, int]:
+    """
+    Make prediction using an already loaded aggregated model
+    
+    Args:
+        aggregated_data: Aggregated model data from the model cache
+        features: Feature array for prediction
+        
+    Returns:
+        Tuple of (probability, prediction)
+    """
+    probabilities, predictions = predict_batch_with_aggregated_model(
+        aggregated_data, features.reshape(1, -1)
+    )
+    
+    return float(probabilities[0]), int(predictions[0])
 
 
 def predict_with_global_model(db: Session, features: np.ndarray) -> Tuple[float, int]:
@@ -24,31 +73,7 @@ def predict_with_global_model(db: Session, features: np.ndarray) -> Tuple[float,
     Raises:
         HTTPException: If no global model is available
     """
-    # Get latest global model
-    global_model = db.query(GlobalModel).order_by(GlobalModel.version.desc()).first()
-    
-    if not global_model:
-        raise HTTPException(
-            status_code=404,
-            detail="No global model available. Please train and aggregate models first."
-        )
-    
-    # Load aggregated model
-    aggregated_data = pickle.loads(global_model.model_data)
-    models = aggregated_data['models']
-    weights = aggregated_data['weights']
-    
-    # Weighted ensemble prediction
-    weighted_probs = []
-    for model, weight in zip(models, weights):
-        prob = model.predict_proba(features.reshape(1, -1))[0]
-        weighted_probs.append(prob * weight)
-    
-    # Sum weighted probabilities
-    final_prob = np.sum(weighted_probs, axis=0)
-    
-    # Get prediction and probability for positive class
-    prediction = np.argmax(final_prob)
-    probability = final_prob[1] if len(final_prob) > 1 else final_prob[0]
-    
-    return float(probability), int(prediction)
+    # Get the served global model (deserialized only when the version changes)
+    _, aggregated_data = model_cache.get_current(db)
+    
+    return predict_with_aggregated_model(aggregated_data, features)
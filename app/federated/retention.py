@@ -0,0 +1,271 @@
+"""
+Retention, compaction and garbage collection of stored models
+
+Every aggregation adds a global version. Compaction keeps the newest
+GLOBAL_MODEL_KEEP_LAST versions plus every pinned one; older versions lose
+their model artifact and legacy blob, but their metadata rows (version,
+num_contributions, created_at) stay. Artifacts that no row references any
+more are then deleted from the artifact store.
+
+The serving version is always among the kept ones, and processes that
+already mapped an artifact keep their mapping after the files are removed,
+so compaction never interrupts prediction.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional, Set
+
+from sqlalchemy import func, update
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal
+from app.models import ModelContribution, GlobalModel
+from app.federated.artifact_store import SERVING_SUFFIX, artifact_store
+
+# Number of newest global versions that keep their model
+GLOBAL_MODEL_KEEP_LAST = int(os.getenv("GLOBAL_MODEL_KEEP_LAST", "5"))
+
+# Unreferenced artifacts younger than this are kept; a training job or an
+# aggregation may have stored them and not yet committed the row that
+# references them
+ARTIFACT_GC_GRACE_SECONDS = int(os.getenv("ARTIFACT_GC_GRACE_SECONDS", "3600"))
+
+# Run compaction in the background after every aggregation
+AUTO_COMPACT = os.getenv("AUTO_COMPACT", "false").lower() == "true"
+
+
+def retained_versions(db: Session, keep_last: int = GLOBAL_MODEL_KEEP_LAST) -> Set[int]:
+    """
+    Get the global versions whose model is kept
+
+    Args:
+        db: Database session
+        keep_last: Number of newest versions to keep
+
+    Returns:
+        Set of versions: the newest keep_last (at least one) plus pinned ones
+    """
+    newest = (
+        db.query(GlobalModel.version)
+        .order_by(GlobalModel.version.desc())
+        .limit(max(1, keep_last))
+    )
+    pinned = db.query(GlobalModel.version).filter(GlobalModel.pinned.is_(True))
+    return {version for (version,) in newest} | {version for (version,) in pinned}
+
+
+def _referenced_artifacts(db: Session) -> Set[str]:
+    """
+    Artifact hashes referenced by any contribution or global version, or by
+    the manifest of a global ensemble version
+    """
+    referenced = set()
+    for column in (ModelContribution.artifact_hash, GlobalModel.artifact_hash,
+                   GlobalModel.student_artifact_hash):
+        referenced.update(
+            artifact_hash for (artifact_hash,) in
+            db.query(column).filter(column.isnot(None)).distinct()
+        )
+
+    # Ensemble versions are assembled from their members when loaded
+    for (artifact_hash,) in db.query(GlobalModel.artifact_hash).filter(
+        GlobalModel.artifact_hash.isnot(None)
+    ).distinct():
+        if not artifact_store.exists(artifact_hash):
+            continue
+        metadata = artifact_store.metadata(artifact_hash)
+        if metadata.get('kind') == 'ensemble':
+            referenced.update(member['artifact_hash'] for member in metadata['members'])
+    return referenced
+
+
+def collect_garbage(db: Session, grace_seconds: int = ARTIFACT_GC_GRACE_SECONDS) -> dict:
+    """
+    Delete artifacts that no database row references
+
+    Args:
+        db: Database session
+        grace_seconds: Minimum age of an artifact before it may be deleted
+
+    Returns:
+        Dictionary with the number of artifacts and bytes deleted
+    """
+    referenced = _referenced_artifacts(db)
+    cutoff = time.time() - grace_seconds
+    deleted, freed_bytes = 0, 0
+
+    for artifact_hash in artifact_store.list():
+        if artifact_hash in referenced:
+            continue
+        if os.path.getmtime(artifact_store.path(artifact_hash)) > cutoff:
+            continue
+        freed_bytes += artifact_store.size(artifact_hash)
+        artifact_store.delete(artifact_hash)
+        deleted += 1
+
+    return {'artifacts_deleted': deleted, 'bytes_freed': freed_bytes}
+
+
+def compact_global_models(db: Session, keep_last: int = GLOBAL_MODEL_KEEP_LAST) -> dict:
+    """
+    Drop the models of superseded global versions and collect garbage
+
+    Versions outside the retention policy keep their metadata row with
+    artifact_hash and model_data cleared. Legacy pickled contribution
+    weights that have been compiled into the artifact store are cleared
+    as well.
+
+    Args:
+        db: Database session
+        keep_last: Number of newest versions to keep
+
+    Returns:
+        Dictionary describing what was compacted and deleted
+    """
+    keep = retained_versions(db, keep_last)
+
+    superseded = [
+        version for (version,) in
+        db.query(GlobalModel.version).filter(
+            GlobalModel.version.notin_(keep),
+            GlobalModel.compacted_at.is_(None)
+        )
+    ]
+    if superseded:
+        db.execute(
+            update(GlobalModel)
+            .where(GlobalModel.version.in_(superseded))
+            .values(artifact_hash=None, student_artifact_hash=None, model_data=None,
+                    compacted_at=datetime.utcnow())
+        )
+
+    legacy_contributions = db.execute(
+        update(ModelContribution)
+        .where(ModelContribution.artifact_hash.isnot(None), ModelContribution.model_weights.isnot(None))
+        .values(model_weights=None)
+    ).rowcount
+    db.commit()
+
+    return {
+        'kept_versions': sorted(keep),
+        'compacted_versions': sorted(superseded),
+        'legacy_contributions_cleared': legacy_contributions,
+        **collect_garbage(db),
+    }
+
+
+def storage_report(db: Session) -> List[dict]:
+    """
+    Report the storage used by every global version
+
+    Artifacts are deduplicated, so several versions may report the same
+    artifact; shared_with counts the other versions that reference it. An
+    ensemble version's artifact is its manifest; serving_bytes is the
+    ensemble assembled from its members on this host, if it was loaded.
+
+    Args:
+        db: Database session
+
+    Returns:
+        List of per-version dictionaries, newest first
+    """
+    rows = (
+        db.query(
+            GlobalModel.version,
+            GlobalModel.num_contributions,
+            GlobalModel.created_at,
+            GlobalModel.pinned,
+            GlobalModel.compacted_at,
+            GlobalModel.artifact_hash,
+            GlobalModel.student_artifact_hash,
+            func.coalesce(func.length(GlobalModel.model_data), 0)
+        )
+        .order_by(GlobalModel.version.desc())
+        .all()
+    )
+
+    references = {}
+    for row in rows:
+        if row.artifact_hash is not None:
+            references[row.artifact_hash] = references.get(row.artifact_hash, 0) + 1
+
+    report = []
+    for (version, num_contributions, created_at, pinned,
+         compacted_at, artifact_hash, student_artifact_hash, blob_bytes) in rows:
+        report.append({
+            'version': version,
+            'num_contributions': num_contributions,
+            'created_at': created_at,
+            'pinned': bool(pinned),
+            'compacted_at': compacted_at,
+            'artifact_hash': artifact_hash,
+            'artifact_bytes': artifact_store.size(artifact_hash) if artifact_hash else 0,
+            'shared_with': references[artifact_hash] - 1 if artifact_hash else 0,
+            'serving_bytes': artifact_store.size(artifact_hash, SERVING_SUFFIX) if artifact_hash else 0,
+            'student_bytes': artifact_store.size(student_artifact_hash) if student_artifact_hash else 0,
+            'legacy_blob_bytes': int(blob_bytes),
+        })
+    return report
+
+
+class CompactionRunner:
+    """
+    Runs compaction on a background thread, one run at a time
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.last_result: Optional[dict] = None
+        self.last_error: Optional[str] = None
+        self.last_finished_at: Optional[datetime] = None
+
+    @property
+    def running(self) -> bool:
+        thread = self._thread
+        return thread is not None and thread.is_alive()
+
+    def start(self, keep_last: int = GLOBAL_MODEL_KEEP_LAST) -> bool:
+        """
+        Start a compaction run unless one is already running
+
+        Args:
+            keep_last: Number of newest versions to keep
+
+        Returns:
+            True if a run was started
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self._thread = threading.Thread(
+                target=self._run, args=(keep_last,), name="model-compaction", daemon=True
+            )
+            self._thread.start()
+            return True
+
+    def _run(self, keep_last: int) -> None:
+        db = SessionLocal()
+        try:
+            self.last_result = compact_global_models(db, keep_last)
+            self.last_error = None
+        except Exception as e:
+            db.rollback()
+            self.last_error = str(e)
+        finally:
+            db.close()
+            self.last_finished_at = datetime.utcnow()
+
+    def status(self) -> dict:
+        return {
+            'running': self.running,
+            'last_finished_at': self.last_finished_at,
+            'last_result': self.last_result,
+            'last_error': self.last_error,
+        }
+
+
+# Shared by the admin endpoints and the aggregation endpoint
+compaction_runner = CompactionRunner()
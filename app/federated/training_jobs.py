@@ -0,0 +1,371 @@
+"""
+Background local training in a bounded process pool
+
+Training a forest is CPU bound and used to run on the event loop thread,
+stalling every other request on the worker. Jobs are now submitted to a
+process pool; each stores its compiled forest in the artifact store and
+a ModelContribution row referencing it is written when the job finishes.
+
+An incremental job updates the hospital's latest contribution with the
+uploaded rows only (see fit_incremental_model); its contribution records
+the one it supersedes, and aggregation drops the superseded one. A
+hospital's incremental jobs run one after another, each choosing its base
+when it starts, so overlapping uploads build on each other. If the base
+is no longer the hospital's newest contribution when the job finishes
+(another upload, possibly on another worker, landed first), the job is
+trained again on the newer base.
+"""
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from fastapi import HTTPException
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from app.database import SessionLocal
+from app.models import ModelContribution
+from app.schemas import ModelContributionResponse
+from app.federated.artifact_store import save_forest, load_forest
+from app.federated.compiled_forest import CompiledForest
+from app.metrics import latency_tracker
+
+# Number of training processes; keep below the core count so serving is not starved
+TRAINING_POOL_SIZE = int(os.getenv("TRAINING_POOL_SIZE", "1"))
+
+# Cores each training job may use (RandomForestClassifier n_jobs)
+TRAINING_JOB_CORES = int(os.getenv("TRAINING_JOB_CORES", "1"))
+
+# Train repeat uploads incrementally when the request does not choose
+INCREMENTAL_TRAINING = os.getenv("INCREMENTAL_TRAINING", "false").lower() == "true"
+
+# Finished jobs kept for status queries before the oldest are forgotten
+MAX_TRACKED_JOBS = 1000
+
+# Times an incremental job is trained again after losing its base
+MAX_REBASES = 3
+
+
+class TrainingJobError(Exception):
+    """Raised in the worker process when training fails"""
+
+
+class StaleBaseError(Exception):
+    """Raised when an incremental job's base is no longer the newest contribution"""
+
+
+class TrainingJob:
+    """
+    Status and timings of one training job
+    """
+
+    def __init__(self, doctor_id: int, hospital_name: str, incremental: bool = False):
+        self.id = uuid.uuid4().hex
+        self.doctor_id = doctor_id
+        self.hospital_name = hospital_name
+        self.incremental = incremental
+        # Set when an incremental job starts on the hospital's newest contribution
+        self.supersedes_id: Optional[int] = None
+        self.rebases = 0
+        self.status = "queued"
+        self.submitted_at = datetime.utcnow()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.train_seconds: Optional[float] = None
+        self.error: Optional[str] = None
+        self.contribution: Optional[ModelContributionResponse] = None
+        self.future: Optional[Future] = None
+
+    @property
+    def queue_seconds(self) -> Optional[float]:
+        if self.started_at is None:
+            return None
+        return (self.started_at - self.submitted_at).total_seconds()
+
+
+def latest_contribution(hospital_name: str) -> Optional[Tuple[int, str]]:
+    """
+    Find the contribution an incremental upload of a hospital builds on
+
+    Args:
+        hospital_name: Hospital of the uploading doctor
+
+    Returns:
+        Tuple of (contribution id, artifact hash) of the hospital's newest
+        compiled contribution, or None if it has none
+    """
+    db = SessionLocal()
+    try:
+        return (
+            db.query(ModelContribution.id, ModelContribution.artifact_hash)
+            .filter(
+                ModelContribution.hospital_name == hospital_name,
+                ModelContribution.artifact_hash.isnot(None)
+            )
+            .order_by(ModelContribution.id.desc())
+            .first()
+        )
+    finally:
+        db.close()
+
+
+def _train_in_worker(
+    X: np.ndarray,
+    y: np.ndarray,
+    n_jobs: int,
+    base_hash: Optional[str] = None
+) -> Tuple[str, int, float, float]:
+    """
+    Train a local model inside a pool process and store its compiled forest
+
+    Args:
+        base_hash: Forest of the contribution an incremental job updates
+
+    Returns:
+        Tuple of (artifact hash, num_samples, start time, end time)
+    """
+    from app.federated.local_trainer import fit_local_model, fit_incremental_model
+    from app.federated.linear_model import LinearModel
+
+    started = time.time()
+    try:
+        if base_hash is None:
+            model_weights, num_samples = fit_local_model(X, y, n_jobs=n_jobs)
+            forest = CompiledForest.from_sklearn(model_weights['model'])
+        else:
+            base_forest, base_metadata = load_forest(base_hash)
+            base_linear = base_metadata.get('linear_model')
+            model_weights, num_samples = fit_incremental_model(
+                X, y, base_forest, base_metadata['n_samples'],
+                LinearModel.from_dict(base_linear) if base_linear else None,
+                n_jobs=n_jobs
+            )
+            forest = model_weights['forest']
+    except HTTPException as e:
+        # HTTPException does not survive the trip back to the parent process
+        raise TrainingJobError(e.detail)
+
+    artifact_hash = save_forest(
+        forest,
+        {
+            'feature_names': model_weights['feature_names'],
+            'n_samples': num_samples,
+            'linear_model': model_weights['linear_model'].to_dict(),
+        }
+    )
+    return artifact_hash, num_samples, started, time.time()
+
+
+class TrainingJobManager:
+    """
+    Submits training jobs to a process pool and tracks their status
+    """
+
+    def __init__(self, pool_size: int = TRAINING_POOL_SIZE, job_cores: int = TRAINING_JOB_CORES):
+        self.pool_size = max(1, pool_size)
+        self.job_cores = job_cores
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._jobs: "OrderedDict[str, TrainingJob]" = OrderedDict()
+        # Hospital -> incremental jobs waiting for its running one, with their data
+        self._waiting: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Created lazily so importing the app does not start processes.
+        # Spawned rather than forked: the parent holds threads and DB connections.
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.pool_size,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def submit(
+        self,
+        X: np.ndarray,
+        y: np.ndarray,
+        doctor_id: int,
+        hospital_name: str,
+        incremental: bool = False
+    ) -> TrainingJob:
+        """
+        Queue a training job
+
+        Incremental jobs may query the database for their base; call this
+        off the event loop.
+
+        Args:
+            X: Parsed feature matrix
+            y: Parsed target vector
+            doctor_id: Doctor who uploaded the data
+            hospital_name: Hospital the contribution belongs to
+            incremental: Update the hospital's newest contribution with
+                the uploaded rows instead of training from scratch
+
+        Returns:
+            The queued TrainingJob
+        """
+        job = TrainingJob(doctor_id, hospital_name, incremental)
+
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > MAX_TRACKED_JOBS:
+                self._jobs.popitem(last=False)
+
+            if incremental:
+                if hospital_name in self._waiting:
+                    # Starts once the hospital's running incremental job is stored
+                    self._waiting[hospital_name].append((job, X, y))
+                    return job
+                self._waiting[hospital_name] = deque()
+
+        self._start(job, X, y)
+        return job
+
+    def _start(self, job: TrainingJob, X: np.ndarray, y: np.ndarray) -> None:
+        base_hash = None
+        if job.incremental:
+            base = latest_contribution(job.hospital_name)
+            job.supersedes_id, base_hash = base if base is not None else (None, None)
+
+        try:
+            job.future = self._get_executor().submit(_train_in_worker, X, y, self.job_cores, base_hash)
+        except BrokenProcessPool:
+            # A pool process died (e.g. killed for memory); start a fresh pool
+            self.shutdown(wait=False)
+            job.future = self._get_executor().submit(_train_in_worker, X, y, self.job_cores, base_hash)
+        job.future.add_done_callback(lambda future: self._finish(job, future, X, y))
+
+    def _start_next(self, hospital_name: str) -> None:
+        # The hospital's incremental job is done; start the one waiting behind it
+        while True:
+            with self._lock:
+                waiting = self._waiting.get(hospital_name)
+                if not waiting:
+                    self._waiting.pop(hospital_name, None)
+                    return
+                job, X, y = waiting.popleft()
+            try:
+                self._start(job, X, y)
+                return
+            except Exception as e:
+                self._fail(job, f"Error starting training: {str(e)}")
+
+    @staticmethod
+    def _fail(job: TrainingJob, error: str) -> None:
+        job.error = error
+        job.finished_at = datetime.utcnow()
+        job.status = "failed"
+
+    def get(self, job_id: str) -> Optional[TrainingJob]:
+        """
+        Look up a job and refresh its status
+
+        Args:
+            job_id: Job identifier returned by submit
+
+        Returns:
+            The TrainingJob, or None if unknown
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None and job.status == "queued" and job.future is not None and job.future.running():
+            job.status = "running"
+        return job
+
+    def _finish(self, job: TrainingJob, future: Future, X: np.ndarray, y: np.ndarray) -> None:
+        try:
+            self._store(job, future)
+        except StaleBaseError as e:
+            error = str(e)
+            if job.rebases < MAX_REBASES:
+                # Train the uploaded rows again on the newer base
+                job.rebases += 1
+                job.status = "queued"
+                try:
+                    self._start(job, X, y)
+                    return
+                except Exception as start_error:
+                    error = f"Error restarting training: {str(start_error)}"
+            self._fail(job, error)
+
+        if job.incremental:
+            self._start_next(job.hospital_name)
+
+    def _store(self, job: TrainingJob, future: Future) -> None:
+        try:
+            artifact_hash, num_samples, started, finished = future.result()
+        except Exception as e:
+            self._fail(job, str(e))
+            return
+
+        job.started_at = datetime.utcfromtimestamp(started)
+        job.train_seconds = finished - started
+        latency_tracker.record("training.queue", job.queue_seconds)
+        latency_tracker.record("training.fit", job.train_seconds)
+        store_started = time.perf_counter()
+
+        db = SessionLocal()
+        try:
+            if job.supersedes_id is not None:
+                newest_id = (
+                    db.query(func.max(ModelContribution.id))
+                    .filter(
+                        ModelContribution.hospital_name == job.hospital_name,
+                        ModelContribution.artifact_hash.isnot(None)
+                    )
+                    .scalar()
+                )
+                if newest_id != job.supersedes_id:
+                    raise StaleBaseError(
+                        f"Contribution {job.supersedes_id} is no longer the hospital's newest"
+                    )
+
+            contribution = ModelContribution(
+                doctor_id=job.doctor_id,
+                hospital_name=job.hospital_name,
+                artifact_hash=artifact_hash,
+                num_samples=num_samples,
+                supersedes_id=job.supersedes_id
+            )
+            db.add(contribution)
+            db.commit()
+            db.refresh(contribution)
+            job.contribution = ModelContributionResponse.model_validate(contribution)
+            latency_tracker.record("training.store", time.perf_counter() - store_started)
+            job.finished_at = datetime.utcnow()
+            job.status = "succeeded"
+        except StaleBaseError:
+            db.rollback()
+            raise
+        except IntegrityError as e:
+            db.rollback()
+            if job.supersedes_id is not None:
+                # Another worker superseded the same contribution first
+                raise StaleBaseError(f"Contribution {job.supersedes_id} was already superseded")
+            self._fail(job, f"Error storing contribution: {str(e)}")
+        except Exception as e:
+            db.rollback()
+            self._fail(job, f"Error storing contribution: {str(e)}")
+        finally:
+            db.close()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop the pool, by default waiting for running jobs to finish"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+# Shared by the training endpoints of this worker
+training_jobs = TrainingJobManager()
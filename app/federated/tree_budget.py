@@ -0,0 +1,191 @@
+"""
+Tree budget: a hard cap on the number of trees in the served ensemble
+
+Every member's trees are stratum samples of the same kind of estimate, so
+a few of them per member already give a stable probability. With a budget
+of B trees, each member gets an expected share proportional to its sample
+weight. Members whose share is at least their tree count keep all their
+trees with their usual weights, and the remaining budget is shared among
+the others the same way. The fractional shares are rounded by systematic
+sampling, so exactly B trees are kept and a small member may keep none in
+a given version.
+
+Each kept tree of a sampled member is weighted by the inverse of its
+inclusion probability (Horvitz-Thompson). The expected output therefore
+equals the full ensemble's, and the weights sum to one in expectation
+only: a sampled member with weight w and share s that keeps k trees
+carries w * k / s of the weight in a given version. Rounding keeps k
+within one tree of s, so each sampled member is off by less than the
+weight of one of its kept trees. Weights are not renormalized, so a
+budgeted ensemble's score can fall slightly outside [0, 1].
+
+Trees within a member are picked uniformly ("stratified") or greedily
+("greedy"). Greedy selection adds, one at a time, the tree that brings the
+kept trees' mean closest to the member's full output on validation inputs.
+The server holds no labels, so the validation inputs are synthesized from
+the ensemble as for distillation. Greedy picks are not random, so the
+expectation argument no longer holds exactly; the number of trees each
+member keeps, and so its weight, is the same either way.
+"""
+import os
+import time
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.schemas import TreeSelection
+from app.federated.compiled_forest import CompiledForest
+from app.federated.distillation import synthesize_inputs, fidelity
+
+# Maximum trees in the served ensemble when the request does not choose; 0 keeps all
+TREE_BUDGET = int(os.getenv("TREE_BUDGET", "0"))
+
+# How trees are picked within each member when the request does not choose
+TREE_SELECTION = TreeSelection(os.getenv("TREE_SELECTION", "stratified"))
+
+# Synthetic rows for greedy selection, and as many to report fidelity on
+TREE_SELECTION_ROWS = int(os.getenv("TREE_SELECTION_ROWS", "2000"))
+
+
+def allocate_trees(
+    tree_counts: Sequence[int],
+    weights: Sequence[float],
+    budget: int,
+    rng: np.random.Generator
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Share a tree budget among members in proportion to their weights
+
+    Args:
+        tree_counts: Trees of each member
+        weights: Sample weight of each member, summing to one
+        budget: Total trees to keep, less than the sum of tree_counts
+        rng: Random generator for the systematic rounding
+
+    Returns:
+        Tuple of (trees kept per member, weight of each kept tree of the
+        member); kept trees times their weight sum to one in expectation
+        over the rounding, not necessarily in a given draw
+    """
+    counts = np.asarray(tree_counts, dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.float64)
+    full = np.zeros(len(counts), dtype=bool)
+    remaining = budget
+
+    # Members whose share covers all their trees keep them all
+    while True:
+        sampled = ~full
+        share = np.where(sampled, remaining * weights / weights[sampled].sum(), 0.0)
+        newly_full = sampled & (share >= counts)
+        if not newly_full.any():
+            break
+        full |= newly_full
+        remaining -= int(counts[newly_full].sum())
+
+    kept = np.where(full, counts, 0)
+    tree_weight = np.where(full, weights / np.maximum(counts, 1), 0.0)
+
+    sampled = ~full
+    if remaining > 0 and sampled.any():
+        # Systematic sampling: one uniform offset, points one tree apart;
+        # each member keeps the points falling within its share
+        cumulative = np.concatenate([[0.0], np.cumsum(share[sampled])])
+        cumulative[-1] = remaining
+        points = rng.random() + np.arange(remaining)
+        kept[sampled] = np.diff(np.searchsorted(points, cumulative))
+        tree_weight[sampled] = weights[sampled] / share[sampled]
+
+    return kept, tree_weight
+
+
+def _greedy_trees(tree_outputs: np.ndarray, n_trees: int) -> np.ndarray:
+    """
+    Pick trees whose mean output best matches the mean of all of them
+
+    Args:
+        tree_outputs: Array of shape (n_trees_total, n_rows)
+        n_trees: Trees to pick
+
+    Returns:
+        Indices of the picked trees, in pick order
+    """
+    target = tree_outputs.mean(axis=0)
+    total = np.zeros_like(target)
+    available = np.ones(len(tree_outputs), dtype=bool)
+    picked = []
+    for step in range(1, n_trees + 1):
+        errors = (((total + tree_outputs) / step - target) ** 2).sum(axis=1)
+        errors[~available] = np.inf
+        best = int(np.argmin(errors))
+        picked.append(best)
+        available[best] = False
+        total += tree_outputs[best]
+    return np.asarray(picked, dtype=np.int64)
+
+
+def select_trees(
+    full: CompiledForest,
+    tree_counts: Sequence[int],
+    weights: Sequence[float],
+    budget: int,
+    selection: TreeSelection = TREE_SELECTION,
+    validation_rows: int = TREE_SELECTION_ROWS,
+    server_inputs: Optional[np.ndarray] = None,
+    seed: int = 0
+) -> Tuple[CompiledForest, dict]:
+    """
+    Build an ensemble of at most budget trees from the full ensemble
+
+    Args:
+        full: Weighted ensemble of all members, their trees in member order
+        tree_counts: Trees of each member
+        weights: Sample weight of each member
+        budget: Maximum trees to keep
+        selection: Uniform ("stratified") or greedy picks within members
+        validation_rows: Synthetic rows for greedy picks and the report
+        server_inputs: Optional server-held rows added to both
+        seed: Random seed
+
+    Returns:
+        Tuple of (budgeted forest, report with sizes and fidelity against
+        the full ensemble)
+    """
+    start = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    kept, tree_weight = allocate_trees(tree_counts, weights, budget, rng)
+
+    X = synthesize_inputs(full, 2 * validation_rows, rng)
+    if server_inputs is not None and len(server_inputs):
+        X = np.vstack([X, server_inputs])
+    X = X[rng.permutation(len(X))]
+    X_validation, X_report = X[:len(X) // 2], X[len(X) // 2:]
+    # Only greedy picks look at tree outputs
+    tree_outputs = full.predict_trees(X_validation).T if selection == TreeSelection.greedy else None
+
+    trees, scales = [], []
+    first_tree = 0
+    for n_trees, n_kept, member_weight, weight in zip(tree_counts, kept, weights, tree_weight):
+        if n_kept == n_trees:
+            picked = np.arange(n_trees)
+        elif tree_outputs is not None:
+            picked = _greedy_trees(tree_outputs[first_tree:first_tree + n_trees], n_kept)
+        else:
+            picked = rng.choice(n_trees, n_kept, replace=False)
+        trees.append(first_tree + picked)
+        # Trees of the full ensemble hold member_weight / n_trees
+        scales.append(np.full(n_kept, weight * n_trees / member_weight))
+        first_tree += n_trees
+
+    selected = full.select_trees(np.concatenate(trees), np.concatenate(scales))
+    report = {
+        'budget': budget,
+        'selection': selection.value,
+        'selected_trees': selected.n_trees,
+        'total_trees': full.n_trees,
+        'selected_nodes': selected.n_nodes,
+        'total_nodes': full.n_nodes,
+        'members_without_trees': int(np.sum(kept == 0)),
+        'fidelity': fidelity(full, selected, X_report),
+        'seconds': time.perf_counter() - start,
+    }
+    return selected, report
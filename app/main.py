@@ -1,27 +1,44 @@
 """
 FastAPI main application
 """
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from datetime import timedelta
-from typing import List
-import pickle
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session, Query as OrmQuery, load_only
+from datetime import datetime, timedelta
+from typing import Optional
 
-from app.database import get_db, init_db, engine
-from app.models import Doctor, ModelContribution, GlobalModel, Base
+from app.database import get_db, init_db, pool_stats, DB_ASYNC, SessionLocal
+from app.models import Doctor, ModelContribution, GlobalModel
 from app.schemas import (
     DoctorRegister, DoctorLogin, Token, DoctorResponse,
     PredictionInput, PredictionOutput,
-    ModelContributionResponse, GlobalModelResponse
+    BatchPredictionInput, BatchPredictionOutput, ExplanationMode, ServingModel,
+    GlobalModelResponse, TrainingJobResponse, AggregationJobResponse,
+    AggregationPolicy, AggregationStrategy, TreeSelection, ContributionPage, GlobalModelPage
 )
 from app.auth import (
     get_password_hash, authenticate_doctor, create_access_token,
-    get_current_doctor, ACCESS_TOKEN_EXPIRE_MINUTES
+    get_current_doctor, get_current_doctor_async, get_current_admin,
+    ACCESS_TOKEN_EXPIRE_MINUTES
+)
+from app.federated.model_cache import model_cache
+from app.federated.model_manager import model_manager
+from app.federated.training_jobs import training_jobs, INCREMENTAL_TRAINING
+from app.federated.aggregation_jobs import aggregation_jobs
+from app.federated.data_processor import parse_csv_stream
+from app.federated.explainer_cache import explainer_cache
+from app.federated.retention import (
+    AUTO_COMPACT, GLOBAL_MODEL_KEEP_LAST, compaction_runner, storage_report
+)
+from app.metrics import latency_tracker, render_metric, RequestMetricsMiddleware
+from app.principal_cache import principal_cache
+from app.result_cache import result_cache
+from app.prediction import (
+    predict_heart_disease_risk, predict_heart_disease_risk_batch, warm_up, WARMUP_ON_STARTUP
 )
-from app.federated import train_local_model, federated_averaging
-from app.prediction import predict_heart_disease_risk
 
 # Create FastAPI app
 app = FastAPI(
@@ -30,6 +47,14 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Authentication dependency of async endpoints: with DB_ASYNC the doctor
+# is resolved on the event loop instead of in a threadpool slot
+get_current_doctor_for_async = get_current_doctor_async if DB_ASYNC else get_current_doctor
+
+# Page size limits of the listing endpoints
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
 # CORS configuration - restrict in production
 app.add_middleware(
     CORSMiddleware,
@@ -39,11 +64,38 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Per-endpoint, per-stage latency histograms (see /metrics)
+app.add_middleware(RequestMetricsMiddleware)
+
+
+# Result of the startup warm-up, reported on /stats
+startup_info = {"warmup": None}
+
 
 @app.on_event("startup")
 def startup_event():
-    """Initialize database on startup"""
-    Base.metadata.create_all(bind=engine)
+    """Initialize database on startup, then optionally warm up the model"""
+    init_db()
+    
+    # Runs before the worker accepts requests, so the first /predict
+    # finds the model and explainer already loaded
+    if WARMUP_ON_STARTUP:
+        db = SessionLocal()
+        try:
+            startup_info["warmup"] = warm_up(db)
+        finally:
+            db.close()
+    
+    # Loads new global versions off the request path from now on
+    model_manager.start()
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    """Stop the model manager, the training process pool and the aggregation thread"""
+    model_manager.stop()
+    training_jobs.shutdown()
+    aggregation_jobs.shutdown()
 
 
 # ==================== Authentication Endpoints ====================
@@ -136,16 +188,28 @@ def get_current_doctor_info(
 
 # ==================== Federated Learning Endpoints ====================
 
-@app.post("/federated/train", response_model=ModelContributionResponse)
+@app.post(
+    "/federated/train",
+    response_model=TrainingJobResponse,
+    status_code=status.HTTP_202_ACCEPTED
+)
 async def train_and_contribute_model(
     file: UploadFile = File(...),
-    current_doctor: Doctor = Depends(get_current_doctor),
-    db: Session = Depends(get_db)
+    incremental: Optional[bool] = None,
+    current_doctor: Doctor = Depends(get_current_doctor_for_async)
 ):
     """
-    Upload CSV dataset, train local model, and contribute weights
+    Upload CSV dataset and queue local training as a background job
     
     - **file**: CSV file with heart disease data
+    - **incremental**: Treat the file as new rows only and update the
+      hospital's latest contribution with them: new trees are grown on
+      these rows, the oldest are retired, and the result supersedes the
+      previous contribution. Trains from scratch if the hospital has none.
+      Defaults to the INCREMENTAL_TRAINING setting.
+    
+    Returns immediately with a job id. Poll `/federated/jobs/{job_id}` for
+    the status and the resulting model contribution.
     
     Required CSV columns:
     - age, sex, cp, trestbps, chol, fbs, restecg, thalach, exang, oldpeak, slope, ca, thal, target
@@ -157,40 +221,140 @@ async def train_and_contribute_model(
             detail="File must be a CSV"
         )
     
-    # Read CSV content
-    content = await file.read()
-    csv_data = content.decode('utf-8')
+    # Stream the upload in chunks into typed arrays, off the event loop
+    try:
+        with latency_tracker.time("parse_csv"):
+            X, y = await run_in_threadpool(parse_csv_stream, file.file)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Data validation error: {str(e)}"
+        )
+    
+    if incremental is None:
+        incremental = INCREMENTAL_TRAINING
     
-    # Train local model and get weights
-    model_weights, num_samples = train_local_model(csv_data)
+    # Train in the process pool; the contribution is stored when it finishes.
+    # Incremental jobs look up the hospital's newest contribution, off the event loop
+    if incremental:
+        return await run_in_threadpool(
+            training_jobs.submit, X, y, current_doctor.id, current_doctor.hospital_name, True
+        )
+    return training_jobs.submit(X, y, current_doctor.id, current_doctor.hospital_name)
+
+
+@app.get("/federated/jobs/{job_id}", response_model=TrainingJobResponse)
+def get_training_job(
+    job_id: str,
+    current_doctor: Doctor = Depends(get_current_doctor)
+):
+    """
+    Get status, timings and resulting contribution of a training job
+    """
+    job = training_jobs.get(job_id)
     
-    # Store model contribution
-    contribution = ModelContribution(
-        doctor_id=current_doctor.id,
-        hospital_name=current_doctor.hospital_name,
-        model_weights=pickle.dumps(model_weights),
-        num_samples=num_samples
-    )
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Training job not found"
+        )
     
-    db.add(contribution)
-    db.commit()
-    db.refresh(contribution)
+    return job
+
+
+def _after_aggregation(global_model: GlobalModel) -> None:
+    # This worker prepares the new version right away; others find it
+    # at their next version check
+    model_manager.refresh()
     
-    return contribution
+    if AUTO_COMPACT:
+        compaction_runner.start()
 
 
-@app.post("/federated/aggregate", response_model=GlobalModelResponse)
+@app.post(
+    "/federated/aggregate",
+    response_model=AggregationJobResponse,
+    status_code=status.HTTP_202_ACCEPTED
+)
 def aggregate_models(
-    current_doctor: Doctor = Depends(get_current_doctor),
-    db: Session = Depends(get_db)
+    policy: Optional[AggregationPolicy] = None,
+    strategy: Optional[AggregationStrategy] = None,
+    tree_budget: Optional[int] = Query(None, ge=0),
+    tree_selection: Optional[TreeSelection] = None,
+    distill: Optional[bool] = None,
+    current_doctor: Doctor = Depends(get_current_doctor)
 ):
     """
-    Trigger FedAvg aggregation of all model contributions
+    Queue FedAvg aggregation of all model contributions as a background job
+    
+    Aggregates model weights from all hospitals using weighted averaging.
+    Only contributions recorded since the previous global version are
+    compiled; earlier members are reused.
+    
+    Returns immediately with a job id. Poll
+    `/federated/aggregations/{job_id}` for the status and the new global
+    model. Jobs of a worker run one at a time.
     
-    Aggregates model weights from all hospitals using weighted averaging
+    - **policy**: `all` (every contribution not superseded by a newer incremental upload) or `latest_per_hospital`
+      (each hospital's newest contribution only). Defaults to the
+      AGGREGATION_POLICY setting.
+    - **strategy**: `ensemble` (every member's trees, weighted) or
+      `parameter_averaging` (sample-weighted mean of the members' logistic
+      regression parameters). Defaults to the AGGREGATION_STRATEGY setting.
+    - **tree_budget**: Maximum trees in the ensemble (0 for no limit),
+      reweighted to keep its expected output; defaults to TREE_BUDGET.
+    - **tree_selection**: `stratified` or `greedy` choice of trees within
+      each contribution under the budget; defaults to TREE_SELECTION.
+    - **distill**: Also distill a bounded-size student model from the
+      ensemble, stored with the version along with its fidelity metrics.
+      Defaults to the DISTILL_ON_AGGREGATE setting; ensemble strategy only.
     """
-    global_model = federated_averaging(db)
-    return global_model
+    return aggregation_jobs.submit(
+        policy, strategy, tree_budget, tree_selection, distill, on_success=_after_aggregation
+    )
+
+
+@app.get("/federated/aggregations/{job_id}", response_model=AggregationJobResponse)
+def get_aggregation_job(
+    job_id: str,
+    current_doctor: Doctor = Depends(get_current_doctor)
+):
+    """
+    Get status, timings and resulting global model of an aggregation job
+    """
+    job = aggregation_jobs.get(job_id)
+    
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Aggregation job not found"
+        )
+    
+    return job
+
+
+def _keyset_page(query: OrmQuery, id_column, cursor: Optional[int], limit: int) -> dict:
+    """
+    Get one page of a listing, newest first
+    
+    Pages are selected by primary key rather than OFFSET, so the cost of a
+    page does not grow with its position in the table.
+    
+    Args:
+        query: Filtered query over the listed model
+        id_column: Primary key column of the model
+        cursor: Only return rows with a smaller id (next_cursor of the previous page)
+        limit: Page size
+    
+    Returns:
+        Dictionary with the page items and the cursor of the next page
+    """
+    if cursor is not None:
+        query = query.filter(id_column < cursor)
+    rows = query.order_by(id_column.desc()).limit(limit + 1).all()
+    items = rows[:limit]
+    next_cursor = items[-1].id if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
 
 
 @app.get("/federated/global-model", response_model=GlobalModelResponse)
@@ -201,7 +365,15 @@ def get_global_model(
     """
     Get the latest global model information
     """
-    global_model = db.query(GlobalModel).order_by(GlobalModel.version.desc()).first()
+    global_model = (
+        db.query(GlobalModel)
+        .options(load_only(GlobalModel.id, GlobalModel.version, GlobalModel.num_contributions,
+                           GlobalModel.pinned, GlobalModel.compacted_at, GlobalModel.strategy,
+                           GlobalModel.tree_budget_report, GlobalModel.student_fidelity,
+                           GlobalModel.created_at))
+        .order_by(GlobalModel.version.desc())
+        .first()
+    )
     
     if not global_model:
         raise HTTPException(
@@ -212,16 +384,69 @@ def get_global_model(
     return global_model
 
 
-@app.get("/federated/contributions", response_model=List[ModelContributionResponse])
+@app.get("/federated/global-models", response_model=GlobalModelPage)
+def list_global_models(
+    cursor: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    current_doctor: Doctor = Depends(get_current_doctor),
+    db: Session = Depends(get_db)
+):
+    """
+    List global model versions, newest first
+    
+    - **cursor**: `next_cursor` of the previous page
+    - **limit**: Page size (1-500)
+    - **since** / **until**: Only versions created in this time range
+    """
+    query = db.query(GlobalModel).options(
+        load_only(GlobalModel.id, GlobalModel.version, GlobalModel.num_contributions,
+                  GlobalModel.pinned, GlobalModel.compacted_at, GlobalModel.strategy,
+                  GlobalModel.tree_budget_report, GlobalModel.student_fidelity,
+                  GlobalModel.created_at)
+    )
+    if since is not None:
+        query = query.filter(GlobalModel.created_at >= since)
+    if until is not None:
+        query = query.filter(GlobalModel.created_at < until)
+    
+    return _keyset_page(query, GlobalModel.id, cursor, limit)
+
+
+@app.get("/federated/contributions", response_model=ContributionPage)
 def get_all_contributions(
+    cursor: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    hospital: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
     current_doctor: Doctor = Depends(get_current_doctor),
     db: Session = Depends(get_db)
 ):
     """
-    Get all model contributions from all hospitals
+    Get model contributions from all hospitals, newest first
+    
+    Only metadata is returned; model artifacts are never loaded.
+    
+    - **cursor**: `next_cursor` of the previous page
+    - **limit**: Page size (1-500)
+    - **hospital**: Only contributions of this hospital
+    - **since** / **until**: Only contributions created in this time range
     """
-    contributions = db.query(ModelContribution).all()
-    return contributions
+    query = db.query(ModelContribution).options(
+        load_only(ModelContribution.id, ModelContribution.doctor_id,
+                  ModelContribution.hospital_name, ModelContribution.num_samples,
+                  ModelContribution.supersedes_id, ModelContribution.created_at)
+    )
+    if hospital is not None:
+        query = query.filter(ModelContribution.hospital_name == hospital)
+    if since is not None:
+        query = query.filter(ModelContribution.created_at >= since)
+    if until is not None:
+        query = query.filter(ModelContribution.created_at < until)
+    
+    return _keyset_page(query, ModelContribution.id, cursor, limit)
 
 
 # ==================== Prediction Endpoints ====================
@@ -229,6 +454,8 @@ def get_all_contributions(
 @app.post("/predict", response_model=PredictionOutput)
 def predict_risk(
     prediction_input: PredictionInput,
+    explain: ExplanationMode = ExplanationMode.exact,
+    model: Optional[ServingModel] = None,
     current_doctor: Doctor = Depends(get_current_doctor),
     db: Session = Depends(get_db)
 ):
@@ -237,6 +464,15 @@ def predict_risk(
     
     All input fields are mandatory. Risk levels: Low, Medium, High
     
+    Query parameter **explain** selects the explanation:
+    `exact` (TreeSHAP, default), `approx` (fast path-based contributions)
+    or `none` (risk score only).
+    
+    Query parameter **model** selects `ensemble` or the distilled
+    `student` (constant latency as the federation grows); defaults to
+    the SERVING_MODEL setting. Versions without a student are served by
+    the ensemble; `served_model` in the response says which one was used.
+    
     - **age**: Age in years (0-120)
     - **sex**: Sex (0=female, 1=male)
     - **cp**: Chest pain type (0-3)
@@ -251,7 +487,101 @@ def predict_risk(
     - **ca**: Number of major vessels colored by fluoroscopy (0-4)
     - **thal**: Thalassemia (0-3)
     """
-    return predict_heart_disease_risk(db, prediction_input)
+    return predict_heart_disease_risk(db, prediction_input, explain, model)
+
+
+@app.post("/predict/batch", response_model=BatchPredictionOutput)
+def predict_risk_batch(
+    batch_input: BatchPredictionInput,
+    explain: ExplanationMode = ExplanationMode.none,
+    model: Optional[ServingModel] = None,
+    current_doctor: Doctor = Depends(get_current_doctor),
+    db: Session = Depends(get_db)
+):
+    """
+    Predict heart disease risk for many patients in one request
+    
+    Every ensemble member scores all rows at once. Predictions are returned
+    in input order.
+    
+    - **inputs**: List of prediction inputs (same fields as `/predict`)
+    - **explain** (query): `none` (default), `approx` or `exact`
+    - **model** (query): `ensemble` or `student`, as for `/predict`
+    """
+    return predict_heart_disease_risk_batch(db, batch_input, explain, model)
+
+
+# ==================== Admin Endpoints ====================
+
+@app.get("/admin/storage")
+def get_storage(
+    current_admin: Doctor = Depends(get_current_admin),
+    db: Session = Depends(get_db)
+):
+    """
+    Storage used by every global model version, newest first
+    
+    Artifacts are deduplicated; `shared_with` counts the other versions
+    referencing the same artifact. `serving_bytes` is the decoded layout
+    this host serves from, assembled from the members for ensemble versions.
+    """
+    versions = storage_report(db)
+    return {
+        "versions": versions,
+        "total_artifact_bytes": sum(
+            {v["artifact_hash"]: v["artifact_bytes"] for v in versions if v["artifact_hash"]}.values()
+        ),
+        "total_serving_bytes": sum(
+            {v["artifact_hash"]: v["serving_bytes"] for v in versions if v["artifact_hash"]}.values()
+        ),
+        "total_legacy_blob_bytes": sum(v["legacy_blob_bytes"] for v in versions),
+        "compaction": compaction_runner.status(),
+    }
+
+
+@app.post("/admin/compact", status_code=status.HTTP_202_ACCEPTED)
+def compact_models(
+    keep_last: int = Query(GLOBAL_MODEL_KEEP_LAST, ge=1),
+    current_admin: Doctor = Depends(get_current_admin)
+):
+    """
+    Start a background compaction run
+    
+    Keeps the newest **keep_last** global versions plus pinned ones; older
+    versions keep their metadata but lose their model. Unreferenced
+    artifacts are then deleted. Poll `/admin/storage` for the result.
+    """
+    started = compaction_runner.start(keep_last)
+    return {"started": started, "compaction": compaction_runner.status()}
+
+
+@app.put("/admin/global-models/{version}/pin", response_model=GlobalModelResponse)
+def pin_global_model(
+    version: int,
+    pinned: bool = True,
+    current_admin: Doctor = Depends(get_current_admin),
+    db: Session = Depends(get_db)
+):
+    """
+    Pin a global version so retention keeps its model (`?pinned=false` unpins)
+    """
+    global_model = db.query(GlobalModel).filter(GlobalModel.version == version).first()
+    
+    if not global_model:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Global model version not found"
+        )
+    if pinned and global_model.compacted_at is not None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Global model version has already been compacted"
+        )
+    
+    global_model.pinned = pinned
+    db.commit()
+    db.refresh(global_model)
+    return global_model
 
 
 # ==================== Health Check ====================
@@ -264,6 +594,93 @@ def health_check():
     return {"status": "healthy", "service": "Federated Learning Heart Disease API"}
 
 
+@app.get("/stats")
+def get_stats():
+    """
+    In-process cache statistics for this worker
+    """
+    return {
+        "model_cache": model_cache.stats(),
+        "model_manager": model_manager.status(),
+        "explainer_cache": explainer_cache.stats(),
+        "principal_cache": principal_cache.stats(),
+        "result_cache": result_cache.stats(),
+        "aggregation_jobs": aggregation_jobs.stats(),
+        "db_pool": pool_stats(),
+        "startup": startup_info,
+        "latency": latency_tracker.summary(),
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Latency histograms and cache counters of this worker in the
+    Prometheus text exposition format
+    """
+    model_stats = model_cache.stats()
+    explainer_stats = explainer_cache.stats()
+    principal_stats = principal_cache.stats()
+    result_stats = result_cache.stats()
+    pools = {name: stats for name, stats in pool_stats().items() if 'checkouts' in stats}
+    
+    lines = latency_tracker.render_prometheus()
+    lines += render_metric(
+        "model_cache_events_total", "counter", "Global model cache lookups",
+        [({"event": "hit"}, model_stats["hits"]), ({"event": "miss"}, model_stats["misses"])]
+    )
+    lines += render_metric(
+        "explainer_cache_events_total", "counter", "SHAP explainer cache lookups",
+        [({"event": "hit"}, explainer_stats["hits"]), ({"event": "miss"}, explainer_stats["misses"])]
+    )
+    lines += render_metric(
+        "principal_cache_events_total", "counter", "Authenticated-principal cache events",
+        [({"event": event}, principal_stats[key]) for event, key in (
+            ("hit", "hits"), ("miss", "misses"),
+            ("expiration", "expirations"), ("invalidation", "invalidations")
+        )]
+    )
+    lines += render_metric(
+        "result_cache_events_total", "counter", "Prediction result cache lookups per row",
+        [({"event": event}, result_stats[key]) for event, key in (
+            ("hit", "hits"), ("miss", "misses"), ("invalidation", "invalidations")
+        )]
+    )
+    lines += render_metric(
+        "result_cache_entries", "gauge", "Cached prediction results",
+        [({}, result_stats["size"])]
+    )
+    lines += render_metric(
+        "model_manager_swaps_total", "counter", "Global model versions swapped in by the model manager",
+        [({}, model_manager.swaps)]
+    )
+    version = model_cache.version
+    lines += render_metric(
+        "model_version", "gauge", "GlobalModel version served by this worker",
+        [({}, version)] if version is not None else []
+    )
+    lines += render_metric(
+        "db_pool_checkouts_total", "counter", "Connection checkouts",
+        [({"engine": name}, stats["checkouts"]) for name, stats in pools.items()]
+    )
+    lines += render_metric(
+        "db_pool_overflow_events_total", "counter", "Checkouts that opened an overflow connection",
+        [({"engine": name}, stats["overflow_events"]) for name, stats in pools.items()]
+    )
+    lines += render_metric(
+        "db_pool_timeouts_total", "counter", "Checkouts that timed out",
+        [({"engine": name}, stats["timeouts"]) for name, stats in pools.items()]
+    )
+    lines += render_metric(
+        "db_pool_checked_out", "gauge", "Connections currently checked out",
+        [({"engine": name}, stats["checked_out"]) for name, stats in pools.items()]
+    )
+    return PlainTextResponse(
+        "\n".join(lines) + "\n",
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,281 @@
+"""
+In-process latency tracking
+
+Stages of a request are timed with ``latency_tracker.time(stage)``. Each
+duration feeds a sliding window per stage (percentiles on /stats) and a
+cumulative histogram per (endpoint, stage), exposed on /metrics in the
+Prometheus text format. Durations recorded while serving a request are
+labelled with that request's route once it has been matched; durations
+recorded outside a request are labelled "background".
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# Number of most recent samples kept per tracked operation
+LATENCY_WINDOW = 1024
+
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+# Record timings at all; when disabled spans cost one flag check
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# Endpoint label of durations recorded outside a request
+BACKGROUND_ENDPOINT = "background"
+
+# Stage label of whole-request durations
+REQUEST_STAGE = "total"
+
+
+class _RequestSpans:
+    """Stage durations of the current request, labelled when it completes"""
+
+    __slots__ = ('spans',)
+
+    def __init__(self):
+        self.spans: List[Tuple[str, float]] = []
+
+
+_current_request: ContextVar[Optional[_RequestSpans]] = ContextVar("current_request", default=None)
+
+
+class LatencyTracker:
+    """
+    Keeps a sliding window of recent durations per operation name and a
+    histogram per endpoint and operation
+    """
+
+    def __init__(self, window: int = LATENCY_WINDOW, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.window = window
+        self.buckets = buckets
+        self.enabled = METRICS_ENABLED
+        self._samples: Dict[str, deque] = {}
+        self._counts: Dict[str, int] = {}
+        # (endpoint, stage) -> [count per bucket (+Inf last), sum of seconds]
+        self._histograms: Dict[Tuple[str, str], list] = {}
+        # (endpoint, method, status) -> count
+        self._requests: Dict[Tuple[str, str, int], int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float, endpoint: Optional[str] = None) -> None:
+        """
+        Record one duration
+
+        Args:
+            name: Operation name, e.g. "predict.exact"
+            seconds: Elapsed wall-clock time
+            endpoint: Endpoint label; defaults to the current request's
+                route, or "background" outside a request
+        """
+        if not self.enabled:
+            return
+
+        if endpoint is None:
+            request = _current_request.get()
+            if request is not None:
+                # Labelled in finish_request, once the route is known
+                request.spans.append((name, seconds))
+                return
+            endpoint = BACKGROUND_ENDPOINT
+
+        with self._lock:
+            self._observe(endpoint, name, seconds)
+
+    def _observe(self, endpoint: str, name: str, seconds: float) -> None:
+        # Caller holds the lock
+        samples = self._samples.get(name)
+        if samples is None:
+            samples = self._samples[name] = deque(maxlen=self.window)
+            self._counts[name] = 0
+        samples.append(seconds)
+        self._counts[name] += 1
+
+        histogram = self._histograms.get((endpoint, name))
+        if histogram is None:
+            histogram = self._histograms[(endpoint, name)] = [0] * (len(self.buckets) + 1) + [0.0]
+        histogram[bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    @contextmanager
+    def time(self, name: str) -> Iterator[None]:
+        """Record the duration of the enclosed block under name"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def start_request(self) -> Tuple[_RequestSpans, object]:
+        """Begin collecting the stage durations of a request"""
+        request = _RequestSpans()
+        return request, _current_request.set(request)
+
+    def finish_request(
+        self,
+        request: _RequestSpans,
+        context_token: object,
+        endpoint: str,
+        method: str,
+        status_code: int,
+        seconds: float
+    ) -> None:
+        """Label and record the stage durations and total of a request"""
+        _current_request.reset(context_token)
+        with self._lock:
+            for name, stage_seconds in request.spans:
+                self._observe(endpoint, name, stage_seconds)
+            self._observe(endpoint, REQUEST_STAGE, seconds)
+            key = (endpoint, method, status_code)
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+    def summary(self) -> dict:
+        """
+        Summarize the recent window of every operation
+
+        Returns:
+            Dictionary of name -> count, mean, p50 and p99 in milliseconds
+        """
+        with self._lock:
+            snapshot = {name: (self._counts[name], np.array(samples))
+                        for name, samples in self._samples.items()}
+
+        summary = {}
+        for name, (count, samples) in sorted(snapshot.items()):
+            samples_ms = samples * 1000.0
+            summary[name] = {
+                'count': count,
+                'mean_ms': float(samples_ms.mean()),
+                'p50_ms': float(np.percentile(samples_ms, 50)),
+                'p99_ms': float(np.percentile(samples_ms, 99)),
+            }
+        return summary
+
+    def render_prometheus(self) -> List[str]:
+        """
+        Histograms and request counters in the Prometheus text format
+
+        Returns:
+            List of exposition lines
+        """
+        with self._lock:
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+            requests = dict(self._requests)
+
+        lines = [
+            "# HELP request_stage_seconds Latency of request stages",
+            "# TYPE request_stage_seconds histogram",
+        ]
+        bounds = [_format_float(bound) for bound in self.buckets] + ["+Inf"]
+        for (endpoint, stage), histogram in sorted(histograms.items()):
+            labels = f'endpoint="{_escape(endpoint)}",stage="{_escape(stage)}"'
+            cumulative = 0
+            for bound, count in zip(bounds, histogram[:-1]):
+                cumulative += count
+                lines.append(f'request_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"request_stage_seconds_sum{{{labels}}} {_format_float(histogram[-1])}")
+            lines.append(f"request_stage_seconds_count{{{labels}}} {cumulative}")
+
+        lines.append("# HELP http_requests_total Completed HTTP requests")
+        lines.append("# TYPE http_requests_total counter")
+        for (endpoint, method, status_code), count in sorted(requests.items()):
+            lines.append(
+                f'http_requests_total{{endpoint="{_escape(endpoint)}",method="{method}",'
+                f'status="{status_code}"}} {count}'
+            )
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_float(value: float) -> str:
+    return repr(float(value))
+
+
+def render_metric(
+    name: str,
+    metric_type: str,
+    help_text: str,
+    samples: Iterable[Tuple[Dict[str, str], float]]
+) -> List[str]:
+    """
+    Render one metric family in the Prometheus text format
+
+    Args:
+        name: Metric name
+        metric_type: "counter" or "gauge"
+        help_text: Description
+        samples: (labels, value) pairs
+
+    Returns:
+        List of exposition lines
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        label_text = ",".join(f'{key}="{_escape(str(val))}"' for key, val in labels.items())
+        lines.append(f"{name}{{{label_text}}} {_format_float(value)}" if label_text
+                     else f"{name} {_format_float(value)}")
+    return lines
+
+
+def _route_label(scope: dict) -> str:
+    """Route template of a matched request, so path parameters do not
+    create one label value per id"""
+    route = scope.get("route")
+    path = getattr(route, "path", None)
+    if path is not None:
+        return path
+    endpoint = scope.get("endpoint")
+    return getattr(endpoint, "__name__", "unmatched")
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware timing each HTTP request and labelling its stage
+    durations with the matched route
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not latency_tracker.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        request, context_token = latency_tracker.start_request()
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            latency_tracker.finish_request(
+                request, context_token, _route_label(scope), scope["method"],
+                status_code, time.perf_counter() - start
+            )
+
+
+# Shared by all request handlers of this worker
+latency_tracker = LatencyTracker()
@@ -1,8 +1,8 @@
 """
 Database models for the application
 """
-from sqlalchemy import Column, Integer, String, ForeignKey, LargeBinary, DateTime, Float
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, ForeignKey, LargeBinary, DateTime, Float, Boolean, JSON, false
+from sqlalchemy.orm import relationship, deferred
 from datetime import datetime
 from app.database import Base
 
@@ -34,9 +34,11 @@ class ModelContribution(Base):
     id = Column(Integer, primary_key=True, index=True)
     doctor_id = Column(Integer, ForeignKey("doctors.id"), nullable=False)
     hospital_name = Column(String, nullable=False, index=True)
-    model_weights = Column(LargeBinary, nullable=False)  # Pickled model weights
+    model_weights = deferred(Column(LargeBinary, nullable=True))  # Pickled model weights (legacy rows only)
+    artifact_hash = Column(String(64), nullable=True, index=True)  # Compiled forest in the artifact store
     num_samples = Column(Integer, nullable=False)  # Number of samples used for training
-    created_at = Column(DateTime, default=datetime.utcnow)
+    supersedes_id = Column(Integer, ForeignKey("model_contributions.id"), nullable=True, unique=True, index=True)  # Contribution an incremental update replaces; each is replaced at most once
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
 
     # Relationship
     doctor = relationship("Doctor", back_populates="model_contributions")
@@ -49,7 +51,14 @@ class GlobalModel(Base):
     __tablename__ = "global_models"
 
     id = Column(Integer, primary_key=True, index=True)
-    model_data = Column(LargeBinary, nullable=False)  # Pickled model
+    model_data = deferred(Column(LargeBinary, nullable=True))  # Pickled model (legacy rows only)
+    artifact_hash = Column(String(64), nullable=True, index=True)  # Forest and manifest in the artifact store
+    student_artifact_hash = Column(String(64), nullable=True)  # Distilled student forest, if any
+    student_fidelity = Column(JSON, nullable=True)  # Distillation report: student vs ensemble
     version = Column(Integer, nullable=False)
+    strategy = Column(String, default="ensemble", server_default="ensemble", nullable=False)  # AggregationStrategy value
+    tree_budget_report = Column(JSON, nullable=True)  # Trees kept under a tree budget, and their fidelity
     num_contributions = Column(Integer, default=0)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    pinned = Column(Boolean, default=False, server_default=false(), nullable=False)  # Exempt from retention
+    compacted_at = Column(DateTime, nullable=True)  # Set once the model was dropped by retention
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
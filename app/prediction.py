@@ -1,14 +1,30 @@
 """
 Prediction module with SHAP explainability
 """
+import os
+import time
 import numpy as np
-import shap
 from sqlalchemy.orm import Session
 from fastapi import HTTPException
+from typing import Hashable, List, Optional
 
-from app.federated import predict_with_global_model
+from app.federated.predictor import predict_batch_with_aggregated_model
+from app.federated.model_cache import model_cache
+from app.federated.explainer_cache import explainer_cache
 from app.federated.data_processor import get_feature_names
-from app.schemas import PredictionInput, PredictionOutput
+from app.metrics import latency_tracker
+from app.result_cache import result_cache
+from app.schemas import (
+    PredictionInput, PredictionOutput, ExplanationMode, ServingModel,
+    BatchPredictionInput, BatchPredictionOutput
+)
+
+# Load the latest global model and build its explainer at worker startup
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "false").lower() == "true"
+
+# Model that scores predictions unless the request chooses; versions
+# without a distilled student are always served by their ensemble
+SERVING_MODEL = ServingModel(os.getenv("SERVING_MODEL", "ensemble"))
 
 
 def determine_risk_level(probability: float) -> str:
@@ -29,80 +45,155 @@ def determine_risk_level(probability: float) -> str:
         return "High"
 
 
-def calculate_shap_values(db: Session, features: np.ndarray) -> dict:
+def build_feature_matrix(inputs: List[PredictionInput]) -> np.ndarray:
     """
-    Calculate SHAP values for feature importance explanation
+    Convert prediction inputs to a 2-D feature matrix
     
     Args:
-        db: Database session
-        features: Feature array
+        inputs: Prediction inputs
         
     Returns:
-        Dictionary with feature names and their SHAP values
+        Array of shape (len(inputs), n_features) in model feature order
     """
-    try:
-        # Get latest global model
-        from app.models import GlobalModel
-        import pickle
-        
-        global_model = db.query(GlobalModel).order_by(GlobalModel.version.desc()).first()
-        
-        if not global_model:
-            raise HTTPException(
-                status_code=404,
-                detail="No global model available"
-            )
-        
-        # Load aggregated model data
-        aggregated_data = pickle.loads(global_model.model_data)
-        models = aggregated_data['models']
-        weights = aggregated_data['weights']
-        
-        # Use the first model as representative for SHAP
-        # Note: This is a simplification. In a production system, you might want to
-        # average SHAP values across all models for a more accurate representation
-        # of the federated model's behavior
-        representative_model = models[0]
-        
-        # Create SHAP explainer
-        explainer = shap.TreeExplainer(representative_model)
-        
-        # Calculate SHAP values
-        shap_values = explainer.shap_values(features.reshape(1, -1))
-        
-        # Handle both binary and multi-class outputs
-        if isinstance(shap_values, list):
-            # Multi-class: use values for positive class
-            shap_values_class = shap_values[1][0] if len(shap_values) > 1 else shap_values[0][0]
-        else:
-            # Binary: use the values directly
-            shap_values_class = shap_values[0]
-        
-        # Get feature names
-        feature_names = get_feature_names()
+    feature_names = get_feature_names()
+    return np.array(
+        [[getattr(item, feature) for feature in feature_names] for item in inputs],
+        dtype=float
+    )
+
+
+def format_explanations(contributions: np.ndarray) -> List[dict]:
+    """
+    Convert per-row feature contributions to sorted dictionaries
+    
+    Args:
+        contributions: Array of shape (n_rows, n_features)
         
+    Returns:
+        List of dictionaries of feature name -> contribution, sorted by
+        absolute importance
+    """
+    feature_names = get_feature_names()
+    
+    explanations = []
+    for row in contributions:
         # Create dictionary of feature importance
-        shap_explanation = {
-            feature: float(value) 
-            for feature, value in zip(feature_names, shap_values_class)
+        explanation = {
+            feature: float(value)
+            for feature, value in zip(feature_names, row)
         }
         
         # Sort by absolute importance
-        shap_explanation = dict(
-            sorted(shap_explanation.items(), key=lambda x: abs(x[1]), reverse=True)
-        )
+        explanations.append(dict(
+            sorted(explanation.items(), key=lambda x: abs(x[1]), reverse=True)
+        ))
+    
+    return explanations
+
+
+def calculate_shap_values_batch(
+    explainer_key: Hashable,
+    aggregated_data: dict,
+    features: np.ndarray
+) -> List[dict]:
+    """
+    Calculate SHAP values for every row of a feature matrix
+    
+    Explains the whole weighted ensemble using the explainer cached for
+    this global model version.
+    
+    Args:
+        explainer_key: GlobalModel version of the aggregated model, or
+            (version, "student") when explaining its student
+        aggregated_data: Aggregated model data from the model cache
+        features: 2-D feature matrix
         
-        return shap_explanation
+    Returns:
+        List of dictionaries with feature names and their SHAP values
         
+    Raises:
+        HTTPException: If the SHAP explanation fails
+    """
+    try:
+        shap_values = explainer_cache.shap_values(explainer_key, aggregated_data['forest'], features)
     except Exception as e:
-        # If SHAP fails, return simple feature importance
-        feature_names = get_feature_names()
-        return {feature: 0.0 for feature in feature_names}
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error calculating SHAP explanation: {str(e)}"
+        )
+    
+    return format_explanations(shap_values)
+
+
+def calculate_shap_values(explainer_key: Hashable, aggregated_data: dict, features: np.ndarray) -> dict:
+    """
+    Calculate SHAP values for feature importance explanation
+    
+    Args:
+        explainer_key: GlobalModel version of the aggregated model
+        aggregated_data: Aggregated model data from the model cache
+        features: Feature array
+        
+    Returns:
+        Dictionary with feature names and their SHAP values
+    """
+    return calculate_shap_values_batch(explainer_key, aggregated_data, features.reshape(1, -1))[0]
+
+
+def calculate_approx_contributions_batch(aggregated_data: dict, features: np.ndarray) -> List[dict]:
+    """
+    Calculate approximate (Saabas) feature contributions for every row
+    
+    Much cheaper than TreeSHAP: contributions are collected during a single
+    traversal of the compiled forest and still sum to the risk score minus
+    the ensemble's baseline.
+    
+    Args:
+        aggregated_data: Aggregated model data from the model cache
+        features: 2-D feature matrix
+        
+    Returns:
+        List of dictionaries with feature names and their contributions
+    """
+    return format_explanations(aggregated_data['forest'].saabas_contributions(features))
+
+
+def explain_batch(
+    mode: ExplanationMode,
+    explainer_key: Hashable,
+    aggregated_data: dict,
+    features: np.ndarray
+) -> List[Optional[dict]]:
+    """
+    Compute explanations for every row in the requested mode
+    
+    Args:
+        mode: Explanation mode
+        explainer_key: GlobalModel version of the aggregated model, or
+            (version, "student") when explaining its student
+        aggregated_data: Aggregated model data from the model cache
+        features: 2-D feature matrix
+        
+    Returns:
+        One explanation dictionary per row, or None per row for mode none
+    """
+    if mode == ExplanationMode.none:
+        return [None] * len(features)
+    
+    with latency_tracker.time(f"explain.{mode.value}"):
+        if aggregated_data.get('linear') is not None:
+            # Exact for a linear model, so both modes return them
+            return format_explanations(aggregated_data['linear'].contributions(features))
+        if mode == ExplanationMode.approx:
+            return calculate_approx_contributions_batch(aggregated_data, features)
+        return calculate_shap_values_batch(explainer_key, aggregated_data, features)
 
 
 def predict_heart_disease_risk(
     db: Session,
-    prediction_input: PredictionInput
+    prediction_input: PredictionInput,
+    explanation_mode: ExplanationMode = ExplanationMode.exact,
+    serving_model: Optional[ServingModel] = None
 ) -> PredictionOutput:
     """
     Predict heart disease risk with SHAP explainability
@@ -110,38 +201,135 @@ def predict_heart_disease_risk(
     Args:
         db: Database session
         prediction_input: Input features for prediction
+        explanation_mode: How to explain the prediction
+        serving_model: Ensemble or distilled student; defaults to the
+            SERVING_MODEL setting
         
     Returns:
         PredictionOutput with risk level, score, and SHAP explanation
     """
-    # Convert input to feature array
-    features = np.array([
-        prediction_input.age,
-        prediction_input.sex,
-        prediction_input.cp,
-        prediction_input.trestbps,
-        prediction_input.chol,
-        prediction_input.fbs,
-        prediction_input.restecg,
-        prediction_input.thalach,
-        prediction_input.exang,
-        prediction_input.oldpeak,
-        prediction_input.slope,
-        prediction_input.ca,
-        prediction_input.thal
-    ])
-    
-    # Make prediction using global model
-    risk_score, prediction = predict_with_global_model(db, features)
-    
-    # Determine risk level
-    risk_level = determine_risk_level(risk_score)
-    
-    # Calculate SHAP explanation
-    shap_explanation = calculate_shap_values(db, features)
-    
-    return PredictionOutput(
-        risk_level=risk_level,
-        risk_score=risk_score,
-        shap_explanation=shap_explanation
-    )
+    with latency_tracker.time(f"predict.{explanation_mode.value}"):
+        features = build_feature_matrix([prediction_input])
+        return _predict(db, features, explanation_mode, serving_model)[0]
+
+
+def predict_heart_disease_risk_batch(
+    db: Session,
+    batch_input: BatchPredictionInput,
+    explanation_mode: ExplanationMode = ExplanationMode.none,
+    serving_model: Optional[ServingModel] = None
+) -> BatchPredictionOutput:
+    """
+    Predict heart disease risk for many patients in one pass
+    
+    Args:
+        db: Database session
+        batch_input: Inputs to score
+        explanation_mode: How to explain the predictions
+        serving_model: Ensemble or distilled student; defaults to the
+            SERVING_MODEL setting
+        
+    Returns:
+        BatchPredictionOutput with one prediction per input, in order
+    """
+    with latency_tracker.time(f"predict_batch.{explanation_mode.value}"):
+        # Convert inputs to one feature matrix
+        features = build_feature_matrix(batch_input.inputs)
+        return BatchPredictionOutput(
+            predictions=_predict(db, features, explanation_mode, serving_model)
+        )
+
+
+def _predict(
+    db: Session,
+    features: np.ndarray,
+    explanation_mode: ExplanationMode,
+    serving_model: Optional[ServingModel] = None
+) -> List[PredictionOutput]:
+    # Take the served model once and share it with the explanation; a
+    # version swapped in meanwhile does not affect this request
+    version, aggregated_data = model_cache.get_current(db)
+    
+    # The student is scored and explained exactly like the ensemble
+    served_model = serving_model or SERVING_MODEL
+    explainer_key: Hashable = version
+    if served_model == ServingModel.student and aggregated_data.get('student') is not None:
+        aggregated_data = aggregated_data['student']
+        explainer_key = (version, served_model.value)
+    else:
+        served_model = ServingModel.ensemble
+    
+    # Results already computed with this version are reused per row
+    keys = [(served_model.value, *row) for row in features.tolist()]
+    results = result_cache.get_many(version, keys)
+    updated = []
+    
+    # Make predictions using global model for rows not cached yet
+    unscored = [i for i, result in enumerate(results) if result is None]
+    if unscored:
+        with latency_tracker.time("inference"):
+            risk_scores, _ = predict_batch_with_aggregated_model(aggregated_data, features[unscored])
+        for i, risk_score in zip(unscored, risk_scores):
+            results[i] = {'risk_score': float(risk_score)}
+        updated.extend(unscored)
+    
+    # Explain rows whose result lacks this mode's explanation
+    if explanation_mode != ExplanationMode.none:
+        unexplained = [i for i, result in enumerate(results) if explanation_mode.value not in result]
+        if unexplained:
+            explanations = explain_batch(
+                explanation_mode, explainer_key, aggregated_data, features[unexplained]
+            )
+            for i, explanation in zip(unexplained, explanations):
+                # Copied, since cached results are shared between requests
+                results[i] = {**results[i], explanation_mode.value: explanation}
+            updated.extend(unexplained)
+    
+    result_cache.put_many(version, [(keys[i], results[i]) for i in set(updated)])
+    
+    return [
+        PredictionOutput(
+            risk_level=determine_risk_level(result['risk_score']),
+            risk_score=result['risk_score'],
+            explanation_mode=explanation_mode,
+            shap_explanation=result.get(explanation_mode.value),
+            model_version=version,
+            served_model=served_model
+        )
+        for result in results
+    ]
+
+
+def warm_up(db: Session) -> dict:
+    """
+    Load the latest global model and run every explanation mode once
+    
+    Pays the model load, the shap import and the explainer construction
+    before the first real request does.
+    
+    Args:
+        db: Database session
+        
+    Returns:
+        Dictionary with the warmed-up version (None if no global model
+        exists yet) and the time taken
+    """
+    start = time.perf_counter()
+    try:
+        version, aggregated_data = model_cache.get_latest(db)
+    except HTTPException:
+        return {'version': None, 'seconds': time.perf_counter() - start}
+    
+    served = [(version, aggregated_data)]
+    if aggregated_data.get('student') is not None:
+        served.append(((version, ServingModel.student.value), aggregated_data['student']))
+    
+    features = np.zeros((1, len(get_feature_names())))
+    for explainer_key, model_data in served:
+        predict_batch_with_aggregated_model(model_data, features)
+        for mode in (ExplanationMode.approx, ExplanationMode.exact):
+            explain_batch(mode, explainer_key, model_data, features)
+    
+    seconds = time.perf_counter() - start
+    latency_tracker.record("warmup", seconds)
+    return {'version': version, 'seconds': seconds}
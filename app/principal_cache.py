@@ -0,0 +1,175 @@
+"""
+Cache of verified tokens and the doctors they resolve to
+
+Every authenticated request used to decode its JWT and query the doctor
+by email. Verified tokens are now kept for a short TTL together with a
+detached copy of the doctor row, so repeat requests skip both the token
+verification and the database round trip.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+
+from app.models import Doctor
+
+# Seconds a verified token stays cached
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+
+# Maximum number of cached tokens
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+
+
+def _detached_copy(doctor: Doctor) -> Doctor:
+    """Copy a doctor's column values into an instance owned by no session"""
+    copy = Doctor(**{
+        column.key: getattr(doctor, column.key)
+        for column in Doctor.__table__.columns
+    })
+    make_transient_to_detached(copy)
+    return copy
+
+
+class PrincipalCache:
+    """
+    Bounded LRU of token -> doctor entries with per-entry expiry
+
+    Entries expire after the TTL or when the token itself expires,
+    whichever comes first, and are dropped as soon as the doctor row is
+    updated or deleted in this process. Other processes are not notified:
+    a doctor deleted or changed through another worker stays authenticated
+    here, as cached, for up to the TTL.
+    """
+
+    def __init__(self, ttl_seconds: float = AUTH_CACHE_TTL_SECONDS, max_size: int = AUTH_CACHE_SIZE):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max(1, max_size)
+        self._entries: "OrderedDict[str, Tuple[float, Doctor]]" = OrderedDict()
+        self._tokens_by_doctor: Dict[int, Set[str]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0
+
+    def get(self, token: str) -> Optional[Doctor]:
+        """
+        Look up a verified token
+
+        Args:
+            token: Raw bearer token
+
+        Returns:
+            Detached Doctor, or None if the token is not cached
+        """
+        if not self.enabled:
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, doctor = entry
+            if expires_at <= now:
+                self._remove(token)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return doctor
+
+    def put(self, token: str, doctor: Doctor, token_expires_at: Optional[float] = None) -> None:
+        """
+        Cache a verified token
+
+        Args:
+            token: Raw bearer token
+            doctor: Doctor the token resolved to
+            token_expires_at: The token's "exp" claim as a Unix timestamp
+        """
+        if not self.enabled:
+            return
+
+        expires_at = time.time() + self.ttl_seconds
+        if token_expires_at is not None:
+            expires_at = min(expires_at, token_expires_at)
+
+        copy = _detached_copy(doctor)
+        with self._lock:
+            self._remove(token)
+            self._entries[token] = (expires_at, copy)
+            self._tokens_by_doctor.setdefault(copy.id, set()).add(token)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_doctor(self, doctor_id: int) -> None:
+        """Drop every cached token of a doctor"""
+        with self._lock:
+            tokens = self._tokens_by_doctor.pop(doctor_id, set())
+            for token in tokens:
+                self._entries.pop(token, None)
+            self.invalidations += len(tokens)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_doctor.clear()
+
+    def _remove(self, token: str) -> None:
+        # Caller holds the lock
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            tokens = self._tokens_by_doctor.get(entry[1].id)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._tokens_by_doctor[entry[1].id]
+
+    def stats(self) -> dict:
+        """
+        Get cache counters
+
+        Returns:
+            Dictionary with size, hits, misses, expirations, invalidations
+            and hit rate
+        """
+        with self._lock:
+            size = len(self._entries)
+            hits, misses = self.hits, self.misses
+            expirations, invalidations = self.expirations, self.invalidations
+        total = hits + misses
+        return {
+            'size': size,
+            'max_size': self.max_size,
+            'ttl_seconds': self.ttl_seconds,
+            'hits': hits,
+            'misses': misses,
+            'expirations': expirations,
+            'invalidations': invalidations,
+            'hit_rate': hits / total if total else 0.0,
+        }
+
+
+# Shared by every authenticated request of this worker
+principal_cache = PrincipalCache()
+
+
+@event.listens_for(Doctor, "after_update")
+@event.listens_for(Doctor, "after_delete")
+def _invalidate_changed_doctor(mapper, connection, target: Doctor) -> None:
+    # Fires for ORM flushes; bulk query.update()/delete() must call
+    # principal_cache.invalidate_doctor themselves
+    principal_cache.invalidate_doctor(target.id)
@@ -0,0 +1,134 @@
+"""
+Per-version cache of prediction results
+
+Clinics often re-score the same patient, for example when a report is
+regenerated, and prediction inputs are mostly small bounded integers, so
+repeated feature vectors are common. Results are kept keyed on the feature
+vector for the global model version that produced them: the risk score
+and every explanation computed for it so far. Entries of older versions
+are dropped as soon as a newer version is served.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+# Maximum number of cached feature vectors; 0 disables the cache
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "10000"))
+
+# Served model ("ensemble" or "student") followed by the feature vector
+FeatureKey = Tuple
+
+
+class ResultCache:
+    """
+    Bounded LRU of feature vector -> prediction result for one model version
+
+    A result is a dictionary with the 'risk_score' and the explanation of
+    each explanation mode computed so far, keyed by the mode's value.
+    """
+
+    def __init__(self, max_size: int = RESULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._version: Optional[int] = None
+        self._entries: "OrderedDict[FeatureKey, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get_many(self, version: int, keys: Sequence[FeatureKey]) -> List[Optional[dict]]:
+        """
+        Look up the results of feature vectors
+
+        Args:
+            version: GlobalModel version serving the request
+            keys: Served model and feature vector, in model feature order
+
+        Returns:
+            Cached result per key, None where nothing is cached
+        """
+        if not self.enabled:
+            return [None] * len(keys)
+
+        with self._lock:
+            self._switch_version(version)
+            if version != self._version:
+                # A request still running on an older version
+                self.misses += len(keys)
+                return [None] * len(keys)
+
+            results = []
+            for key in keys:
+                result = self._entries.get(key)
+                if result is None:
+                    self.misses += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                results.append(result)
+            return results
+
+    def put_many(self, version: int, items: Sequence[Tuple[FeatureKey, dict]]) -> None:
+        """
+        Cache results computed with a model version
+
+        Args:
+            version: GlobalModel version that computed the results
+            items: (key, result) pairs
+        """
+        if not self.enabled or not items:
+            return
+
+        with self._lock:
+            self._switch_version(version)
+            if version != self._version:
+                return
+            for key, result in items:
+                self._entries[key] = result
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _switch_version(self, version: int) -> None:
+        # Caller holds the lock
+        if self._version is None or version > self._version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._version = version
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+
+    def stats(self) -> dict:
+        """
+        Get cache counters
+
+        Returns:
+            Dictionary with cached version, size, hits, misses, version
+            invalidations and hit rate
+        """
+        with self._lock:
+            version, size = self._version, len(self._entries)
+            hits, misses, invalidations = self.hits, self.misses, self.invalidations
+        total = hits + misses
+        return {
+            'version': version,
+            'size': size,
+            'max_size': self.max_size,
+            'hits': hits,
+            'misses': misses,
+            'invalidations': invalidations,
+            'hit_rate': hits / total if total else 0.0,
+        }
+
+
+# Shared by both prediction endpoints of this worker
+result_cache = ResultCache()
@@ -4,6 +4,7 @@ Pydantic schemas for request/response validation
 from pydantic import BaseModel, EmailStr, Field
 from typing import Optional, List
 from datetime import datetime
+from enum import Enum
 
 
 # Authentication Schemas
@@ -64,32 +65,149 @@ class PredictionInput(BaseModel):
     thal: int = Field(..., ge=0, le=3, description="Thalassemia (0-3)")
 
 
+class ExplanationMode(str, Enum):
+    """How much explanation to compute for a prediction"""
+    none = "none"  # Risk score only
+    approx = "approx"  # Path-based (Saabas) contributions from the same tree traversal
+    exact = "exact"  # TreeSHAP over the whole ensemble
+
+
+class ServingModel(str, Enum):
+    """Which model of a global version scores predictions"""
+    ensemble = "ensemble"  # Every tree of every contribution
+    student = "student"  # Bounded-size forest distilled from the ensemble
+
+
 class PredictionOutput(BaseModel):
     """Schema for prediction output"""
     risk_level: str = Field(..., description="Risk level: Low, Medium, or High")
     risk_score: float = Field(..., description="Risk score between 0 and 1")
-    shap_explanation: dict = Field(..., description="SHAP feature importance values")
+    explanation_mode: ExplanationMode = Field(
+        ExplanationMode.exact, description="Explanation mode used for shap_explanation"
+    )
+    shap_explanation: Optional[dict] = Field(
+        None,
+        description="Feature contributions: SHAP values (exact), Saabas contributions (approx) or null (none)"
+    )
+    model_version: Optional[int] = Field(None, description="GlobalModel version that made the prediction")
+    served_model: ServingModel = Field(ServingModel.ensemble, description="Model of that version that made it")
+
+
+class BatchPredictionInput(BaseModel):
+    """Schema for batch heart disease prediction input"""
+    inputs: List[PredictionInput] = Field(
+        ..., min_length=1, max_length=10000, description="Patients to score"
+    )
+
+
+class BatchPredictionOutput(BaseModel):
+    """Schema for batch prediction output, in input order"""
+    predictions: List[PredictionOutput]
 
 
 # Federated Learning Schemas
+class AggregationPolicy(str, Enum):
+    """Which contributions take part in the global ensemble"""
+    all = "all"  # Every contribution not superseded by a newer incremental upload
+    latest_per_hospital = "latest_per_hospital"  # Only each hospital's newest contribution
+
+
+class AggregationStrategy(str, Enum):
+    """How the members of a global version are combined"""
+    ensemble = "ensemble"  # Weighted ensemble of every member's trees
+    parameter_averaging = "parameter_averaging"  # Sample-weighted mean of the members' logistic regressions
+
+
+class TreeSelection(str, Enum):
+    """How trees are picked within each member under a tree budget"""
+    stratified = "stratified"  # Uniformly at random
+    greedy = "greedy"  # Closest to the member's full output on validation inputs
+
+
 class ModelContributionResponse(BaseModel):
     """Schema for model contribution response"""
     id: int
     doctor_id: int
     hospital_name: str
     num_samples: int
+    supersedes_id: Optional[int] = Field(None, description="Contribution replaced by this incremental update")
     created_at: datetime
 
     class Config:
         from_attributes = True
 
 
+class TrainingJobResponse(BaseModel):
+    """Schema for background training job status"""
+    id: str
+    status: str = Field(..., description="queued, running, succeeded or failed")
+    hospital_name: str
+    incremental: bool = False
+    supersedes_id: Optional[int] = Field(
+        None, description="Contribution the incremental job builds on, set when it starts"
+    )
+    submitted_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    queue_seconds: Optional[float] = Field(None, description="Time spent waiting for a pool process")
+    train_seconds: Optional[float] = Field(None, description="Time spent training")
+    error: Optional[str] = None
+    contribution: Optional[ModelContributionResponse] = None
+
+    class Config:
+        from_attributes = True
+
+
 class GlobalModelResponse(BaseModel):
     """Schema for global model response"""
     id: int
     version: int
     num_contributions: int
+    pinned: bool = Field(False, description="Exempt from retention")
+    compacted_at: Optional[datetime] = Field(None, description="When retention dropped the model")
+    strategy: AggregationStrategy = Field(
+        AggregationStrategy.ensemble, description="How the contributions were combined"
+    )
+    tree_budget_report: Optional[dict] = Field(
+        None, description="Trees kept under a tree budget and their fidelity to the full ensemble, if one applied"
+    )
+    student_fidelity: Optional[dict] = Field(
+        None, description="Fidelity of the distilled student against the ensemble, if one was distilled"
+    )
     created_at: datetime
 
     class Config:
         from_attributes = True
+
+
+class AggregationJobResponse(BaseModel):
+    """Schema for background aggregation job status"""
+    id: str
+    status: str = Field(..., description="queued, running, succeeded or failed")
+    policy: Optional[AggregationPolicy] = None
+    strategy: Optional[AggregationStrategy] = None
+    tree_budget: Optional[int] = None
+    tree_selection: Optional[TreeSelection] = None
+    distill: Optional[bool] = None
+    submitted_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    queue_seconds: Optional[float] = Field(None, description="Time spent behind earlier aggregations")
+    aggregate_seconds: Optional[float] = Field(None, description="Time spent aggregating")
+    error: Optional[str] = None
+    global_model: Optional[GlobalModelResponse] = None
+
+    class Config:
+        from_attributes = True
+
+
+class ContributionPage(BaseModel):
+    """Schema for one page of model contributions, newest first"""
+    items: List[ModelContributionResponse]
+    next_cursor: Optional[int] = Field(None, description="Pass as cursor to get the next page; null on the last page")
+
+
+class GlobalModelPage(BaseModel):
+    """Schema for one page of global model versions, newest first"""
+    items: List[GlobalModelResponse]
+    next_cursor: Optional[int] = Field(None, description="Pass as cursor to get the next page; null on the last page")
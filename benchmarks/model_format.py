@@ -0,0 +1,125 @@
+"""
+Size and load time of the model storage formats
+
+Trains local models on sample_heart_data.csv and compares, for a single
+contribution and for an aggregated ensemble of several:
+
+- pickle: the pickled sklearn estimator contributions used to be stored as
+  (loading includes compiling it for inference)
+- full: the float64/int32 array artifact
+- compact_float32 / compact_uint16: the compact artifact format
+
+Prints a JSON report. Run from the repository root:
+
+    python -m benchmarks.model_format
+"""
+import io
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ["MODEL_STORE_DIR"] = tempfile.mkdtemp(prefix="model-format-")
+
+from app.federated.artifact_store import artifact_store, save_forest, load_forest
+from app.federated.compiled_forest import CompiledForest
+from app.federated.data_processor import parse_csv_stream
+from app.federated.local_trainer import fit_local_model
+
+SAMPLE_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sample_heart_data.csv")
+
+# Contributions merged into the aggregated ensemble
+ENSEMBLE_MEMBERS = 10
+
+# Timed repetitions per load; the median is reported
+LOAD_REPEATS = 50
+
+
+def _median_seconds(load) -> float:
+    durations = []
+    for _ in range(LOAD_REPEATS):
+        start = time.perf_counter()
+        load()
+        durations.append(time.perf_counter() - start)
+    return float(np.median(durations))
+
+
+def _store_full(forest: CompiledForest) -> str:
+    arrays = forest.to_arrays()
+    forest_shape = {name: arrays.pop(name) for name in ('max_depth', 'n_features')}
+    return artifact_store.put(arrays, {'kind': 'compiled_forest', 'forest_shape': forest_shape})
+
+
+def _compare(name: str, models: list, X: np.ndarray) -> dict:
+    weights = [1.0 / len(models)] * len(models)
+    forest = CompiledForest.concatenate(
+        [CompiledForest.from_sklearn(model, weight) for model, weight in zip(models, weights)]
+    )
+    expected = sum(w * m.predict_proba(X)[:, list(m.classes_).index(1)] for m, w in zip(models, weights))
+
+    blob = pickle.dumps({'models': models, 'weights': weights})
+
+    def load_pickle():
+        data = pickle.loads(blob)
+        return CompiledForest.concatenate(
+            [CompiledForest.from_sklearn(m, w) for m, w in zip(data['models'], data['weights'])]
+        )
+
+    formats = {
+        'pickle': {
+            'bytes': len(blob),
+            'load_ms': _median_seconds(load_pickle) * 1000,
+            'max_abs_error': float(np.abs(load_pickle().predict(X) - expected).max()),
+        }
+    }
+
+    stored = {'full': _store_full(forest)}
+    for encoding in ('float32', 'uint16'):
+        stored[f'compact_{encoding}'] = save_forest(forest, value_encoding=encoding)
+
+    for format_name, artifact_hash in stored.items():
+        loaded = load_forest(artifact_hash)[0]
+        predictions = loaded.predict(X)
+        formats[format_name] = {
+            'bytes': artifact_store.size(artifact_hash),
+            'load_ms': _median_seconds(lambda: load_forest(artifact_hash)) * 1000,
+            'max_abs_error': float(np.abs(predictions - expected).max()),
+            'decisions_changed': int(((predictions > 0.5) != (expected > 0.5)).sum()),
+        }
+
+    for format_name, result in formats.items():
+        result['size_reduction_vs_pickle'] = formats['pickle']['bytes'] / result['bytes']
+        result['load_speedup_vs_pickle'] = formats['pickle']['load_ms'] / result['load_ms']
+
+    return {'name': name, 'trees': forest.n_trees, 'nodes': forest.n_nodes, 'formats': formats}
+
+
+def main() -> dict:
+    with open(SAMPLE_CSV, 'rb') as f:
+        X, y = parse_csv_stream(io.BytesIO(f.read()))
+
+    rng = np.random.default_rng(0)
+    models = []
+    for member in range(ENSEMBLE_MEMBERS):
+        # Each simulated hospital trains on a bootstrap resample
+        rows = np.arange(len(X)) if member == 0 else rng.integers(0, len(X), len(X))
+        model_weights, _ = fit_local_model(X[rows], y[rows], n_jobs=1)
+        models.append(model_weights['model'])
+
+    return {
+        'dataset': {'path': 'sample_heart_data.csv', 'rows': int(len(X))},
+        'results': [
+            _compare('contribution', models[:1], X),
+            _compare(f'ensemble_of_{ENSEMBLE_MEMBERS}', models, X),
+        ],
+    }
+
+
+if __name__ == "__main__":
+    json.dump(main(), sys.stdout, indent=2)
+    print()
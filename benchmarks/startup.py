@@ -0,0 +1,131 @@
+"""
+Worker import time and time to first prediction
+
+Prepares a temporary database with one aggregated global model, then
+starts fresh Python processes that import the app, run its startup events
+and serve /predict, with and without WARMUP_ON_STARTUP. Reports medians
+as JSON:
+
+    python -m benchmarks.startup [--runs 5] [--output startup.json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# Libraries that a serving worker should not import until it needs them
+HEAVY_MODULES = ('shap', 'sklearn', 'pandas', 'scipy')
+
+PREDICTION_INPUT = {
+    'age': 63, 'sex': 1, 'cp': 3, 'trestbps': 145, 'chol': 233, 'fbs': 1, 'restecg': 0,
+    'thalach': 150, 'exang': 0, 'oldpeak': 2.3, 'slope': 0, 'ca': 0, 'thal': 1,
+}
+
+
+def _child() -> None:
+    """Measure one worker start; runs in a fresh interpreter"""
+    start = time.perf_counter()
+    from app.main import app
+    import_seconds = time.perf_counter() - start
+    loaded_after_import = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    from fastapi.testclient import TestClient
+
+    headers = {'Authorization': f"Bearer {os.environ['BENCH_TOKEN']}"}
+    start = time.perf_counter()
+    with TestClient(app) as client:
+        startup_seconds = time.perf_counter() - start
+        first = {}
+        for mode in ('none', 'exact'):
+            request_start = time.perf_counter()
+            response = client.post("/predict", json=PREDICTION_INPUT, headers=headers,
+                                    params={'explain': mode})
+            response.raise_for_status()
+            first[mode] = (time.perf_counter() - request_start) * 1000.0
+
+    json.dump({
+        'import_seconds': import_seconds,
+        'startup_seconds': startup_seconds,
+        'first_predict_ms': first['none'],
+        'first_exact_predict_ms': first['exact'],
+        'time_to_first_prediction_seconds': import_seconds + startup_seconds + first['none'] / 1000.0,
+        'heavy_modules_after_import': loaded_after_import,
+    }, sys.stdout)
+
+
+def _prepare(workdir: str) -> dict:
+    """Create a database with one aggregated model; returns the child environment"""
+    env = {
+        **os.environ,
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'startup.db')}",
+        'MODEL_STORE_DIR': os.path.join(workdir, "model_store"),
+        'SECRET_KEY': os.environ.get('SECRET_KEY', "benchmark-secret-key"),
+    }
+    os.environ.update(env)
+
+    from fastapi.testclient import TestClient
+    from app.main import app
+    from benchmarks.suite import BenchmarkClient, synthesize_csv
+
+    rng = np.random.default_rng(0)
+    with TestClient(app) as client:
+        bench = BenchmarkClient(client)
+        for _ in range(4):
+            bench.train(bench.add_hospital(), synthesize_csv(300, rng))
+        bench.aggregate()
+
+    env['BENCH_TOKEN'] = bench.headers[0]['Authorization'].split(" ", 1)[1]
+    return env
+
+
+def run(runs: int) -> dict:
+    env = _prepare(tempfile.mkdtemp(prefix="fl-startup-"))
+    results = {}
+
+    for warmup in (False, True):
+        child_env = {**env, 'WARMUP_ON_STARTUP': str(warmup).lower(), 'PYTHONWARNINGS': "ignore"}
+        samples = []
+        for _ in range(runs):
+            output = subprocess.check_output(
+                [sys.executable, "-m", "benchmarks.startup", "--child"],
+                env=child_env, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            )
+            samples.append(json.loads(output))
+
+        summary = {
+            key: float(np.median([sample[key] for sample in samples]))
+            for key in samples[0] if key != 'heavy_modules_after_import'
+        }
+        summary['heavy_modules_after_import'] = samples[0]['heavy_modules_after_import']
+        results['warmup' if warmup else 'no_warmup'] = summary
+
+    return {'runs': runs, 'results': results}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5, help="Worker starts per configuration")
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child()
+        return
+
+    results = run(args.runs)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,586 @@
+"""
+Reproducible benchmark suite for prediction, training and aggregation
+
+Runs the FastAPI app in-process against a temporary SQLite database and
+artifact store, with hospital datasets synthesized from the distribution
+of sample_heart_data.csv. Measures:
+
+- /predict p50/p99 latency and throughput as contributing hospitals grow,
+  served by the full ensemble and by the distilled student
+- /predict/batch throughput per batch size
+- training time as a function of rows
+- aggregation time, global artifact size and serving layout size per
+  contribution count
+- ensemble vs parameter averaging aggregation: latency, artifact size and
+  accuracy on held-out rows, after every hospital trained on rows labelled
+  by a known rule (see synthesize_rule_data)
+- the same measurements per tree budget and tree selection method
+
+Results are written as JSON so runs can be compared across commits:
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --quick
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_CSV = os.path.join(REPO_ROOT, "sample_heart_data.csv")
+
+# Configuration of a full run and of a quick (smoke) run
+DEFAULT_CONFIG = {
+    'hospitals': [1, 2, 4, 8, 16],
+    'rows_per_hospital': 300,
+    'predict_requests': 300,
+    'explain_modes': ['none', 'approx', 'exact'],
+    'serving_models': ['ensemble', 'student'],
+    'strategies': ['ensemble', 'parameter_averaging'],
+    'holdout_rows': 2000,
+    'tree_budgets': [0, 25, 50, 100, 200, 400, 800],
+    'tree_selections': ['stratified', 'greedy'],
+    'batch_sizes': [1, 10, 100, 1000, 5000],
+    'batch_requests': 20,
+    'train_rows': [100, 1000, 10000, 50000],
+    'incremental_rows': 100,
+    'seed': 0,
+}
+QUICK_CONFIG = {
+    **DEFAULT_CONFIG,
+    'hospitals': [1, 2, 4],
+    'rows_per_hospital': 100,
+    'predict_requests': 50,
+    'tree_budgets': [0, 25, 100],
+    'batch_sizes': [1, 100, 1000],
+    'batch_requests': 5,
+    'train_rows': [100, 1000],
+}
+
+# Value ranges of the API's input validation
+COLUMN_BOUNDS = {
+    'age': (20, 90), 'trestbps': (80, 220), 'chol': (100, 600),
+    'thalach': (60, 220), 'oldpeak': (0.0, 6.5),
+}
+
+# Known decision rule of the labelled data: log-odds of the target per
+# standard deviation of each feature. The remaining features are noise
+RULE_WEIGHTS = {
+    'oldpeak': -1.2, 'ca': -1.0, 'cp': 0.9, 'thalach': 0.8,
+    'exang': -0.7, 'sex': -0.6, 'thal': -0.6, 'age': -0.4,
+}
+
+
+def synthesize_csv(n_rows: int, rng: np.random.Generator) -> bytes:
+    """
+    Synthesize a hospital dataset shaped like sample_heart_data.csv
+
+    Rows are resampled from the sample file with the continuous columns
+    jittered, so every hospital has a different but plausible dataset.
+
+    Args:
+        n_rows: Number of rows
+        rng: Random generator
+
+    Returns:
+        CSV file content
+    """
+    import pandas as pd
+
+    base = pd.read_csv(SAMPLE_CSV)
+    df = base.iloc[rng.integers(0, len(base), n_rows)].reset_index(drop=True)
+    jitter = {'age': 4, 'trestbps': 10, 'chol': 30, 'thalach': 12}
+    for column, scale in jitter.items():
+        low, high = COLUMN_BOUNDS[column]
+        df[column] = (df[column] + rng.integers(-scale, scale + 1, n_rows)).clip(low, high)
+    df['oldpeak'] = (df['oldpeak'] + rng.normal(0, 0.3, n_rows)).clip(*COLUMN_BOUNDS['oldpeak']).round(1)
+    return df.to_csv(index=False).encode()
+
+
+def synthesize_rule_data(n_rows: int, rng: np.random.Generator) -> tuple:
+    """
+    Synthesize rows whose target follows a known decision rule
+
+    Each column is drawn independently from its values in the sample file,
+    continuous ones jittered, so the features cover far more combinations
+    than the sample's rows. The target is drawn with probability
+    sigmoid(sum of RULE_WEIGHTS times the standardized features), so the
+    rule's own accuracy is the best any model can reach.
+
+    Args:
+        n_rows: Number of rows
+        rng: Random generator
+
+    Returns:
+        Tuple of (DataFrame with the target column, rule probability per row)
+    """
+    import pandas as pd
+
+    base = pd.read_csv(SAMPLE_CSV)
+    df = pd.DataFrame({
+        column: base[column].to_numpy()[rng.integers(0, len(base), n_rows)]
+        for column in base.columns if column != 'target'
+    })
+    jitter = {'age': 4, 'trestbps': 10, 'chol': 30, 'thalach': 12}
+    for column, scale in jitter.items():
+        low, high = COLUMN_BOUNDS[column]
+        df[column] = (df[column] + rng.integers(-scale, scale + 1, n_rows)).clip(low, high)
+    df['oldpeak'] = (df['oldpeak'] + rng.normal(0, 0.3, n_rows)).clip(*COLUMN_BOUNDS['oldpeak']).round(1)
+
+    logit = sum(
+        weight * (df[column] - base[column].mean()) / base[column].std()
+        for column, weight in RULE_WEIGHTS.items()
+    ).to_numpy()
+    probabilities = 1.0 / (1.0 + np.exp(-logit))
+    df['target'] = (rng.random(n_rows) < probabilities).astype(int)
+    return df, probabilities
+
+
+def synthesize_rule_csv(n_rows: int, rng: np.random.Generator) -> bytes:
+    """Hospital dataset labelled by the known rule, see synthesize_rule_data"""
+    return synthesize_rule_data(n_rows, rng)[0].to_csv(index=False).encode()
+
+
+def _prediction_inputs(df) -> list:
+    return [
+        {key: (float(value) if key == 'oldpeak' else int(value)) for key, value in row.items()}
+        for row in df.to_dict(orient='records')
+    ]
+
+
+def synthesize_labelled_inputs(n_rows: int, rng: np.random.Generator) -> tuple:
+    """
+    Prediction inputs labelled by the known rule
+
+    Returns:
+        Tuple of (inputs, targets, rule probabilities)
+    """
+    df, probabilities = synthesize_rule_data(n_rows, rng)
+    targets = df.pop('target').to_numpy()
+    return _prediction_inputs(df), targets, probabilities
+
+
+def synthesize_inputs(n_rows: int, rng: np.random.Generator) -> list:
+    """Prediction inputs drawn like synthesize_csv, without the target"""
+    import pandas as pd
+
+    df = pd.read_csv(io.BytesIO(synthesize_csv(n_rows, rng)))
+    return _prediction_inputs(df.drop(columns='target'))
+
+
+def _latency_summary(durations: list) -> dict:
+    durations_ms = np.asarray(durations) * 1000.0
+    return {
+        'requests': len(durations),
+        'p50_ms': float(np.percentile(durations_ms, 50)),
+        'p99_ms': float(np.percentile(durations_ms, 99)),
+        'mean_ms': float(durations_ms.mean()),
+        'throughput_rps': float(len(durations) / (durations_ms.sum() / 1000.0)),
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class BenchmarkClient:
+    """
+    In-process API client with one registered doctor per hospital
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.headers = []
+
+    def add_hospital(self) -> dict:
+        index = len(self.headers)
+        doctor = {
+            'hospital_name': f"Hospital {index}",
+            'doctor_name': f"Doctor {index}",
+            'license_id': f"BENCH-{index}",
+            'email': f"doctor{index}@bench.example.com",
+            'password': "benchmark-password",
+        }
+        response = self.client.post("/auth/register", json=doctor)
+        response.raise_for_status()
+        response = self.client.post(
+            "/auth/login", data={'username': doctor['email'], 'password': doctor['password']}
+        )
+        response.raise_for_status()
+        headers = {'Authorization': f"Bearer {response.json()['access_token']}"}
+        self.headers.append(headers)
+        return headers
+
+    def train(self, headers: dict, csv_data: bytes, incremental: bool = False) -> dict:
+        """Upload a dataset and wait for its training job"""
+        start = time.perf_counter()
+        response = self.client.post(
+            "/federated/train", files={'file': ("data.csv", csv_data, "text/csv")}, headers=headers,
+            params={'incremental': str(incremental).lower()}
+        )
+        response.raise_for_status()
+        job_id = response.json()['id']
+        while True:
+            job = self.client.get(f"/federated/jobs/{job_id}", headers=headers).json()
+            if job['status'] in ("succeeded", "failed"):
+                break
+            time.sleep(0.01)
+        if job['status'] == "failed":
+            raise RuntimeError(f"Training failed: {job['error']}")
+        job['wall_seconds'] = time.perf_counter() - start
+        return job
+
+    def aggregate(self, timeout: float = 600.0, **params) -> tuple:
+        """Queue an aggregation and poll its job until the global model is stored"""
+        start = time.perf_counter()
+        response = self.client.post("/federated/aggregate", headers=self.headers[0], params=params)
+        response.raise_for_status()
+        job_id = response.json()['id']
+        while time.perf_counter() - start < timeout:
+            response = self.client.get(f"/federated/aggregations/{job_id}", headers=self.headers[0])
+            response.raise_for_status()
+            job = response.json()
+            if job['status'] == 'succeeded':
+                return job['global_model'], time.perf_counter() - start
+            if job['status'] == 'failed':
+                raise RuntimeError(f"Aggregation failed: {job['error']}")
+            time.sleep(0.01)
+        raise RuntimeError(f"Aggregation job {job_id} did not finish")
+
+    def wait_for_version(self, payload: dict, version: int, timeout: float = 60.0) -> float:
+        """Predict until the worker serves the given global version"""
+        start = time.perf_counter()
+        while time.perf_counter() - start < timeout:
+            response = self.client.post("/predict", json=payload, headers=self.headers[0],
+                                        params={'explain': 'none'})
+            response.raise_for_status()
+            if response.json()['model_version'] == version:
+                return time.perf_counter() - start
+            time.sleep(0.005)
+        raise RuntimeError(f"Global model version {version} was not swapped in")
+
+    def timed_post(self, path: str, payload: dict, **params) -> float:
+        start = time.perf_counter()
+        response = self.client.post(path, json=payload, headers=self.headers[0], params=params)
+        elapsed = time.perf_counter() - start
+        response.raise_for_status()
+        return elapsed
+
+
+def _global_storage_bytes(version: int) -> dict:
+    """
+    Bytes of a version's artifact, and of the serving layout this host
+    decoded or assembled from it
+    """
+    from app.database import SessionLocal
+    from app.models import GlobalModel
+    from app.federated.artifact_store import SERVING_SUFFIX, artifact_store
+
+    db = SessionLocal()
+    try:
+        artifact_hash = (
+            db.query(GlobalModel.artifact_hash)
+            .filter(GlobalModel.version == version)
+            .scalar()
+        )
+    finally:
+        db.close()
+    if not artifact_hash:
+        return {'artifact_bytes': 0, 'serving_bytes': 0}
+    return {
+        'artifact_bytes': artifact_store.size(artifact_hash),
+        'serving_bytes': artifact_store.size(artifact_hash, SERVING_SUFFIX),
+    }
+
+
+def bench_scaling(bench: BenchmarkClient, config: dict, rng: np.random.Generator) -> tuple:
+    """
+    Add hospitals step by step; after each step aggregate and measure
+    /predict per explanation mode
+
+    Returns:
+        Tuple of (predict results, aggregation results)
+    """
+    inputs = synthesize_inputs(config['predict_requests'], rng)
+    predict_results, aggregate_results = [], []
+
+    for target in config['hospitals']:
+        while len(bench.headers) < target:
+            headers = bench.add_hospital()
+            bench.train(headers, synthesize_csv(config['rows_per_hospital'], rng))
+
+        global_model, aggregate_seconds = bench.aggregate(
+            distill=str('student' in config['serving_models']).lower()
+        )
+        # The model manager prepares the new version off the request path
+        swap_seconds = bench.wait_for_version(inputs[0], global_model['version'])
+        student_fidelity = global_model['student_fidelity']
+        aggregate_results.append({
+            'contributions': global_model['num_contributions'],
+            # Includes distillation, which grows with the whole ensemble
+            'aggregate_ms': aggregate_seconds * 1000.0,
+            'distill_ms': student_fidelity['seconds'] * 1000.0 if student_fidelity else None,
+            'swap_ms': swap_seconds * 1000.0,
+            **_global_storage_bytes(global_model['version']),
+            'student_fidelity': student_fidelity,
+        })
+
+        for model in config['serving_models']:
+            for mode in config['explain_modes']:
+                # First request of each mode on the new version
+                first_request_ms = bench.timed_post(
+                    "/predict", inputs[0], explain=mode, model=model
+                ) * 1000.0
+                durations = [
+                    bench.timed_post("/predict", payload, explain=mode, model=model)
+                    for payload in inputs
+                ]
+                predict_results.append({
+                    'hospitals': target,
+                    'model': model,
+                    'explain': mode,
+                    'first_request_ms': first_request_ms,
+                    **_latency_summary(durations),
+                })
+
+    return predict_results, aggregate_results
+
+
+def bench_batch(bench: BenchmarkClient, config: dict, rng: np.random.Generator) -> list:
+    """Throughput of /predict/batch per batch size"""
+    results = []
+    for batch_size in config['batch_sizes']:
+        payload = {'inputs': synthesize_inputs(batch_size, rng)}
+        bench.timed_post("/predict/batch", payload)
+        durations = [bench.timed_post("/predict/batch", payload) for _ in range(config['batch_requests'])]
+        summary = _latency_summary(durations)
+        results.append({
+            'batch_size': batch_size,
+            'p50_ms': summary['p50_ms'],
+            'p99_ms': summary['p99_ms'],
+            'rows_per_second': batch_size * summary['throughput_rps'],
+        })
+    return results
+
+
+def _evaluate_version(bench: BenchmarkClient, config: dict, global_model: dict, holdout: tuple) -> dict:
+    """
+    Held-out accuracy and /predict latency of a new global version
+
+    Args:
+        holdout: Tuple of (inputs, targets, rule probabilities) from
+            synthesize_labelled_inputs; the rule's own scores are reported
+            as the ceiling of what a model can reach
+    """
+    from sklearn.metrics import roc_auc_score
+
+    inputs, targets, rule_probabilities = holdout
+    bench.wait_for_version(inputs[0], global_model['version'])
+    response = bench.client.post(
+        "/predict/batch", json={'inputs': inputs}, headers=bench.headers[0], params={'explain': 'none'}
+    )
+    response.raise_for_status()
+    scores = np.array([p['risk_score'] for p in response.json()['predictions']])
+
+    latency = {}
+    for mode in config['explain_modes']:
+        durations = [
+            bench.timed_post("/predict", payload, explain=mode)
+            for payload in inputs[:config['predict_requests']]
+        ]
+        latency[mode] = _latency_summary(durations)
+
+    return {
+        'contributions': global_model['num_contributions'],
+        **_global_storage_bytes(global_model['version']),
+        'holdout_rows': len(targets),
+        'accuracy': float(np.mean((scores > 0.5) == targets)),
+        'roc_auc': float(roc_auc_score(targets, scores)),
+        'brier': float(np.mean((scores - targets) ** 2)),
+        'rule_accuracy': float(np.mean((rule_probabilities > 0.5) == targets)),
+        'rule_roc_auc': float(roc_auc_score(targets, rule_probabilities)),
+        'predict': latency,
+    }
+
+
+def _train_rule_contributions(bench: BenchmarkClient, config: dict, rng: np.random.Generator) -> tuple:
+    """
+    Give every hospital a new contribution trained on rows labelled by the
+    known rule, and draw held-out rows from the same rule
+
+    Aggregating with the latest_per_hospital policy then combines only
+    these contributions.
+
+    Returns:
+        Held-out rows, see synthesize_labelled_inputs
+    """
+    for headers in bench.headers:
+        bench.train(headers, synthesize_rule_csv(config['rows_per_hospital'], rng))
+    return synthesize_labelled_inputs(config['holdout_rows'], rng)
+
+
+def bench_strategies(bench: BenchmarkClient, config: dict, holdout: tuple) -> list:
+    """
+    Aggregate the rule-labelled contributions with each strategy and
+    compare the results on held-out rows of the same rule
+    """
+    results = []
+    for strategy in config['strategies']:
+        global_model, aggregate_seconds = bench.aggregate(
+            strategy=strategy, policy='latest_per_hospital', distill='false'
+        )
+        results.append({
+            'strategy': strategy,
+            'aggregate_ms': aggregate_seconds * 1000.0,
+            **_evaluate_version(bench, config, global_model, holdout),
+        })
+    return results
+
+
+def bench_tree_budget(bench: BenchmarkClient, config: dict, holdout: tuple) -> list:
+    """
+    Accuracy and latency of the ensemble of the rule-labelled contributions
+    per tree budget and selection method
+    """
+    results = []
+    for budget in config['tree_budgets']:
+        # Without a budget the selection method makes no difference
+        for selection in (config['tree_selections'] if budget else ['stratified']):
+            global_model, aggregate_seconds = bench.aggregate(
+                strategy='ensemble', policy='latest_per_hospital', tree_budget=budget,
+                tree_selection=selection, distill='false'
+            )
+            report = global_model['tree_budget_report']
+            results.append({
+                'tree_budget': budget,
+                'selection': selection,
+                'trees': report['selected_trees'] if report else None,
+                'fidelity': report['fidelity'] if report else None,
+                'aggregate_ms': aggregate_seconds * 1000.0,
+                **_evaluate_version(bench, config, global_model, holdout),
+            })
+    return results
+
+
+def bench_training(bench: BenchmarkClient, config: dict, rng: np.random.Generator) -> list:
+    """
+    Training job time per dataset size, and of an incremental update with
+    incremental_rows new rows on top of a dataset of that size
+    """
+    headers = bench.headers[0]
+    results = []
+    for n_rows in config['train_rows']:
+        csv_data = synthesize_csv(n_rows, rng)
+        job = bench.train(headers, csv_data)
+        incremental_job = bench.train(
+            headers, synthesize_csv(config['incremental_rows'], rng), incremental=True
+        )
+        results.append({
+            'rows': n_rows,
+            'csv_bytes': len(csv_data),
+            'train_seconds': job['train_seconds'],
+            'queue_seconds': job['queue_seconds'],
+            'wall_seconds': job['wall_seconds'],
+            'incremental_rows': config['incremental_rows'],
+            'incremental_train_seconds': incremental_job['train_seconds'],
+            'incremental_wall_seconds': incremental_job['wall_seconds'],
+        })
+    return results
+
+
+def run(config: dict) -> dict:
+    """
+    Run every benchmark in a fresh temporary environment
+
+    Args:
+        config: Benchmark configuration (see DEFAULT_CONFIG)
+
+    Returns:
+        JSON-serializable results
+    """
+    workdir = tempfile.mkdtemp(prefix="fl-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["MODEL_STORE_DIR"] = os.path.join(workdir, "model_store")
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret-key")
+    # Inputs repeat across explanation modes and models; measure the
+    # models, not the result cache
+    os.environ.setdefault("RESULT_CACHE_SIZE", "0")
+
+    import sklearn
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    rng = np.random.default_rng(config['seed'])
+    started = time.time()
+
+    with TestClient(app) as client:
+        bench = BenchmarkClient(client)
+        predict_results, aggregate_results = bench_scaling(bench, config, rng)
+        batch_results = bench_batch(bench, config, rng)
+        training_results = bench_training(bench, config, rng)
+        holdout = _train_rule_contributions(bench, config, rng)
+        strategy_results = bench_strategies(bench, config, holdout)
+        tree_budget_results = bench_tree_budget(bench, config, holdout)
+
+    return {
+        'meta': {
+            'commit': _git_commit(),
+            'started_at': datetime.utcfromtimestamp(started).isoformat(),
+            'duration_seconds': time.time() - started,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'sklearn': sklearn.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'config': config,
+        },
+        'predict': predict_results,
+        'predict_batch': batch_results,
+        'training': training_results,
+        'aggregation': aggregate_results,
+        'strategies': strategy_results,
+        'tree_budget': tree_budget_results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--quick", action="store_true", help="Small configuration for a fast smoke run")
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+    parser.add_argument("--hospitals", help="Comma-separated hospital counts, e.g. 1,2,4,8")
+    parser.add_argument("--train-rows", help="Comma-separated training dataset sizes")
+    parser.add_argument("--seed", type=int, help="Random seed")
+    args = parser.parse_args()
+
+    config = dict(QUICK_CONFIG if args.quick else DEFAULT_CONFIG)
+    if args.hospitals:
+        config['hospitals'] = [int(n) for n in args.hospitals.split(",")]
+    if args.train_rows:
+        config['train_rows'] = [int(n) for n in args.train_rows.split(",")]
+    if args.seed is not None:
+        config['seed'] = args.seed
+
+    results = run(config)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()